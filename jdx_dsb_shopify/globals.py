@@ -1,6 +1,6 @@
 import os
 
-from jdx_utils.api.secrets import get_secret_from_sm
+from jdx_dsb_shopify.util.secret_utils import get_secret
 
 shopify_secret_name = {
     'dev': 'dsb-shopify-dev2-secret',
@@ -29,6 +29,9 @@ NIPS_PLUS_LP = 699.00
 SNOWFLAKE_SECRET_NAME = 'dsb-snowflake-secrets'
 SNOWFLAKE_WH = 'DSB_ANALYTICS_WH'
 
+# Platform database
+PLATFORM_DB_SECRET_NAME = 'dsb-platform-db-readonly'
+
 # Jotform details
 JOTFORM_SECRET_NAME = 'dsb-jotform-api-key'
 JOTFORM_ID_REDRAW ='231075275142955'
@@ -37,6 +40,10 @@ JOTFORM_ID_BIRCH = '231068067067962'
 
 # Google Sheet
 GOOGLE_API_SECRET_NAME = 'dsb-ingestion-bot-key'
+GOOGLE_API_SCOPES = (
+    'https://spreadsheets.google.com/feeds',
+    'https://www.googleapis.com/auth/drive',
+)
 INVENTORY_SHEET_ID = '1-TTSt61uvWsVNI93boGyijqAWVcwzd_B4MfSA6u4_sA'
 ORDER_CREATION_SHEET_ID = '1pP7oib65GRye7VXOt06xO5S17oA9tP0ixDP2Jt43q_o'
 AMAZON_FBA_USER_SHEET_ID = '1JgoRadxvhUM9beOO4voGpPpucfX8SHT7ettjBShB9-4'
@@ -49,7 +56,24 @@ slack_secret_mapping = {
 
 SLACK_BOT_SECRET_NAME = slack_secret_mapping[os.environ['ENV']]
 
-# Get slack secrets
-slack_secrets = get_secret_from_sm(SLACK_BOT_SECRET_NAME)
-SLACK_BOT_TOKEN = slack_secrets['SLACK_BOT_TOKEN']
-SLACK_APP_TOKEN = slack_secrets['SLACK_APP_TOKEN']
\ No newline at end of file
+
+
+def get_slack_bot_token():
+    return get_secret(SLACK_BOT_SECRET_NAME)['SLACK_BOT_TOKEN']
+
+
+def get_slack_app_token():
+    return get_secret(SLACK_BOT_SECRET_NAME)['SLACK_APP_TOKEN']
+
+
+# Slack tokens are resolved on first access so importing globals does not call Secrets Manager
+_lazy_globals = {
+    'SLACK_BOT_TOKEN': get_slack_bot_token,
+    'SLACK_APP_TOKEN': get_slack_app_token,
+}
+
+
+def __getattr__(name):
+    if name in _lazy_globals:
+        return _lazy_globals[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,29 +1,26 @@
+import asyncio
 import logging
 import os
 
 import click
 import pandas as pd
-from google.oauth2.service_account import Credentials
-from jdx_slack_bot.util.google_drive_util import append_df2gsheet, get_spreadsheet
-from jdx_utils.api.secrets import get_secret_from_sm, get_google_api_creds
 from jdx_utils.util import log_start_stop, log_runtime
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
 
-from jdx_dsb_shopify.globals import SHOPIFY_SECRET_NAME, GOOGLE_API_SECRET_NAME, SLACK_BOT_TOKEN, \
-    AMAZON_FBA_USER_SHEET_ID
-from jdx_dsb_shopify.scripts.jotform_integration import get_b2b_orders, get_latest_product_variant_info
-from jdx_dsb_shopify.util.shopify_utils import ShopifyHelper
+from jdx_dsb_shopify.globals import SHOPIFY_SECRET_NAME, GOOGLE_API_SECRET_NAME, AMAZON_FBA_USER_SHEET_ID, \
+    SNOWFLAKE_SECRET_NAME, GOOGLE_API_SCOPES
+from jdx_dsb_shopify.scripts.jotform_integration import SLACK_CHANNELS, get_b2b_orders, \
+    get_latest_product_variant_info
+from jdx_dsb_shopify.util.async_utils import AsyncShopifyHelper, post_slack_message, run_blocking
+from jdx_dsb_shopify.util.normalize_utils import normalize_orders
+from jdx_dsb_shopify.util.secret_utils import get_google_credentials, prefetch_secrets
+from jdx_dsb_shopify.util.snowflake_utils import set_query_tag
 from jdx_dsb_shopify.util.util import fuzzy_merge
 
 logger = logging.getLogger(__name__)
 
-creds = get_google_api_creds(GOOGLE_API_SECRET_NAME)
-scopes = [
-    'https://spreadsheets.google.com/feeds',
-    'https://www.googleapis.com/auth/drive',
-]
-google_creds = Credentials.from_service_account_info(creds, scopes=scopes)
+
+def get_google_creds():
+    return get_google_credentials(GOOGLE_API_SECRET_NAME, scopes=GOOGLE_API_SCOPES)
 
 
 @log_start_stop
@@ -35,12 +32,32 @@ def amazon_fba_shopify(
         start_user_number: int =None,
         batch_size: int =None
 ):
-    shopify_helper = ShopifyHelper(SHOPIFY_SECRET_NAME)
-    # get Amazon FBA orders from Google Sheet
-    total_amazon_fba_orders = get_spreadsheet(
-        spreadsheet_id=AMAZON_FBA_USER_SHEET_ID,
-        range='Sheet1',
-        creds=google_creds,
+    asyncio.run(amazon_fba_shopify_async(start_user_number, batch_size))
+
+
+async def amazon_fba_shopify_async(
+        start_user_number: int = None,
+        batch_size: int = None
+):
+    prefetch_secrets([SHOPIFY_SECRET_NAME, SNOWFLAKE_SECRET_NAME])
+    set_query_tag('jdx_dsb_shopify.amazon_fba_shopify')
+    async with AsyncShopifyHelper(SHOPIFY_SECRET_NAME) as shopify_helper:
+        await _amazon_fba_shopify(shopify_helper, start_user_number, batch_size)
+
+
+async def _amazon_fba_shopify(shopify_helper: AsyncShopifyHelper, start_user_number: int, batch_size: int):
+    from jdx_slack_bot.util.google_drive_util import append_df2gsheet, get_spreadsheet
+
+    google_creds = get_google_creds()
+    # get Amazon FBA orders from Google Sheet and the latest variant information at the same time
+    total_amazon_fba_orders, variant_df = await asyncio.gather(
+        run_blocking(
+            get_spreadsheet,
+            spreadsheet_id=AMAZON_FBA_USER_SHEET_ID,
+            range='Sheet1',
+            creds=google_creds,
+        ),
+        run_blocking(get_latest_product_variant_info, shopify_helper.shop_env),
     )
 
     total_amazon_fba_orders['User Number'] = total_amazon_fba_orders['User Number'].astype(int)
@@ -50,25 +67,25 @@ def amazon_fba_shopify(
     if batch_size is not None:
         batch_size = int(batch_size)
         total_amazon_fba_orders = total_amazon_fba_orders.sort_values('User Number', ascending=True).head(batch_size)
-    # get latest variant information
-    shopify_secrets = get_secret_from_sm(SHOPIFY_SECRET_NAME)
-    shop_env = shopify_secrets['SHOP_ENV']
-    variant_df = get_latest_product_variant_info(shop_env)
 
     # create order based on amazon FBA user creation sheet
     # Only create order if STATUS='REGISTERED'
-    new_orders = total_amazon_fba_orders.query('Status=="REGISTERED"')
-    new_orders['account_name'] = 'Amazon FBA'
-    new_orders['product_short_name'] = 'birch'
+    new_orders = total_amazon_fba_orders.query('Status=="REGISTERED"').assign(
+        account_name='Amazon FBA',
+        product_short_name='birch',
+    )
+    new_orders = normalize_orders(new_orders, strip_cols=('First Name', 'Last Name'), email_cols=('Email',))
 
     if len(new_orders) > 0:
         logger.info(f'Found {len(new_orders)} orders to create.')
-        new_orders['account_name_sku'] = new_orders['account_name'] + '|' + new_orders['product_short_name']
-        variant_df['account_name_sku'] = variant_df['account_name'] + '|' + variant_df['product_short_name']
+        # account names are only matched against variants of the same product
         fuzzy_matched_df = fuzzy_merge(
-            new_orders, variant_df[['account_name_sku', 'id', 'product_id', 'price']],
-            'account_name_sku', 'account_name_sku',
+            new_orders,
+            variant_df[['account_name', 'product_short_name', 'id', 'product_id', 'price']]
+                .rename(columns={'account_name': 'variant_account_name'}),
+            'account_name', 'variant_account_name',
             threshold=90,
+            block_keys='product_short_name',
             how='left'
         ).rename(columns={'id': 'variant_id'})
         fuzzy_matched_df_cols = [
@@ -79,9 +96,7 @@ def amazon_fba_shopify(
             'product_id'
         ]
 
-        shopify_order_names = list()
-        shopify_order_ids = list()
-        shopify_order_date=list()
+        order_payloads = list()
         for order in fuzzy_matched_df.iterrows():
             account_name = order[1]['account_name']
             first_name = order[1]['First Name']
@@ -110,23 +125,30 @@ def amazon_fba_shopify(
                 account_address=account_address
             )
             logger.info(f'Create order for {account_name} with email: {email}')
-            r = shopify_helper.create_order(order_payload)
-            if r.status_code in (200, 201):  # successfully created
+            order_payloads.append(order_payload)
+
+        shopify_order_names = list()
+        shopify_order_ids = list()
+        shopify_order_date=list()
+        responses = await shopify_helper.create_orders(order_payloads)
+        for order_payload, r in zip(order_payloads, responses):
+            if r is not None and r.status_code in (200, 201):  # successfully created
                 logger.info(f"Created shopify order: {r.json()['order']['name']}")
                 shopify_order_names.append(r.json()['order']['name'])
                 shopify_order_ids.append(r.json()['order']['id'])
                 shopify_order_date.append(r.json()['order']["created_at"])
             else:
+                logger.error(f"Failed to create order for email: {order_payload['order']['email']}")
                 shopify_order_names.append('')
                 shopify_order_ids.append('')
                 shopify_order_date.append('')
 
         shopify_order_created = pd.concat(
             [
-                fuzzy_matched_df[fuzzy_matched_df_cols],
+                fuzzy_matched_df[fuzzy_matched_df_cols].reset_index(drop=True),
                 pd.DataFrame(shopify_order_names, columns=['order_name']),
                 pd.DataFrame(shopify_order_ids, columns=['order_id']),
-                pd.DataFrame(shopify_order_ids, columns=['order_created_at']),
+                pd.DataFrame(shopify_order_date, columns=['order_created_at']),
             ], axis=1
         )
 
@@ -140,7 +162,8 @@ def amazon_fba_shopify(
 
         logger.info(shopify_order_created[update_cols].fillna(''))
 
-        response = append_df2gsheet(
+        response = await run_blocking(
+            append_df2gsheet,
             df=shopify_order_created[update_cols].fillna(''),
             spreadsheet_id=AMAZON_FBA_USER_SHEET_ID,
             sheet_name='Orders',
@@ -150,26 +173,11 @@ def amazon_fba_shopify(
         logger.info('Updated order creation report on Google drive:')
         logger.info(response)
 
-        client = WebClient(token=SLACK_BOT_TOKEN)
-
-        slack_channel_map = {
-            'dev': '#dsb-slack-test',
-            'prd': '#cs-x-dsb',
-        }
-
         info_msg = f'I have created {len(shopify_order_created)} Amazon FBA orders in Shopify. \n'
         review_msg = f'Please review the google sheet https://docs.google.com/spreadsheets/d/{AMAZON_FBA_USER_SHEET_ID}. \n'''
 
         msg = info_msg + review_msg
-        try:
-            result = client.chat_postMessage(
-                channel=slack_channel_map[os.environ['ENV']],
-                text=msg
-            )
-            # Log the result
-            logger.info(result)
-        except SlackApiError as e:
-            logger.error(f"Error posting the message: {e}")
+        await post_slack_message(SLACK_CHANNELS[os.environ['ENV']], msg)
 
 
         # Send slack notification and update
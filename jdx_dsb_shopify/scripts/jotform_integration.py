@@ -1,125 +1,203 @@
+import asyncio
 import logging
 import os
 
+import click
 import pandas as pd
-from google.oauth2.service_account import Credentials
-from jdx_slack_bot.util.google_drive_util import append_df2gsheet, get_spreadsheet
-from jdx_utils.api.secrets import get_secret_from_sm, get_google_api_creds
 from jdx_utils.util import log_start_stop, log_runtime
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-from snowflake.snowpark import Session
 
 from jdx_dsb_shopify.globals import SNOWFLAKE_SECRET_NAME, SHOPIFY_SECRET_NAME, JOTFORM_SECRET_NAME, \
     JOTFORM_ID_HAZEL, JOTFORM_ID_BIRCH, INVENTORY_SHEET_ID, GOOGLE_API_SECRET_NAME, ORDER_CREATION_SHEET_ID, \
-    SLACK_BOT_TOKEN
-from jdx_dsb_shopify.util.jotform_utils import JotformAPIClient, parse_form_names, parse_form_dates
+    PLATFORM_DB_SECRET_NAME, GOOGLE_API_SCOPES, get_slack_bot_token
+from jdx_dsb_shopify.util.async_utils import AsyncJotformAPIClient, AsyncShopifyHelper, post_slack_message, \
+    run_blocking
+from jdx_dsb_shopify.util.cache import JsonState, ParquetCache
+from jdx_dsb_shopify.util.jotform_utils import extract_answers
 from jdx_dsb_shopify.util.logging import setup_logging_env
+from jdx_dsb_shopify.util.match_memo import MatchMemo
+from jdx_dsb_shopify.util.normalize_utils import clean_email, decategorize, normalize_orders, \
+    parse_dates, parse_hazel_products, split_names, standardize_names
+from jdx_dsb_shopify.util.order_queue import PROCESSING, QUEUED, OrderQueue
 from jdx_dsb_shopify.util.platform_db_utils import get_platformdb_conn_str
+from jdx_dsb_shopify.util.secret_utils import get_google_credentials, get_secret, prefetch_secrets
 from jdx_dsb_shopify.util.shopify_utils import ShopifyHelper
+from jdx_dsb_shopify.util.snowflake_utils import fetch_pandas, get_table_version, set_query_tag
 from jdx_dsb_shopify.util.util import fuzzy_merge
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
-creds = get_google_api_creds(GOOGLE_API_SECRET_NAME)
-scopes = [
-    'https://spreadsheets.google.com/feeds',
-    'https://www.googleapis.com/auth/drive',
+# memo of imaging center spellings matched to variant account names, see scripts/match_memo.py
+ACCOUNT_NAME_MEMO = 'jotform_account_name'
+
+# last fully processed submission of every form, see get_submission_watermarks
+SUBMISSION_WATERMARKS = 'jotform_submission_watermarks'
+# submissions older than this are never turned into orders
+ORDER_LOOKBACK = timedelta(days=30)
+JOTFORM_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+JOTFORM_FORM_IDS = {
+    'birch': JOTFORM_ID_BIRCH,
+    'hazel': JOTFORM_ID_HAZEL,
+    # 'hazel_plus': JOTFORM_ID_HAZEL,
+}
+JOTFORM_COLS = [
+    'patientsName',
+    'patientsEmail',
+    'patientsDob',
+    'patientsLmp',
+    'imagingCenters',
+    'patientsPhone',
+    'kitCode25',
+    'kitCode43',
+    'hazelTest'
 ]
-google_creds = Credentials.from_service_account_info(creds, scopes=scopes)
+JOTFORM_FORM_STATUSES = ['ACTIVE', 'ARCHIVED', 'CUSTOM']
+
+SLACK_CHANNELS = {
+    'dev': '#dsb-slack-test',
+    'prd': '#cs-x-dsb',
+}
+
+VARIANT_DTYPES = {
+    'id': 'int64',
+    'product_id': 'int64',
+    'title': 'object',
+    'sku': 'object',
+    'price': 'float64',
+    'product_short_name': 'object',
+    'update_ts': 'object',
+}
 
-def parse_hazel_product(x):
-    if 'plus' in x.lower():
-        return 'hazel_plus'
-    else:
-        return 'hazel_basic'
 
-def pull_orders_from_jotform(
+def get_google_creds():
+    return get_google_credentials(GOOGLE_API_SECRET_NAME, scopes=GOOGLE_API_SCOPES)
+
+
+async def pull_orders_from_jotform_async(
+        jotform_client: AsyncJotformAPIClient,
         form_id,
         cols: list,
         form_statuses: list = None,
+        since: dict = None,
 ):
-    jotform_api_key = get_secret_from_sm(JOTFORM_SECRET_NAME)['API_KEY']
-    jotform_client = JotformAPIClient(jotform_api_key)
-    forms = jotform_client.get_form_submissions(form_id=form_id)
+    """
+    Args:
+        jotform_client: client shared by the pulls of the run
+        form_id: Jotform form id
+        cols: question names to extract
+        form_statuses: only keep submissions with these statuses
+        since: watermark {'created_at', 'id'}, only submissions after it are pulled
+    """
+    filter_array = submission_filter(form_id, form_statuses, since)
+    selected_forms = list()
+    async for submissions in jotform_client.iter_form_submissions(form_id, page_size=1000, filterArray=filter_array):
+        selected_forms.extend(select_submissions(submissions, form_statuses, since))
+
+    logger.info(f'Found {len(selected_forms)} active forms for form: {form_id}')
+    if len(selected_forms) == 0:
+        return None
+
+    return submissions_to_form_info(selected_forms, cols)
+
+
+def submission_filter(form_id, form_statuses: list = None, since: dict = None):
+    """
+    Returns:
+        dict: filterArray of the submissions after the watermark, None without a watermark
+    """
     if form_statuses:
         logger.info(f'Looking for submissions with the following status: {",".join(form_statuses)}')
-        selected_forms = [form for form in forms.json()['content'] if form['status'] in form_statuses]
-    else:
-        selected_forms = [form for form in forms.json()['content']]
+    if since is None:
+        return None
+    # created_at has a resolution of seconds, ids are increasing, so filter inclusively and drop what was seen
+    logger.info(f'Pulling submissions of form {form_id} since {since["created_at"]} (id {since["id"]})')
+    return {'created_at:gte': since['created_at'], 'status:ne': 'DELETED'}
 
-    logger.info(f'Found {len(selected_forms)} active forms for form: {form_id}')
-    form_infos = list()
-
-    for form in selected_forms:
-        form_df = pd.DataFrame.from_dict(form['answers'], orient='index')
-        form_answers = form_df.query('name.isin(@cols)')[['name','answer']].T
-        form_answers.columns = form_answers.iloc[0,:]
-        form_answers = form_answers.iloc[1:]
-        form_answers = form_answers.rename(columns={'kitCode43':'kit_code', 'kitCode25': 'kit_code'})
-        form_answers['created_at'] = form['created_at']
-        form_infos.append(form_answers)
-
-    logger.info(form_infos)
-    if len(form_infos)>0:
-        form_info = pd.concat(form_infos).reset_index().drop(columns=['index'])
-    else:
-        form_info = None
+
+def select_submissions(submissions: list, form_statuses: list = None, since: dict = None) -> list:
+    return [
+        form for form in submissions
+        if (not form_statuses or form['status'] in form_statuses)
+        and (since is None or int(form['id']) > int(since['id']))
+    ]
+
+
+def log_latency_metrics(client):
+    for call, metrics in client.latency_metrics().items():
+        logger.info(f'{call}: {metrics["calls"]} calls, {metrics["total_s"]:.1f}s total, {metrics["max_s"]:.1f}s max')
+
+
+def submissions_to_form_info(submissions: list, cols: list) -> pd.DataFrame:
+    """
+    Args:
+        submissions: raw submissions of one form
+        cols: question names to extract
+
+    Returns:
+        pd.DataFrame: one row per submission with the answers, created_at and submission_id
+    """
+    form_info = pd.DataFrame(extract_answers(submissions, cols))
+    kit_code_cols = [c for c in ('kitCode43', 'kitCode25') if c in form_info.columns]
+    if kit_code_cols:
+        kit_codes = form_info[kit_code_cols]
+        form_info['kit_code'] = kit_codes.mask(kit_codes == '').bfill(axis=1).iloc[:, 0].fillna(kit_codes.iloc[:, 0])
+        form_info = form_info.drop(columns=kit_code_cols)
+    form_info['created_at'] = [form['created_at'] for form in submissions]
+    form_info['submission_id'] = [form['id'] for form in submissions]
 
     return form_info
 
-@log_start_stop
-@log_runtime
-def all_orders_from_jotform():
-    cols = [
-        'patientsName',
-        'patientsEmail',
-        'patientsDob',
-        'patientsLmp',
-        'imagingCenters',
-        'patientsPhone',
-        'kitCode25',
-        'kitCode43',
-        'created_at',
-        'hazelTest'
-    ]
 
-    form_id_dict = {
-        'birch': JOTFORM_ID_BIRCH,
-        'hazel': JOTFORM_ID_HAZEL,
-        # 'hazel_plus': JOTFORM_ID_HAZEL,
-    }
-    form_infos = list()
-    for k, form_id in form_id_dict.items():
-        form_info = pull_orders_from_jotform(form_id=form_id, cols=cols, form_statuses=['ACTIVE', 'ARCHIVED', 'CUSTOM'])
-        if form_info is not None:
-            form_info[['first_name', 'last_name']] = (
-                form_info['patientsName']
-                    .apply(lambda x: parse_form_names(x))
-                    .apply(pd.Series)
-            )
-
-            form_info['dob'] = form_info['patientsDob'].apply(lambda x: parse_form_dates(x))
-            form_info['lmp'] = form_info['patientsLmp'].apply(lambda x: parse_form_dates(x))
-
-            if k == 'hazel':
-                form_info['product_short_name'] = form_info['hazelTest'].apply(lambda x: parse_hazel_product(x))
-            else:
-                form_info['product_short_name'] = k
-            form_infos.append(form_info)
-        else:
-            print(f'No new orders found for {k} products.')
+def parse_form_info(form_info: pd.DataFrame, form_key: str) -> pd.DataFrame:
+    """Parse the names, dates and product of the submissions of a form."""
+    form_info['form'] = form_key
+    form_info['first_name'], form_info['last_name'] = split_names(form_info['patientsName'])
 
-    if len(form_infos)>0:
-        total_from_info_df = pd.concat(form_infos)
-        return total_from_info_df
+    form_info['dob'] = parse_dates(form_info['patientsDob'])
+    form_info['lmp'] = parse_dates(form_info['patientsLmp'])
+
+    if form_key == 'hazel':
+        form_info['product_short_name'] = parse_hazel_products(form_info['hazelTest'])
     else:
-        return None
+        form_info['product_short_name'] = form_key
+    return form_info
+
+
+async def all_orders_from_jotform_async(jotform_client: AsyncJotformAPIClient, watermarks: dict = None):
+    """
+    Pull the submissions of every form concurrently.
+
+    Args:
+        jotform_client: client shared by the pulls of the run
+        watermarks: form key -> watermark, forms with a watermark are pulled incrementally
+
+    Returns:
+        pd.DataFrame: submissions of all forms with the form key in ``form``, None without submissions
+    """
+    watermarks = watermarks or dict()
+    form_infos = await asyncio.gather(*[
+        pull_orders_from_jotform_async(
+            jotform_client,
+            form_id=form_id,
+            cols=JOTFORM_COLS,
+            form_statuses=JOTFORM_FORM_STATUSES,
+            since=watermarks.get(k),
+        )
+        for k, form_id in JOTFORM_FORM_IDS.items()
+    ])
+    form_infos = [
+        parse_form_info(form_info, k)
+        for k, form_info in zip(JOTFORM_FORM_IDS, form_infos) if form_info is not None
+    ]
+    if len(form_infos) > 0:
+        return pd.concat(form_infos, ignore_index=True)
+    logger.info('No new orders found.')
+    return None
 
 
 def get_recent_order_df(limit=1000):
-    conn_str = get_platformdb_conn_str('dsb-platform-db-readonly')
+    conn_str = get_platformdb_conn_str(PLATFORM_DB_SECRET_NAME)
     query = f'''
             SELECT 
                 O.ordered_at, 
@@ -188,75 +266,124 @@ def get_b2b_orders(
 
 
 @log_start_stop
-def get_latest_product_variant_info(shop_env):
-    snowflake_secrets = get_secret_from_sm(SNOWFLAKE_SECRET_NAME)
-    connection_parameters = {
-        "account": snowflake_secrets['SNOWFLAKE_ACCOUNT'],
-        "user": snowflake_secrets['SNOWFLAKE_USER'],
-        "password": snowflake_secrets['SNOWFLAKE_PASSWORD'],
-        "warehouse": 'COMPUTE_WH',
-        "database": 'JDX_PLATFORM',
-        "schema": 'ANALYTICS',
-    }
-
-    session = Session.builder.configs(connection_parameters).create()
+def get_latest_product_variant_info(shop_env, use_cache: bool = True):
+    """
+    Latest Shopify variant of every account and product type.
+
+    The resolved table is cached on disk and only re-queried when SHOPIFY_B2B_PRODUCTS
+    changed since it was cached, which is once a day when manage_b2b_products runs.
+    """
+    from snowflake.snowpark.exceptions import SnowparkSQLException
+
+    cache = ParquetCache(f'shopify_b2b_products_{shop_env}')
+    version = None
+    if use_cache:
+        try:
+            version = get_table_version('JDX_PLATFORM.ANALYTICS.SHOPIFY_B2B_PRODUCTS')
+        except SnowparkSQLException as e:
+            logger.warning(f'Could not probe SHOPIFY_B2B_PRODUCTS version, skipping the cache: {e}')
+        df = cache.get(version)
+        if df is not None:
+            return df
+
+    # SHOPIFY_B2B_PRODUCTS is upserted on the variant id, a recreated product leaves the rows of its old
+    # variant ids behind, so keep the latest variant of every account and product type.
+    # An account can move between product shards (or be renamed), so partition on the account id in the title.
     query = f'''
-        SELECT *
+        SELECT ID, PRODUCT_ID, TITLE, SKU, PRICE, PRODUCT_SHORT_NAME, UPDATE_TS
         FROM JDX_PLATFORM.ANALYTICS.SHOPIFY_B2B_PRODUCTS
         WHERE ENV = '{shop_env}'
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY TRIM(SPLIT_PART(TITLE, '|', 1)), PRODUCT_SHORT_NAME
+            ORDER BY UPDATE_TS DESC
+        ) = 1
         ORDER BY UPDATE_TS DESC
     '''
 
-    data = session.sql(query).collect()
-    df = session.create_dataframe(data).to_pandas()
-    df = (
-        df
-            .sort_values('UPDATE_TS', ascending=False)
-            .groupby(['TITLE', 'SKU'])
-            .head(1)
-    )
-
-    df.columns = [c.lower() for c in df.columns]
-    df['account_id'] = df['title'].apply(lambda x: x.split('|')[0].strip())
-    df['account_name'] = df['title'].apply(lambda x: x.split('|')[1].strip().upper())
+    df = fetch_pandas(query, dtypes=VARIANT_DTYPES)
+    title_parts = df['title'].str.split('|')
+    df['account_id'] = title_parts.str[0].str.strip()
+    df['account_name'] = title_parts.str[1].str.strip().str.upper()
 
+    cache.put(df, version)
     return df
 
-def standardize_name(name):
-    name = ''.join(s.lower() if i!=0 else s.upper() for i, s in enumerate(name) )
-    return name
+def get_submission_watermarks(full_sync: bool = False) -> dict:
+    """
+    Watermark of every form to pull from. Without a stored watermark, or on a full sync,
+    submissions are pulled from the start of the order lookback window.
+
+    Returns:
+        dict: form key -> {'created_at', 'id'}
+    """
+    floor = {'created_at': (datetime.now() - ORDER_LOOKBACK).strftime(JOTFORM_DATETIME_FORMAT), 'id': '0'}
+    if full_sync:
+        return {'birch': floor, 'hazel': floor}
+    watermarks = JsonState(SUBMISSION_WATERMARKS).get()
+    return {
+        k: watermarks[k] if k in watermarks and watermarks[k]['created_at'] > floor['created_at'] else floor
+        for k in ('birch', 'hazel')
+    }
 
 
-@log_start_stop
-@log_runtime
-@setup_logging_env
-def jotform2shopify():
-    shopify_helper = ShopifyHelper(SHOPIFY_SECRET_NAME)
-    # find all orders from Jotform
-    total_form_info_df = (
-        all_orders_from_jotform()
-            .rename(columns={
-            'imagingCenters':'account_name',
-            'created_at': 'order_submitted_at',
-            'patientsEmail': 'email',
-        })
-    )
+def advance_submission_watermarks(watermarks: dict, submissions: pd.DataFrame, pending_ids) -> dict:
+    """
+    Move every form's watermark to its last submission that is done. Submissions whose order
+    is still pending (not matched to a variant or failed to create) hold the watermark back,
+    so they are pulled again on the next run.
+
+    Args:
+        watermarks: form key -> watermark the submissions were pulled from
+        submissions: pulled submissions with form, submission_id and order_submitted_at
+        pending_ids: submission ids whose order is not created yet
+
+    Returns:
+        dict: form key -> advanced watermark
+    """
+    watermarks = dict(watermarks)
+    submissions = submissions.assign(
+        sid=submissions['submission_id'].astype('int64'),
+        pending=submissions['submission_id'].isin(set(pending_ids)),
+    ).sort_values('sid')
+    for form, done in submissions.groupby('form'):
+        if done['pending'].any():
+            done = done[done['sid'] < done.loc[done['pending'], 'sid'].min()]
+        if len(done) > 0:
+            last = done.iloc[-1]
+            watermarks[form] = {'created_at': last['order_submitted_at'], 'id': last['submission_id']}
+    return watermarks
+
+
+def clean_form_orders(total_form_info_df: pd.DataFrame) -> pd.DataFrame:
+    """Rename and normalize parsed submissions into orders, dropping test orders."""
+    total_form_info_df = total_form_info_df.rename(columns={
+        'imagingCenters':'account_name',
+        'created_at': 'order_submitted_at',
+        'patientsEmail': 'email',
+    })
 
     # clean jotform format
-    for c in ('first_name', 'last_name', 'account_name', 'kit_code'):
-        total_form_info_df[c] = total_form_info_df[c].astype(str).apply(lambda x: x.upper().strip())
-
-    total_form_info_df = (
-        total_form_info_df
-            .query('account_name!="TEST"')
-            .query('last_name!="TEST"')
-            .query('first_name!="TEST"')
+    total_form_info_df = normalize_orders(
+        total_form_info_df,
+        upper_cols=('first_name', 'last_name', 'account_name', 'kit_code'),
+        email_cols=('email',),
     )
-    total_form_info_df['email'] = total_form_info_df['email'].apply(lambda x: x.lower().strip())
+    return total_form_info_df.query(
+        'account_name!="TEST" and last_name!="TEST" and first_name!="TEST"'
+    )
+
+
+def find_new_orders(total_form_info_df: pd.DataFrame, order_df: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Orders of the lookback window without a lab portal order yet.
 
+    Args:
+        total_form_info_df: cleaned Jotform orders
+        order_df: recent lab portal orders, queried when not given
+    """
     # remove orders that are already synced by matching kitcode in platform database
-    order_df = get_recent_order_df(limit=10000)
-    order_df['email'] = order_df['email'].apply(lambda x: x.lower().strip())
+    order_df = get_recent_order_df(limit=10000) if order_df is None else order_df.copy()
+    order_df['email'] = clean_email(order_df['email'])
     # match on kit code first
     form_lp_order_df_1 = total_form_info_df[['email', 'kit_code']].merge(
         order_df[['ordered_at','kit_code', 'lab_portal_order_number', 'shopify_order_id']],
@@ -281,6 +408,7 @@ def jotform2shopify():
         form_lp_order_df_resolved.drop(columns=['shopify_order_id_x', 'shopify_order_id_y']).drop_duplicates()
     )
 
+    total_form_info_df = total_form_info_df.copy()
     total_form_info_df['order_date'] = pd.to_datetime(total_form_info_df['order_submitted_at']).dt.date
     form_lp_order_df_resolved['order_date'] = pd.to_datetime(form_lp_order_df_resolved['ordered_at']).dt.date
     matched_lab_portal_order = total_form_info_df.merge(form_lp_order_df_resolved, on=['email'], how='left')
@@ -294,166 +422,312 @@ def jotform2shopify():
         on=['email', 'order_submitted_at'], how='left'
     )
 
-    # get latest variant information
-    shopify_secrets = get_secret_from_sm(SHOPIFY_SECRET_NAME)
-    shop_env = shopify_secrets['SHOP_ENV']
-    variant_df=get_latest_product_variant_info(shop_env)
-
     # Find orders to be created
     logger.info(total_form_info_df_final.columns)
-    new_orders = (
+    return (
         total_form_info_df_final
-            .query(f'order_submitted_at>"{str(datetime.now() - timedelta(days=30))}"')
+            .query(f'order_submitted_at>"{str(datetime.now() - ORDER_LOOKBACK)}"')
             .query('lab_portal_order_number.isna()').copy()
     )
 
-    if len(new_orders)>0:
-        logger.info(f'Found {len(new_orders)} orders to create.')
-        new_orders['account_name_sku'] = new_orders['account_name'] + '|' + new_orders['product_short_name']
-        variant_df['account_name_sku'] = variant_df['account_name'] + '|' + variant_df['product_short_name']
-        fuzzy_matched_df = fuzzy_merge(
-            new_orders, variant_df[['account_name_sku', 'id', 'product_id', 'price']],
-            'account_name_sku', 'account_name_sku',
-            threshold=90,
-            how='left'
-        ).rename(columns={'id':'variant_id'})
-        fuzzy_matched_df_cols = [
-            'account_name',
-            'first_name',
-            'last_name',
-            'email',
-            'dob',
-            'lmp',
-            'product_short_name',
-            'product_id',
-            'variant_id',
-            'kit_code',
-            'order_submitted_at',
-        ]
 
-        shopify_order_names=list()
-        shopify_order_ids = list()
-        for order in fuzzy_matched_df.iterrows():
-            account_name = order[1]['account_name']
-            first_name = standardize_name(order[1]['first_name'])
-            last_name = standardize_name(order[1]['last_name'])
-            email = order[1]['email']
-            variant_id = order[1]['variant_id']
-            product_id = order[1]['product_id']
-            account_address = {
-                "first_name": first_name,
-                "last_name": last_name,
-                "company": account_name,
-                "address1": "11760 Sorrento Valley Rd Suite J",
-                "phone": "858-201-7154",
-                "city": "San Diego",
-                "province": "California",
-                "country": "US",
-                "zip": "92122"
-            }
-
-            order_payload = get_b2b_orders(
-                variant_id = variant_id,
-                product_id = product_id,
-                first_name = first_name,
-                last_name = last_name,
-                email = email,
-                account_address = account_address
-            )
-            logger.info(f'Create order for {account_name} with email: {email}')
-            r=shopify_helper.create_order(order_payload)
-            if r.status_code in (200,201): #successfully created
-                logger.info(f"Created shopify order: {r.json()['order']['name']}")
-                shopify_order_names.append(r.json()['order']['name'])
-                shopify_order_ids.append(r.json()['order']['id'])
-            else:
-                shopify_order_names.append('')
-                shopify_order_ids.append('')
-
-        shopify_order_created = pd.concat(
-            [
-                fuzzy_matched_df[fuzzy_matched_df_cols],
-                pd.DataFrame(shopify_order_names, columns=['order_name']),
-                pd.DataFrame(shopify_order_ids, columns=['order_id'])
-            ], axis=1
+def match_order_variants(new_orders: pd.DataFrame, variant_df: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Match the imaging center of every order to the Shopify variant of its account.
+    Orders without a close enough variant are dropped.
+
+    Args:
+        new_orders: orders to match
+        variant_df: latest variant of every account, queried when not given
+    """
+    # get latest variant information
+    if variant_df is None:
+        shopify_secrets = get_secret(SHOPIFY_SECRET_NAME)
+        shop_env = shopify_secrets['SHOP_ENV']
+        variant_df=get_latest_product_variant_info(shop_env)
+
+    # account names are only matched against variants of the same product
+    fuzzy_matched_df = fuzzy_merge(
+        new_orders,
+        variant_df[['account_name', 'product_short_name', 'id', 'product_id', 'price']]
+            .rename(columns={'account_name': 'variant_account_name'}),
+        'account_name', 'variant_account_name',
+        threshold=90,
+        block_keys='product_short_name',
+        memo=MatchMemo(ACCOUNT_NAME_MEMO),
+        how='left'
+    ).rename(columns={'id':'variant_id'})
+
+    fuzzy_matched_df['customer_first_name'] = standardize_names(fuzzy_matched_df['first_name'])
+    fuzzy_matched_df['customer_last_name'] = standardize_names(fuzzy_matched_df['last_name'])
+    return fuzzy_matched_df
+
+
+def create_shopify_orders(shopify_helper: ShopifyHelper, fuzzy_matched_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Create a Shopify order for every matched order.
+
+    Returns:
+        pd.DataFrame: the orders with order_name and order_id, both empty where the order failed
+    """
+    order_payloads = build_order_payloads(fuzzy_matched_df)
+    responses = shopify_helper.create_orders(order_payloads)
+    return created_orders_frame(fuzzy_matched_df, order_payloads, responses)
+
+
+async def create_shopify_orders_async(shopify_helper: AsyncShopifyHelper, fuzzy_matched_df: pd.DataFrame):
+    """Async version of create_shopify_orders, every order create is in flight at once."""
+    order_payloads = build_order_payloads(fuzzy_matched_df)
+    responses = await shopify_helper.create_orders(order_payloads)
+    return created_orders_frame(fuzzy_matched_df, order_payloads, responses)
+
+
+def build_order_payloads(fuzzy_matched_df: pd.DataFrame) -> list:
+    order_payloads = list()
+    for order in fuzzy_matched_df.iterrows():
+        account_name = order[1]['account_name']
+        first_name = order[1]['customer_first_name']
+        last_name = order[1]['customer_last_name']
+        email = order[1]['email']
+        variant_id = order[1]['variant_id']
+        product_id = order[1]['product_id']
+        account_address = {
+            "first_name": first_name,
+            "last_name": last_name,
+            "company": account_name,
+            "address1": "11760 Sorrento Valley Rd Suite J",
+            "phone": "858-201-7154",
+            "city": "San Diego",
+            "province": "California",
+            "country": "US",
+            "zip": "92122"
+        }
+
+        order_payload = get_b2b_orders(
+            variant_id = variant_id,
+            product_id = product_id,
+            first_name = first_name,
+            last_name = last_name,
+            email = email,
+            account_address = account_address
         )
+        logger.info(f'Create order for {account_name} with email: {email}')
+        order_payloads.append(order_payload)
+    return order_payloads
+
+
+def created_orders_frame(fuzzy_matched_df: pd.DataFrame, order_payloads: list, responses: list) -> pd.DataFrame:
+    """
+    Returns:
+        pd.DataFrame: the orders with order_name and order_id, both empty where the order failed,
+            and response_status, the HTTP status of the order create or None without a response
+    """
+    fuzzy_matched_df_cols = [
+        'account_name',
+        'first_name',
+        'last_name',
+        'email',
+        'dob',
+        'lmp',
+        'product_short_name',
+        'product_id',
+        'variant_id',
+        'kit_code',
+        'order_submitted_at',
+        'submission_id',
+    ]
 
-        # get inventory information
-        inventory_df = get_spreadsheet(INVENTORY_SHEET_ID, range='Providers', creds=google_creds)[
-            [
-                'Kit_Code',
-                'Device_ID',
-                'ReturnShipping',
-                'ExpDate'
-            ]
-        ]
+    shopify_order_names=list()
+    shopify_order_ids = list()
+    response_statuses = list()
+    for order_payload, r in zip(order_payloads, responses):
+        response_statuses.append(None if r is None else r.status_code)
+        if r is not None and r.status_code in (200,201): #successfully created
+            logger.info(f"Created shopify order: {r.json()['order']['name']}")
+            shopify_order_names.append(r.json()['order']['name'])
+            shopify_order_ids.append(r.json()['order']['id'])
+        else:
+            logger.error(f"Failed to create order for email: {order_payload['order']['email']}")
+            shopify_order_names.append('')
+            shopify_order_ids.append('')
+
+    return pd.concat(
+        [
+            fuzzy_matched_df[fuzzy_matched_df_cols].reset_index(drop=True),
+            pd.DataFrame(shopify_order_names, columns=['order_name']),
+            pd.DataFrame(shopify_order_ids, columns=['order_id']),
+            pd.DataFrame({'response_status': pd.Series(response_statuses, dtype=object)}),
+        ], axis=1
+    )
 
-        inventory_df = inventory_df.rename(columns={
-            'Kit_Code': 'kit_code',
-            'Device_ID':'sample_number',
-            'ReturnShipping': 'return_tracking_number',
-            'ExpDate': 'expiration_date'
-        })
-
-        inventory_df['kit_code'] = inventory_df['kit_code'].apply(lambda x: x.upper())
-
-        shopify_order_created = shopify_order_created.merge(inventory_df, on='kit_code', how='left')
-        update_cols = [
-            'order_name',
-            'account_name',
-            'first_name',
-            'last_name',
-            'email',
-            'dob',
-            'lmp',
-            'kit_code',
-            'sample_number',
-            'return_tracking_number',
-            'expiration_date',
-            'order_submitted_at',
-        ]
-        response = append_df2gsheet(
-            df=shopify_order_created[update_cols].fillna(''),
-            spreadsheet_id=ORDER_CREATION_SHEET_ID,
-            creds=google_creds
+
+def report_created_orders(shopify_order_created: pd.DataFrame):
+    """
+    Append the created orders with their kit inventory to the order creation sheet and notify CS on Slack.
+    """
+    append_created_orders(shopify_order_created)
+
+    from slack_sdk import WebClient
+    from slack_sdk.errors import SlackApiError
+    client = WebClient(token=get_slack_bot_token())
+
+    try:
+        result = client.chat_postMessage(
+            channel=SLACK_CHANNELS[os.environ['ENV']],
+            text=created_orders_message(len(shopify_order_created))
         )
+        # Log the result
+        logger.info(result)
+    except SlackApiError as e:
+        logger.error(f"Error posting the message: {e}")
+
+
+async def report_created_orders_async(shopify_order_created: pd.DataFrame):
+    """Async version of report_created_orders."""
+    await run_blocking(append_created_orders, shopify_order_created)
+    await post_slack_message(SLACK_CHANNELS[os.environ['ENV']], created_orders_message(len(shopify_order_created)))
+
+
+def append_created_orders(shopify_order_created: pd.DataFrame):
+    """
+    Append the created orders with their kit inventory to the order creation sheet.
+    """
+    # get inventory information
+    from jdx_slack_bot.util.google_drive_util import append_df2gsheet, get_spreadsheet
+    google_creds = get_google_creds()
+    inventory_df = get_spreadsheet(INVENTORY_SHEET_ID, range='Providers', creds=google_creds)[
+        [
+            'Kit_Code',
+            'Device_ID',
+            'ReturnShipping',
+            'ExpDate'
+        ]
+    ]
 
-        logger.info('Updated order creation report on Google drive:')
-        logger.info(response)
+    inventory_df = inventory_df.rename(columns={
+        'Kit_Code': 'kit_code',
+        'Device_ID':'sample_number',
+        'ReturnShipping': 'return_tracking_number',
+        'ExpDate': 'expiration_date'
+    })
+
+    inventory_df['kit_code'] = inventory_df['kit_code'].str.upper()
+
+    shopify_order_created = shopify_order_created.merge(inventory_df, on='kit_code', how='left')
+    update_cols = [
+        'order_name',
+        'account_name',
+        'first_name',
+        'last_name',
+        'email',
+        'dob',
+        'lmp',
+        'kit_code',
+        'sample_number',
+        'return_tracking_number',
+        'expiration_date',
+        'order_submitted_at',
+    ]
+    response = append_df2gsheet(
+        df=decategorize(shopify_order_created[update_cols]).fillna(''),
+        spreadsheet_id=ORDER_CREATION_SHEET_ID,
+        creds=google_creds
+    )
 
-        client = WebClient(token=SLACK_BOT_TOKEN)
+    logger.info('Updated order creation report on Google drive:')
+    logger.info(response)
 
-        slack_channel_map = {
-            'dev': '#dsb-slack-test',
-            'prd': '#cs-x-dsb',
-        }
 
-        info_msg = f'I have created {len(shopify_order_created)} orders from Jotform to Shopify. \n'
-        review_msg = f'Please review the google sheet along with additional information you need to update lab ' \
-                     f'portal orders later on at https://docs.google.com/spreadsheets/d/{ORDER_CREATION_SHEET_ID}. \n'''
-        update_msg = 'Once orders are synced over to the lab portal, please update the following information in lab ' \
-                     'portal: kit_code, tracking_number, patient DoB, patient LMP, and patient chart. \n'
+def created_orders_message(n_orders: int) -> str:
+    info_msg = f'I have created {n_orders} orders from Jotform to Shopify. \n'
+    review_msg = f'Please review the google sheet along with additional information you need to update lab ' \
+                 f'portal orders later on at https://docs.google.com/spreadsheets/d/{ORDER_CREATION_SHEET_ID}. \n'
+    update_msg = 'Once orders are synced over to the lab portal, please update the following information in lab ' \
+                 'portal: kit_code, tracking_number, patient DoB, patient LMP, and patient chart. \n'
 
-        msg = info_msg + review_msg + update_msg
-        try:
-            result = client.chat_postMessage(
-                channel=slack_channel_map[os.environ['ENV']],
-                text=msg
-            )
-            # Log the result
-            logger.info(result)
-        except SlackApiError as e:
-            logger.error(f"Error posting the message: {e}")
+    return info_msg + review_msg + update_msg
 
 
-        # Send slack notification and update
+@click.command()
+@click.option("--full_sync", is_flag=True, help="pull every submission of the lookback window, ignoring the watermarks")
+@log_start_stop
+@log_runtime
+@setup_logging_env
+def jotform2shopify(full_sync: bool = False):
+    asyncio.run(jotform2shopify_async(full_sync))
+
+
+async def jotform2shopify_async(full_sync: bool = False):
+    """
+    Create the Shopify orders of new Jotform submissions. Once there are submissions to
+    order, the lab portal orders and the Shopify variants are queried on worker threads
+    at the same time.
+    """
+    prefetch_secrets([SHOPIFY_SECRET_NAME, SNOWFLAKE_SECRET_NAME, JOTFORM_SECRET_NAME, PLATFORM_DB_SECRET_NAME])
+    set_query_tag('jdx_dsb_shopify.jotform_integration')
+    async with AsyncShopifyHelper(SHOPIFY_SECRET_NAME) as shopify_helper, \
+            AsyncJotformAPIClient(get_secret(JOTFORM_SECRET_NAME)['API_KEY']) as jotform_client:
+        try:
+            await _jotform2shopify(shopify_helper, jotform_client, full_sync)
+        finally:
+            log_latency_metrics(jotform_client)
+            log_latency_metrics(shopify_helper)
 
-    else:
-        logger.info('No new Jotform orders found.')
 
+async def _jotform2shopify(
+        shopify_helper: AsyncShopifyHelper,
+        jotform_client: AsyncJotformAPIClient,
+        full_sync: bool,
+):
+    # find new orders from Jotform
+    watermark_state = JsonState(SUBMISSION_WATERMARKS)
+    watermarks = get_submission_watermarks(full_sync)
+    total_form_info_df = await all_orders_from_jotform_async(jotform_client, watermarks)
+    if total_form_info_df is None:
+        logger.info('No new Jotform submissions found.')
+        return
+    pulled_submissions = (
+        total_form_info_df[['form', 'submission_id', 'created_at']]
+            .rename(columns={'created_at': 'order_submitted_at'})
+    )
 
+    # submissions received by the webhook service are ordered from its queue, see scripts/jotform_webhook.py
+    order_queue = OrderQueue()
+    queued_submission_ids = order_queue.submission_ids()
+    # submissions the worker has not finished yet hold the watermark back, in case it gives up on them
+    in_flight_ids = order_queue.submission_ids((QUEUED, PROCESSING)) & set(pulled_submissions['submission_id'])
+    total_form_info_df = total_form_info_df[~total_form_info_df['submission_id'].isin(queued_submission_ids)]
+    logger.info(f'{len(pulled_submissions) - len(total_form_info_df)} submissions are handled by the webhook queue.')
+
+    new_orders = total_form_info_df
+    created_submission_ids = set()
+    if len(total_form_info_df) > 0:
+        order_task = asyncio.ensure_future(run_blocking(get_recent_order_df, limit=10000))
+        variant_task = asyncio.ensure_future(run_blocking(get_latest_product_variant_info, shopify_helper.shop_env))
+        try:
+            new_orders = find_new_orders(clean_form_orders(total_form_info_df), await order_task)
+            if len(new_orders) > 0:
+                logger.info(f'Found {len(new_orders)} orders to create.')
+                fuzzy_matched_df = match_order_variants(new_orders, await variant_task)
+                shopify_order_created = await create_shopify_orders_async(shopify_helper, fuzzy_matched_df)
+                created_submission_ids = set(shopify_order_created.query('order_name!=""')['submission_id'])
+                await report_created_orders_async(shopify_order_created)
+        finally:
+            # nothing awaits the variants when every submission is already ordered
+            variant_task.cancel()
+    if len(new_orders) == 0:
+        logger.info('No new Jotform orders found.')
 
+    pending_ids = set(new_orders['submission_id']) - created_submission_ids
+    if pending_ids:
+        logger.warning(f'{len(pending_ids)} submissions have no order yet, they are pulled again on the next run.')
+    if in_flight_ids:
+        logger.info(
+            f'{len(in_flight_ids)} submissions are still in the webhook queue, they are pulled again on the next run.'
+        )
+    pending_ids |= in_flight_ids
+    watermark_state.put(advance_submission_watermarks(watermarks, pulled_submissions, pending_ids))
 
 
 if __name__ == "__main__":
-    jotform2shopify()
\ No newline at end of file
+    jotform2shopify()
@@ -0,0 +1,266 @@
+import email.parser
+import email.policy
+import hmac
+import json
+import logging
+import threading
+import urllib.parse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import pandas as pd
+import requests
+
+from jdx_dsb_shopify.globals import JOTFORM_SECRET_NAME, PLATFORM_DB_SECRET_NAME, SHOPIFY_SECRET_NAME, \
+    SNOWFLAKE_SECRET_NAME
+from jdx_dsb_shopify.scripts.jotform_integration import JOTFORM_COLS, JOTFORM_FORM_IDS, JOTFORM_FORM_STATUSES, \
+    clean_form_orders, create_shopify_orders, find_new_orders, match_order_variants, parse_form_info, \
+    report_created_orders, submissions_to_form_info
+from jdx_dsb_shopify.util.jotform_utils import JotformAPIClient
+from jdx_dsb_shopify.util.logging import setup_logging_env
+from jdx_dsb_shopify.util.order_queue import OrderQueue
+from jdx_dsb_shopify.util.retry_utils import NON_IDEMPOTENT_RETRY_STATUSES
+from jdx_dsb_shopify.util.secret_utils import get_secret, prefetch_secrets
+from jdx_dsb_shopify.util.shopify_utils import ShopifyHelper
+from jdx_dsb_shopify.util.snowflake_utils import set_query_tag
+
+logger = logging.getLogger(__name__)
+
+FORM_KEYS = {str(form_id): k for k, form_id in JOTFORM_FORM_IDS.items()}
+# webhook fields kept with the queued submission for auditing
+WEBHOOK_FIELDS = ('formID', 'submissionID', 'rawRequest')
+
+
+def get_webhook_token():
+    """Shared token Jotform has to send as ?token=, webhooks are accepted without one if unset."""
+    return get_secret(JOTFORM_SECRET_NAME).get('WEBHOOK_TOKEN')
+
+
+def parse_webhook_fields(content_type: str, body: bytes) -> dict:
+    """
+    Fields of a Jotform webhook post, sent as multipart/form-data.
+    """
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+        fields = dict()
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name:
+                fields[name] = part.get_content()
+        return fields
+    return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+
+class JotformWebhookHandler(BaseHTTPRequestHandler):
+    """
+    Queues the submission of every webhook post and answers right away, orders are
+    created by the worker. GET returns the queue counts as a health check.
+    """
+    def _respond(self, status: HTTPStatus, body: dict):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond(HTTPStatus.OK, self.server.order_queue.counts())
+
+    def do_POST(self):
+        token = self.server.token
+        if token:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            if not hmac.compare_digest(query.get('token', [''])[0], token):
+                self._respond(HTTPStatus.FORBIDDEN, {'error': 'invalid token'})
+                return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        fields = parse_webhook_fields(self.headers.get('Content-Type', ''), body)
+        submission_id = fields.get('submissionID')
+        if not submission_id:
+            self._respond(HTTPStatus.BAD_REQUEST, {'error': 'missing submissionID'})
+            return
+        form = FORM_KEYS.get(fields.get('formID'))
+        if form is None:
+            # answer 200 so Jotform does not redeliver posts of forms we do not order from
+            logger.warning(f'Ignoring submission {submission_id} of unknown form {fields.get("formID")}')
+            self._respond(HTTPStatus.OK, {'status': 'ignored'})
+            return
+
+        queued = self.server.order_queue.enqueue(
+            submission_id, form, {k: fields[k] for k in WEBHOOK_FIELDS if k in fields}
+        )
+        logger.info(f'{"Queued" if queued else "Already queued"} {form} submission {submission_id}')
+        self._respond(HTTPStatus.OK, {'status': 'queued' if queued else 'duplicate'})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def process_batch(order_queue: OrderQueue, jotform_client: JotformAPIClient, shopify_helper: ShopifyHelper, batch):
+    """
+    Create the Shopify orders of a micro-batch of queued submissions, going through the
+    same parsing, lab portal check and variant matching as jotform2shopify.
+
+    Args:
+        batch: (submission_id, form) claimed from the queue
+    """
+    submissions = dict()
+    for submission_id, form in batch:
+        try:
+            submission = jotform_client.get_submission(submission_id)
+        except requests.RequestException as e:
+            order_queue.mark_failed(submission_id, f'Could not fetch submission: {e}')
+            continue
+        if str(submission.get('form_id')) != str(JOTFORM_FORM_IDS[form]):
+            # the form of the post is not trusted, reconciliation pulls the submission from its real form if ordered
+            order_queue.mark_failed(
+                submission_id, f'submission belongs to form {submission.get("form_id")}, not {form}', retry=False
+            )
+            continue
+        if submission.get('status') not in JOTFORM_FORM_STATUSES:
+            order_queue.mark_done(submission_id, note=f'submission is {submission.get("status")}')
+            continue
+        submissions.setdefault(form, list()).append(submission)
+    if not submissions:
+        return
+
+    form_infos = [
+        parse_form_info(submissions_to_form_info(form_submissions, JOTFORM_COLS), form)
+        for form, form_submissions in submissions.items()
+    ]
+    orders = clean_form_orders(pd.concat(form_infos, ignore_index=True))
+    new_orders = find_new_orders(orders) if len(orders) > 0 else orders
+    for submission_id in {s['id'] for subs in submissions.values() for s in subs} - set(new_orders['submission_id']):
+        order_queue.mark_done(submission_id, note='test order, already in the lab portal or past the lookback')
+    if len(new_orders) == 0:
+        return
+
+    fuzzy_matched_df = match_order_variants(new_orders)
+    for submission_id in set(new_orders['submission_id']) - set(fuzzy_matched_df['submission_id']):
+        # the variant may only exist after the next manage_b2b_products run, leave it to the reconciliation
+        order_queue.mark_failed(submission_id, 'no variant matched the imaging center', retry=False)
+    if len(fuzzy_matched_df) == 0:
+        return
+
+    try:
+        shopify_order_created = create_shopify_orders(shopify_helper, fuzzy_matched_df)
+    except Exception:
+        # some orders may have been created, requeueing them could duplicate them
+        for submission_id in fuzzy_matched_df['submission_id']:
+            order_queue.mark_failed(submission_id, 'Shopify order creation failed, see the service logs', retry=False)
+        raise
+    for submission_id, order_name, status in shopify_order_created[
+        ['submission_id', 'order_name', 'response_status']
+    ].itertuples(index=False):
+        if order_name:
+            order_queue.mark_done(submission_id, order_name=order_name)
+        elif status in NON_IDEMPOTENT_RETRY_STATUSES:
+            # Shopify did not process the order, it is safe to create it again
+            order_queue.mark_failed(submission_id, f'Shopify order creation returned {status}')
+        else:
+            # the order may exist in Shopify (e.g. a timeout after it was sent), requeueing it could
+            # duplicate it, the reconciliation run only orders submissions missing from the lab portal
+            order_queue.mark_failed(
+                submission_id, f'Shopify order creation failed with {status or "no response"}', retry=False
+            )
+
+    shopify_order_created = shopify_order_created.query('order_name!=""')
+    if len(shopify_order_created) > 0:
+        report_created_orders(shopify_order_created)
+
+
+def run_worker(order_queue: OrderQueue, stop: threading.Event, batch_size: int = 20, interval: float = 5.0):
+    """
+    Drain the queue in micro-batches of up to batch_size submissions until stop is set.
+    """
+    jotform_client = JotformAPIClient(get_secret(JOTFORM_SECRET_NAME)['API_KEY'])
+    shopify_helper = ShopifyHelper(SHOPIFY_SECRET_NAME)
+    order_queue.requeue_stale()
+    try:
+        while not stop.is_set():
+            batch = order_queue.claim(batch_size)
+            if not batch:
+                stop.wait(interval)
+                continue
+            logger.info(f'Processing {len(batch)} queued submissions')
+            try:
+                process_batch(order_queue, jotform_client, shopify_helper, batch)
+            except Exception:
+                logger.exception('Failed to process batch, requeueing it')
+                for submission_id, _ in batch:
+                    order_queue.mark_failed(submission_id, 'batch failed, see the service logs')
+    finally:
+        jotform_client.close()
+        shopify_helper.close()
+
+
+@click.group()
+def jotform_webhook():
+    """Receive Jotform submissions by webhook and turn them into Shopify orders."""
+
+
+@jotform_webhook.command('serve', help='Receive webhooks and create the queued orders in micro-batches.')
+@click.option("--host", default='0.0.0.0', help="interface to listen on")
+@click.option("--port", default=8081, help="port to listen on")
+@click.option("--batch_size", default=20, help="maximum submissions per micro-batch")
+@click.option("--interval", default=5.0, help="seconds between polls of an empty queue")
+@click.option("--insecure", is_flag=True, help="accept unauthenticated webhooks when there is no WEBHOOK_TOKEN")
+@setup_logging_env
+def serve(
+        host: str = '0.0.0.0',
+        port: int = 8081,
+        batch_size: int = 20,
+        interval: float = 5.0,
+        insecure: bool = False,
+):
+    token = get_webhook_token()
+    if not token and not insecure:
+        raise click.ClickException('No WEBHOOK_TOKEN in the Jotform secret, pass --insecure to serve without one')
+    prefetch_secrets([SHOPIFY_SECRET_NAME, SNOWFLAKE_SECRET_NAME, JOTFORM_SECRET_NAME, PLATFORM_DB_SECRET_NAME])
+    set_query_tag('jdx_dsb_shopify.jotform_webhook')
+    order_queue = OrderQueue()
+
+    server = ThreadingHTTPServer((host, port), JotformWebhookHandler)
+    server.order_queue = order_queue
+    server.token = token
+    if not server.token:
+        logger.warning('No WEBHOOK_TOKEN in the Jotform secret, accepting unauthenticated webhooks')
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    logger.info(f'Listening for Jotform webhooks on {host}:{port}')
+
+    stop = threading.Event()
+    try:
+        run_worker(order_queue, stop, batch_size=batch_size, interval=interval)
+    except KeyboardInterrupt:
+        logger.info('Shutting down')
+    finally:
+        stop.set()
+        server.shutdown()
+        server.server_close()
+
+
+@jotform_webhook.command('register', help='Register the webhook service on the birch and hazel forms.')
+@click.option("--url", required=True, help="public URL of the webhook service")
+@setup_logging_env
+def register(url: str):
+    token = get_webhook_token()
+    if token:
+        url = f'{url}{"&" if "?" in url else "?"}token={token}'
+    jotform_client = JotformAPIClient(get_secret(JOTFORM_SECRET_NAME)['API_KEY'])
+    for form, form_id in JOTFORM_FORM_IDS.items():
+        webhooks = jotform_client.get_form_webhooks(str(form_id)) or dict()
+        if url in (webhooks.values() if isinstance(webhooks, dict) else webhooks):
+            logger.info(f'The webhook is already registered on the {form} form')
+            continue
+        jotform_client.create_form_webhook(str(form_id), url)
+        logger.info(f'Registered the webhook on the {form} form')
+
+
+if __name__ == "__main__":
+    jotform_webhook()
@@ -1,50 +1,90 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import click
 import pandas as pd
-import snowflake
-from jdx_utils.api.secrets import get_secret_from_sm
 from jdx_utils.util import log_start_stop, log_runtime
-from snowflake.snowpark import Session
 
-from jdx_dsb_shopify.globals import SNOWFLAKE_SECRET_NAME, SNOWFLAKE_WH, SHOPIFY_SECRET_NAME
+from jdx_dsb_shopify.globals import SNOWFLAKE_SECRET_NAME, SHOPIFY_SECRET_NAME
+from jdx_dsb_shopify.util.bulk_load import SnowflakeStageLoader
+from jdx_dsb_shopify.util.cache import JsonState
 from jdx_dsb_shopify.util.logging import setup_logging_env
-from jdx_dsb_shopify.util.shopify_utils import ShopifyHelper
+from jdx_dsb_shopify.util.secret_utils import get_secret, prefetch_secrets
+from jdx_dsb_shopify.util.shopify_utils import ShopifyHelper, assign_variant_shards, get_product_shard
+from jdx_dsb_shopify.util.snowflake_utils import SNOWFLAKE_DATABASE, SNOWFLAKE_SCHEMA, fetch_pandas, \
+    set_query_tag, snowflake_session
 
 logger = logging.getLogger(__name__)
 
+SHOPIFY_B2B_PRODUCTS_KEYS = ('ENV', 'PRODUCT_SHORT_NAME', 'ID')
+# latest PRICE update synced per shop and product type, also moves when the prices left every variant unchanged
+PRICE_WATERMARKS = 'b2b_price_watermarks'
+
+PRICE_DTYPES = {
+    'account_id': 'object',
+    'account_name': 'object',
+    'product_short_name': 'object',
+    'price': 'float64',
+    'update_ts': 'object',
+}
+
+LAST_VARIANT_UPDATE_DTYPES = {
+    'product_short_name': 'object',
+    'last_modified': 'datetime64[ns]',
+}
+
 @log_start_stop
 def get_last_variant_update(shop_env):
-    snowflake_secrets = get_secret_from_sm(SNOWFLAKE_SECRET_NAME)
-    connection_parameters = {
-        "account": snowflake_secrets['SNOWFLAKE_ACCOUNT'],
-        "user": snowflake_secrets['SNOWFLAKE_USER'],
-        "password": snowflake_secrets['SNOWFLAKE_PASSWORD'],
-        "warehouse": 'COMPUTE_WH',
-        "database": 'JDX_PLATFORM',
-        "schema": 'ANALYTICS',
-    }
+    """
+    Returns:
+        dict: product_short_name -> time its Shopify B2B products were last written to Snowflake
+    """
+    from snowflake.snowpark.exceptions import SnowparkSQLException
 
-    session = Session.builder.configs(connection_parameters).create()
     query = f'''
-        SELECT UPDATE_TS AS LAST_MODIFIED
+        SELECT PRODUCT_SHORT_NAME, MAX(UPDATE_TS) AS LAST_MODIFIED
         FROM JDX_PLATFORM.ANALYTICS.SHOPIFY_B2B_PRODUCTS
         WHERE ENV = '{shop_env}'
-        ORDER BY UPDATE_TS DESC
-        LIMIT 1
+        GROUP BY PRODUCT_SHORT_NAME
     '''
 
     try:
-        data = session.sql(query).collect()
-        if len(data)>0:
-            df = session.create_dataframe(data).to_pandas()
-            last_modified_time = datetime.strptime(df['LAST_MODIFIED'][0], '%Y-%m-%d %H:%M:%S.%f')
-            logger.info(f'Shopify B2B products were last modified at {last_modified_time}')
-        else:
-            last_modified_time = -1
-    except snowflake.snowpark.exceptions.SnowparkSQLException:
-        last_modified_time = -1
-    return last_modified_time
+        df = fetch_pandas(query, dtypes=LAST_VARIANT_UPDATE_DTYPES)
+    except SnowparkSQLException:
+        return dict()
+
+    last_modified_times = dict(zip(df['product_short_name'], df['last_modified']))
+    for product_short_name, last_modified_time in last_modified_times.items():
+        logger.info(f'Shopify B2B {product_short_name} products were last modified at {last_modified_time}')
+    return last_modified_times
+
+
+def get_price_watermarks(shop_env) -> dict:
+    """
+    Returns:
+        dict: product_short_name -> latest PRICE update already synced to Shopify
+    """
+    watermarks = JsonState(PRICE_WATERMARKS).get().get(shop_env, dict())
+    return {product_short_name: pd.Timestamp(ts) for product_short_name, ts in watermarks.items()}
+
+
+def put_price_watermarks(shop_env, price_watermarks: dict):
+    state = JsonState(PRICE_WATERMARKS)
+    watermarks = state.get()
+    watermarks.setdefault(shop_env, dict()).update({
+        product_short_name: ts.isoformat() for product_short_name, ts in price_watermarks.items()
+    })
+    state.put(watermarks)
+
+
+def get_last_price_update(price_df: pd.DataFrame):
+    """
+    Returns:
+        dict: product_short_name -> time of its latest PRICE update
+    """
+    last_price_updates = pd.to_datetime(price_df['update_ts']).groupby(price_df['product_short_name']).max()
+    return last_price_updates.to_dict()
 
 
 @log_start_stop
@@ -52,135 +92,315 @@ def update_snowflake_shopify_b2b_products(
         df,
         product_short_name: str,
         dst_table_name: str = 'SHOPIFY_B2B_PRODUCTS',
-        mode: str = 'append',
+        mode: str = 'merge',
 ):
-    df = df.copy()
-    snowflake_secrets = get_secret_from_sm(SNOWFLAKE_SECRET_NAME)
-    connection_parameters = {
-        "account": snowflake_secrets['SNOWFLAKE_ACCOUNT'],
-        "user": snowflake_secrets['SNOWFLAKE_USER'],
-        "password": snowflake_secrets['SNOWFLAKE_PASSWORD'],
-        "warehouse": SNOWFLAKE_WH,
-        "database": 'JDX_PLATFORM',
-        "schema": 'ANALYTICS'
-    }
+    """
+    Bulk load Shopify variants into Snowflake through a staged Parquet file.
 
-    session = Session.builder.configs(connection_parameters).create()
-    full_dst_table_name = f"{connection_parameters['database']}.{connection_parameters['schema']}.{dst_table_name}"
+    Args:
+        df: variants as returned by the Shopify REST API
+        product_short_name: birch, hazel_basic or hazel_plus
+        dst_table_name: destination table
+        mode: 'append' adds a new copy of every variant, 'merge' upserts on (ENV, PRODUCT_SHORT_NAME, ID)
+    """
+    df = df.copy()
+    full_dst_table_name = f"{SNOWFLAKE_DATABASE}.{SNOWFLAKE_SCHEMA}.{dst_table_name}"
     logger.info(f"Updating {full_dst_table_name} with {mode} mode...")
     df['update_ts'] = str(datetime.now())
-    df['env']=get_secret_from_sm(SHOPIFY_SECRET_NAME)['SHOP_ENV']
+    df['env']=get_secret(SHOPIFY_SECRET_NAME)['SHOP_ENV']
     df['product_short_name'] = product_short_name
     df.columns = [c.upper() for c in df.columns]
-    sf_df = session.create_dataframe(df)
-    sf_df.write.save_as_table(dst_table_name, mode=mode)
-    session.close()
+    with snowflake_session() as session:
+        SnowflakeStageLoader(session).load(
+            df,
+            dst_table_name,
+            mode=mode,
+            merge_keys=SHOPIFY_B2B_PRODUCTS_KEYS,
+        )
 
 
 def get_latest_prices():
-    snowflake_secrets = get_secret_from_sm(SNOWFLAKE_SECRET_NAME)
-    connection_parameters = {
-        "account": snowflake_secrets['SNOWFLAKE_ACCOUNT'],
-        "user": snowflake_secrets['SNOWFLAKE_USER'],
-        "password": snowflake_secrets['SNOWFLAKE_PASSWORD'],
-        "warehouse": SNOWFLAKE_WH,
-        "database": 'JDX_PLATFORM',
-        "schema": 'ANALYTICS',
-    }
-    session = Session.builder.configs(connection_parameters).create()
+    # PRICE is append-only, keep the latest price of every account and product type
     query = f'''
-            SELECT *
+            SELECT ACCOUNT_ID, ACCOUNT_NAME, PRODUCT_SHORT_NAME, PRICE, UPDATE_TS
             FROM JDX_PLATFORM.ANALYTICS.PRICE
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY ACCOUNT_ID, PRODUCT_SHORT_NAME
+                ORDER BY UPDATE_TS DESC
+            ) = 1
+            ORDER BY UPDATE_TS DESC
         '''
-    df = session.create_dataframe(session.sql(query).collect()).to_pandas()
-    df = df.sort_values('UPDATE_TS', ascending=False).groupby(['ACCOUNT_ID', 'PRODUCT_SHORT_NAME']).head(1)
-    df.columns = [c.lower() for c in df.columns]
-    return df
+    return fetch_pandas(query, dtypes=PRICE_DTYPES)
+
+def _variant_account_id(variant_info):
+    return str(variant_info['option1']).split('|')[0].strip()
+
+
+def diff_product_variants(live_variants: list, desired_variants: list):
+    """
+    Compare the live variants of a B2B product with the variants built from the latest prices.
+    Variants are matched on the account id in option1.
+
+    Returns:
+        tuple: variants to update (with their live id), variants to create and variant ids to delete
+    """
+    live_by_account = {_variant_account_id(v): v for v in live_variants}
+    desired_accounts = set()
+    to_update, to_create = list(), list()
+    for variant_info in desired_variants:
+        account_id = _variant_account_id(variant_info)
+        desired_accounts.add(account_id)
+        live_variant = live_by_account.get(account_id)
+        if live_variant is None:
+            to_create.append(variant_info)
+        elif (
+                round(float(live_variant['price']), 2) != round(float(variant_info['price']), 2)
+                or live_variant['option1'] != variant_info['option1']
+        ):
+            to_update.append({
+                'id': live_variant['id'],
+                'option1': variant_info['option1'],
+                'price': variant_info['price'],
+            })
+
+    to_delete = [v['id'] for account_id, v in live_by_account.items() if account_id not in desired_accounts]
+    return to_update, to_create, to_delete
+
+
+def apply_product_variant_diff(
+        b2b_product: dict,
+        variant_df: pd.DataFrame,
+        product_short_name: str,
+        shopify_helper: ShopifyHelper,
+):
+    desired_variants = shopify_helper.create_b2b_product_variants(variant_df, product_short_name=product_short_name)
+    to_update, to_create, to_delete = diff_product_variants(b2b_product['variants'], desired_variants)
+    logger.info(
+        f'{product_short_name}: {len(to_update)} variants to update, {len(to_create)} to add, '
+        f'{len(to_delete)} to remove.'
+    )
+    if not (to_update or to_create or to_delete):
+        return None
+
+    responses = (
+        shopify_helper.update_variants(to_update)
+        + shopify_helper.delete_variants(b2b_product['id'], to_delete)
+        + shopify_helper.create_variants(b2b_product['id'], to_create)
+    )
+    failed = [r for r in responses if r is None or not r.ok]
+    if failed:
+        raise RuntimeError(f'{len(failed)} variant writes failed for product {b2b_product["id"]}.')
+
+    response = shopify_helper.get_product(b2b_product['id'])
+    response.raise_for_status()
+    return response
+
+
+B2B_PRODUCT_SHORT_NAMES = ('birch', 'hazel_basic', 'hazel_plus')
+
+
+@log_start_stop
+def get_b2b_catalog(shopify_helper: ShopifyHelper):
+    """
+    Snapshot the B2B products of every product type with a single catalog scan.
+
+    Returns:
+        dict: product_short_name -> list of B2B products (id, tags, product_type and variants)
+    """
+    catalog = {product_short_name: list() for product_short_name in B2B_PRODUCT_SHORT_NAMES}
+    for product_info in shopify_helper.iter_products(fields=['id', 'tags', 'product_type', 'variants']):
+        if 'b2b' in product_info['tags'] and product_info['product_type'] in catalog:
+            catalog[product_info['product_type']].append(product_info)
+    return catalog
+
 
 def update_product_pricing(
         price_df: pd.DataFrame,
         product_short_name: str,
         shopify_helper: ShopifyHelper,
+        mode: str = 'diff',
+        b2b_products: list = None,
 ):
-    if product_short_name not in ('birch', 'hazel_basic', 'hazel_plus'):
+    """
+    Sync the B2B products of a product type with the latest prices. Accounts are sharded over
+    as many products as needed to stay within Shopify's variants per product limit.
+
+    Args:
+        price_df: latest price per account and product type
+        product_short_name: birch, hazel_basic or hazel_plus
+        shopify_helper: Shopify client
+        mode: 'diff' only writes the variants whose price or account changed,
+            'recreate' creates a new product with every variant and deletes the old one
+        b2b_products: B2B products of this product type from a catalog snapshot,
+            fetched from Shopify when not given
+
+    Returns:
+        list: product responses of the shards that were written
+    """
+    if product_short_name not in B2B_PRODUCT_SHORT_NAMES:
         raise ValueError(f'Unknown product short names: {product_short_name}')
+    if mode not in ('diff', 'recreate'):
+        raise ValueError(f'Unknown update mode: {mode}')
 
     # get b2b products
-    r = shopify_helper.get_products()
-    b2b_product = [
-        product_info for product_info in r.json()['products']
-        if 'b2b' in product_info['tags'] and product_info['product_type'] == product_short_name
-    ]
-    variant_df = price_df.query(f'product_short_name=="{product_short_name}"')
-    if len(variant_df) >0:
-        logger.info(f'{variant_df} variants to update price.')
-
-        if len(b2b_product)>1:
+    if b2b_products is None:
+        b2b_products = [
+            product_info for product_info in shopify_helper.iter_products(
+                product_type=product_short_name,
+                fields=['id', 'tags', 'product_type', 'variants'],
+            )
+            if 'b2b' in product_info['tags'] and product_info['product_type'] == product_short_name
+        ]
+    variant_df = price_df.query(f'product_short_name=="{product_short_name}"').copy()
+    if len(variant_df) == 0:
+        logger.info('No product variants to update.')
+        return None
+
+    logger.info(f'{variant_df} variants to update price.')
+    b2b_product_shards = dict()
+    for product_info in b2b_products:
+        shard = get_product_shard(product_info)
+        if shard in b2b_product_shards:
             raise ValueError(
-                'Found duplicate B2B products for the same product type.  '
-                'There should only be one for each product_type.'
+                'Found duplicate B2B products for the same product type and shard.  '
+                'There should only be one for each product_type shard.'
+            )
+        b2b_product_shards[shard] = product_info
+
+    current_shards = {
+        _variant_account_id(v): shard
+        for shard, product_info in b2b_product_shards.items() for v in product_info['variants']
+    }
+    shard_map = assign_variant_shards(variant_df['account_id'].tolist(), current_shards=current_shards)
+    variant_df['shard'] = variant_df['account_id'].astype(str).map(shard_map)
+    n_shards = variant_df['shard'].max() + 1
+    logger.info(f'{product_short_name}: {len(variant_df)} accounts over {n_shards} products.')
+
+    responses = list()
+    for shard in range(n_shards):
+        shard_variant_df = variant_df.query(f'shard=={shard}')
+        b2b_product = b2b_product_shards.get(shard)
+        if b2b_product is not None and mode == 'diff': # update the changed variants in place
+            response = apply_product_variant_diff(
+                b2b_product=b2b_product,
+                variant_df=shard_variant_df,
+                product_short_name=product_short_name,
+                shopify_helper=shopify_helper,
             )
-        elif len(b2b_product)==1: # create a new product and delete the old product
+            if response is None:
+                logger.info(f'{product_short_name} shard {shard} variants are already up to date.')
+                continue
+        else: # create the product, replacing the old one in recreate mode
             response = shopify_helper.create_b2b_products(
-                variant_df=variant_df,
+                variant_df=shard_variant_df,
                 status='active',
                 product_short_name=product_short_name,
+                shard=shard,
             )
-            logger.debug(response)
-            shopify_helper.delete_product(b2b_product[0]['id'])
-            update_snowflake_shopify_b2b_products(pd.DataFrame(response.json()['product']['variants']),
-                                                  product_short_name=product_short_name)
-            return response
+            response.raise_for_status()
+            if b2b_product is not None:
+                shopify_helper.delete_product(b2b_product['id'])
+        logger.debug(response)
+        update_snowflake_shopify_b2b_products(pd.DataFrame(response.json()['product']['variants']),
+                                              product_short_name=product_short_name,
+                                              mode='merge')
+        responses.append(response)
+
+    # the account set shrank, drop shards that are no longer used
+    for shard, b2b_product in b2b_product_shards.items():
+        if shard >= n_shards:
+            logger.info(f'Deleting unused {product_short_name} product shard {shard}.')
+            shopify_helper.delete_product(b2b_product['id'])
+
+    return responses
 
-        else: # create product
-            response = shopify_helper.create_b2b_products(
-                variant_df=variant_df,
-                status = 'active',
-                product_short_name = product_short_name,
-            )
-            logger.debug(response)
-            update_snowflake_shopify_b2b_products(pd.DataFrame(response.json()['product']['variants']),
-                                                  product_short_name=product_short_name)
-            return response
-    else:
-        logger.info('No product variants to update.')
 
+@log_start_stop
+def rebuild_shopify_b2b_products(shopify_helper: ShopifyHelper):
+    """
+    Rewrite SHOPIFY_B2B_PRODUCTS from the live B2B variants, exported with a single
+    GraphQL bulk operation instead of paging through the products.
+    """
+    variants = shopify_helper.bulk_export_variants()
+    variants = variants[variants['product_tags'].map(lambda tags: 'b2b' in tags)]
+    for product_short_name in B2B_PRODUCT_SHORT_NAMES:
+        product_variants = variants[variants['product_type'] == product_short_name]
+        logger.info(f'Rebuilding {len(product_variants)} {product_short_name} B2B variants.')
+        update_snowflake_shopify_b2b_products(
+            product_variants.drop(columns=['product_type', 'product_tags']),
+            product_short_name=product_short_name,
+            mode='merge',
+        )
 
 
+@click.command()
+@click.option("--rebuild", is_flag=True, help="rewrite SHOPIFY_B2B_PRODUCTS from a bulk export of the live variants")
 @log_start_stop
 @log_runtime
 @setup_logging_env
-def main():
+def main(rebuild: bool = False):
+    prefetch_secrets([SNOWFLAKE_SECRET_NAME, SHOPIFY_SECRET_NAME])
+    set_query_tag('jdx_dsb_shopify.manage_b2b_products')
+    if rebuild:
+        rebuild_shopify_b2b_products(ShopifyHelper(SHOPIFY_SECRET_NAME))
+        return
+
     # get latest price information from Snowflake
     price_df = get_latest_prices()
-    last_price_update = datetime.strptime(price_df['update_ts'].to_list()[0], '%Y-%m-%d %H:%M:%S.%f')
+    last_price_updates = get_last_price_update(price_df)
     shopify_helper = ShopifyHelper(SHOPIFY_SECRET_NAME)
-    last_variant_update = get_last_variant_update(shopify_helper.shop_env)
-
-    if last_variant_update==-1 or last_price_update>last_variant_update:  # there is a price update
-        # Update FST B2B product
-        logger.info('UPDATE: FST B2B Product')
-        update_product_pricing(
-            price_df=price_df,
-            product_short_name='birch',
-            shopify_helper=shopify_helper
-        )
+    last_variant_updates = get_last_variant_update(shopify_helper.shop_env)
+    price_watermarks = get_price_watermarks(shopify_helper.shop_env)
 
-        logger.info('UPDATE: NIPS-BASIC B2B Product')
-        update_product_pricing(
-            price_df=price_df,
-            product_short_name='hazel_basic',
-            shopify_helper=shopify_helper
+    # only touch the product types whose prices changed since their products were last written or found up to date
+    product_short_names = list()
+    for product_short_name in B2B_PRODUCT_SHORT_NAMES:
+        last_price_update = last_price_updates.get(product_short_name)
+        last_variant_update = max(
+            (ts for ts in (last_variant_updates.get(product_short_name), price_watermarks.get(product_short_name))
+             if ts is not None),
+            default=None,
         )
+        if last_price_update is None:
+            logger.info(f'No prices found for {product_short_name}.')
+        elif last_variant_update is None or last_price_update > last_variant_update:  # there is a price update
+            product_short_names.append(product_short_name)
+        else:
+            logger.info(f'No new price found for {product_short_name}.')
 
-        logger.info('UPDATE: NIPS-Hazel B2B Product')
-        update_product_pricing(
-            price_df=price_df,
-            product_short_name='hazel_plus',
-            shopify_helper=shopify_helper
-        )
-    else:
-        logger.info('No new price found.')
+    if len(product_short_names) == 0:
+        return
+
+    # one catalog snapshot for the run, then update the product types independently
+    catalog = get_b2b_catalog(shopify_helper)
+    failures = dict()
+    synced = dict()
+    with ThreadPoolExecutor(max_workers=len(product_short_names)) as executor:
+        futures = dict()
+        for product_short_name in product_short_names:
+            logger.info(f'UPDATE: {product_short_name} B2B Product')
+            future = executor.submit(
+                update_product_pricing,
+                price_df=price_df,
+                product_short_name=product_short_name,
+                shopify_helper=shopify_helper,
+                b2b_products=catalog[product_short_name],
+            )
+            futures[future] = product_short_name
+
+        for future in as_completed(futures):
+            product_short_name = futures[future]
+            try:
+                future.result()
+                synced[product_short_name] = last_price_updates[product_short_name]
+                logger.info(f'Updated {product_short_name} B2B Product')
+            except Exception as e:
+                logger.exception(f'Failed to update {product_short_name} B2B Product')
+                failures[product_short_name] = e
+
+    put_price_watermarks(shopify_helper.shop_env, synced)
+    if failures:
+        raise RuntimeError(f'B2B product updates failed for: {", ".join(failures)}')
 
 
 
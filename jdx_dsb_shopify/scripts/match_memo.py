@@ -0,0 +1,64 @@
+import logging
+
+import click
+import pandas as pd
+
+from jdx_dsb_shopify.globals import SHOPIFY_SECRET_NAME
+from jdx_dsb_shopify.scripts.jotform_integration import ACCOUNT_NAME_MEMO, get_latest_product_variant_info
+from jdx_dsb_shopify.util.logging import setup_logging
+from jdx_dsb_shopify.util.match_memo import MatchMemo, normalize_key
+from jdx_dsb_shopify.util.secret_utils import get_secret
+
+logger = logging.getLogger(__name__)
+
+
+@click.group()
+@click.option("--name", default=ACCOUNT_NAME_MEMO, help="memo to inspect")
+@click.pass_context
+def match_memo(ctx, name: str):
+    """Inspect the fuzzy match memo and pin matches by hand."""
+    setup_logging()
+    ctx.obj = MatchMemo(name)
+
+
+@match_memo.command('list')
+@click.option("--block", default=None, help="only show this block, e.g. a product_short_name")
+@click.option("--pinned", is_flag=True, help="only show pinned matches")
+@click.option("--key", default=None, help="only show keys containing this text")
+@click.pass_obj
+def list_matches(memo: MatchMemo, block: str = None, pinned: bool = False, key: str = None):
+    df = memo.to_frame(block=block, pinned_only=pinned)
+    if key is not None:
+        df = df[df['key'].str.contains(normalize_key(key), regex=False)]
+    with pd.option_context('display.max_rows', None, 'display.width', None, 'display.max_colwidth', 60):
+        click.echo(df.to_string(index=False) if len(df) > 0 else 'No matches.')
+
+
+@match_memo.command('pin')
+@click.argument("block")
+@click.argument("key")
+@click.argument("matched")
+@click.pass_obj
+def pin_match(memo: MatchMemo, block: str, key: str, matched: str):
+    """Always match KEY to the variant account MATCHED within BLOCK, e.g. pin hazel_plus "St Marys Imaging" "ST. MARY'S IMAGING CENTER"."""
+    variant_df = get_latest_product_variant_info(get_secret(SHOPIFY_SECRET_NAME)['SHOP_ENV'])
+    candidates = variant_df.loc[variant_df['product_short_name'] == block, 'account_name']
+    try:
+        memo.pin(block, key, matched, candidates)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@match_memo.command('unpin')
+@click.argument("block")
+@click.argument("key")
+@click.pass_obj
+def unpin_match(memo: MatchMemo, block: str, key: str):
+    """Remove the pin of KEY within BLOCK, the key is scored again on the next run."""
+    if not memo.unpin(block, key):
+        raise click.ClickException(f'{key!r} is not pinned in {block}')
+    logger.info(f'Unpinned {key!r} in {block}')
+
+
+if __name__ == "__main__":
+    match_memo()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for the asyncio clients of Shopify, Jotform and Slack.
+
+AsyncShopifyHelper and AsyncJotformAPIClient mirror ShopifyHelper and JotformAPIClient
+on one aiohttp session each, so hundreds of calls can be in flight on a single event
+loop. Responses come back as requests.Response objects, callers handle them exactly
+like the responses of the sync clients.
+
+Only the order path is ported: reading Jotform submissions, creating and reading
+Shopify orders and posting to Slack, as used by jotform2shopify and amazon_fba_shopify.
+Product and variant management (manage_b2b_products) and the webhook worker stay on
+the sync clients. Both share the retry policy of retry_utils and the paging plan of
+SubmissionPager, so the order calls behave the same on either client.
+"""
+import asyncio
+import functools
+import json
+import logging
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from jdx_dsb_shopify.util.jotform_utils import SubmissionPager
+from jdx_dsb_shopify.util.retry_utils import LatencyRecorder, RetryPolicy
+from jdx_dsb_shopify.util.secret_utils import get_secret
+from jdx_dsb_shopify.util.shopify_utils import ShopifyCallLimiter
+
+logger = logging.getLogger(__name__)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call (Snowflake, Postgres, Google Sheets) on the default thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+def _to_response(method: str, url: str, status: int, headers, body: bytes) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r.headers = CaseInsensitiveDict(headers)
+    r._content = body
+    r.url = url
+    r.encoding = 'utf-8'
+    r.request = requests.Request(method, url).prepare()
+    return r
+
+
+class _AsyncClient:
+    """
+    aiohttp session with the retry policy and latency bookkeeping of the sync clients.
+    """
+    def __init__(
+            self,
+            headers: dict,
+            retry: RetryPolicy,
+            timeout: tuple = (5, 60),
+            max_in_flight: int = 50,
+    ):
+        self._headers = headers
+        self._retry = retry
+        self._timeout = timeout
+        self._max_in_flight = max_in_flight
+        self._session = None
+        self._latencies = LatencyRecorder()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                headers=self._headers,
+                timeout=aiohttp.ClientTimeout(sock_connect=self._timeout[0], sock_read=self._timeout[1]),
+                connector=aiohttp.TCPConnector(limit=self._max_in_flight),
+            )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _before_call(self):
+        pass
+
+    def _after_call(self, r: requests.Response):
+        pass
+
+    async def _request(self, method: str, url: str, metric: str = None, **kwargs) -> requests.Response:
+        """
+        Send a request, backing off on throttling (429) and server errors (5xx).
+        Connection errors and timeouts are raised as requests.RequestException.
+        """
+        import aiohttp
+
+        await self.open()
+        for attempt in self._retry.attempts:
+            await self._before_call()
+            start = time.perf_counter()
+            try:
+                async with self._session.request(method, url, **kwargs) as resp:
+                    body = await resp.read()
+                    r = _to_response(method, str(resp.url), resp.status, resp.headers, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise requests.ConnectionError(f'{self._retry.name} {method} {url} failed: {e!r}') from e
+            self._latencies.record(f'{method} {metric or url}', time.perf_counter() - start)
+            self._after_call(r)
+            delay = self._retry.retry_delay(method, url, r, attempt)
+            if delay is None:
+                return r
+            await asyncio.sleep(delay)
+
+    async def _gather(self, coros) -> list:
+        """
+        Await calls concurrently.
+
+        Returns:
+            list: results in input order, None where the call raised
+        """
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for i, result in enumerate(results):
+            if isinstance(result, requests.RequestException):
+                logger.error(f'{self._retry.name} call for batch item {i} failed: {result}')
+                results[i] = None
+            elif isinstance(result, BaseException):
+                raise result
+        return results
+
+    def latency_metrics(self):
+        """
+        Returns:
+            dict: 'METHOD endpoint' -> calls, total_s, mean_s, max_s
+        """
+        return self._latencies.metrics()
+
+
+class AsyncShopifyHelper(_AsyncClient):
+    """
+    asyncio counterpart of ShopifyHelper for order calls, paced by the same ShopifyCallLimiter.
+    """
+
+    def __init__(
+            self,
+            secret_name,
+            max_retries: int = 5,
+            backoff_factor: float = 1.0,
+            timeout: tuple = (5, 60),
+            max_in_flight: int = 40,
+    ):
+        shopify_secrets = get_secret(secret_name)
+        self._shop_env = shopify_secrets['SHOP_ENV']
+        self._order_endpoint = f'https://{self._shop_env}/admin/api/2023-04/orders.json'
+        self._limiter = ShopifyCallLimiter()
+        super().__init__(
+            headers={
+                'X-Shopify-Access-Token': shopify_secrets['SHOPIFY_TOKEN'],
+                'Content-Type': 'application/json',
+            },
+            retry=RetryPolicy('Shopify', max_retries, backoff_factor, limiter_waits=True),
+            timeout=timeout,
+            max_in_flight=max_in_flight,
+        )
+
+    @property
+    def shop_env(self):
+        return self._shop_env
+
+    @property
+    def limiter(self):
+        return self._limiter
+
+    async def _before_call(self):
+        wait = self._limiter.reserve()
+        if wait > 0:
+            logger.debug(f'Throttling Shopify call for {wait:.2f}s')
+            await asyncio.sleep(wait)
+
+    def _after_call(self, r: requests.Response):
+        self._limiter.update_from_response(r)
+
+    async def create_order(self, order_info):
+        return await self._request('POST', self._order_endpoint, metric='orders', data=json.dumps(order_info))
+
+    async def create_orders(self, order_infos: list):
+        logger.info(f'Creating {len(order_infos)} orders.')
+        return await self._gather([self.create_order(order_info) for order_info in order_infos])
+
+    async def get_orders(self, order_ids: list):
+        return await self._request(
+            'GET', self._order_endpoint, metric='orders', params={'ids': json.dumps(order_ids), 'status': 'any'}
+        )
+
+
+class AsyncJotformAPIClient(_AsyncClient):
+    """
+    asyncio counterpart of JotformAPIClient for reading forms and submissions.
+    """
+    DEFAULT_BASE_URL = 'https://junodx.jotform.com/'
+
+    def __init__(
+            self,
+            api_key=None,
+            base_url=DEFAULT_BASE_URL,
+            max_retries: int = 5,
+            backoff_factor: float = 1.0,
+            timeout: tuple = (5, 60),
+            max_in_flight: int = 10,
+            gzip: bool = True,
+    ):
+        self._base_url = base_url
+        headers = {
+            'User-Agent': 'JOTFORM_PYTHON_WRAPPER',
+            'Accept-Encoding': 'gzip, deflate' if gzip else 'identity',
+        }
+        if api_key:
+            headers['APIKEY'] = api_key
+        super().__init__(
+            headers=headers,
+            retry=RetryPolicy('Jotform', max_retries, backoff_factor),
+            timeout=timeout,
+            max_in_flight=max_in_flight,
+        )
+
+    async def _api_request(self, method, path, **kwargs):
+        url = self._base_url.rstrip('/') + '/API' + path
+        return await self._request(method, url, metric=path, **kwargs)
+
+    async def fetch_url(self, path, params=None):
+        r = await self._api_request('GET', path, params=params)
+        r.raise_for_status()
+        return r.json()['content']
+
+    async def get_form(self, form_id):
+        return await self.fetch_url(f'/form/{form_id}')
+
+    async def get_submission(self, sid):
+        return await self.fetch_url(f'/submission/{sid}')
+
+    async def get_form_submissions(self, form_id, offset=None, limit=None, filterArray=None, order_by=None):
+        args = {'offset': offset, 'limit': limit, 'filter': filterArray, 'orderby': order_by}
+        params = {k: json.dumps(v) if k == 'filter' else v for k, v in args.items() if v}
+        return await self._api_request('GET', f'/form/{form_id}/submissions', params=params)
+
+    async def get_form_submission_count(self, form_id):
+        return int((await self.get_form(form_id)).get('count', 0))
+
+    async def iter_form_submissions(self, form_id, page_size=1000, filterArray=None, order_by=None):
+        """
+        Async version of JotformAPIClient.iter_form_submissions, pages past the first
+        are requested at once and yielded as they arrive.
+        """
+        pager = SubmissionPager(page_size, concurrent=not filterArray)
+
+        async def fetch_page(offset):
+            r = await self.get_form_submissions(
+                form_id, offset=offset, limit=page_size, filterArray=filterArray, order_by=order_by
+            )
+            r.raise_for_status()
+            return r.json()['content']
+
+        async def fetch_concurrent_page(offset):
+            return offset, await fetch_page(offset)
+
+        yield pager.first_page(await fetch_page(None))
+        if pager.needs_count:
+            offsets = pager.concurrent_offsets(await self.get_form_submission_count(form_id))
+            for page in asyncio.as_completed([fetch_concurrent_page(offset) for offset in offsets]):
+                yield pager.concurrent_page(*(await page))
+        while not pager.done:
+            yield pager.next_page(await fetch_page(pager.next_offset))
+
+
+async def post_slack_message(channel: str, text: str, token: str = None):
+    """
+    Post a message with slack_sdk's AsyncWebClient, errors are logged and not raised.
+    """
+    from slack_sdk.errors import SlackApiError
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    from jdx_dsb_shopify.globals import get_slack_bot_token
+
+    client = AsyncWebClient(token=token or get_slack_bot_token())
+    try:
+        result = await client.chat_postMessage(channel=channel, text=text)
+        logger.info(result)
+        return result
+    except SlackApiError as e:
+        logger.error(f"Error posting the message: {e}")
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for bulk loading pandas DataFrames into warehouse tables.
+
+Frames are written to a local compressed Parquet file, staged and loaded with a
+single COPY, instead of being inlined through the SQL channel row by row. The
+``merge`` mode upserts the staged rows on a key instead of appending them.
+
+``SnowflakeStageLoader`` is the production backend, ``DuckDBStageLoader`` runs the
+same load locally so it can be exercised offline.
+"""
+import abc
+import logging
+import os
+import tempfile
+import uuid
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+LOAD_MODES = ('append', 'merge')
+
+
+class ParquetStageLoader(abc.ABC):
+    """Writes the frame to Parquet, backends implement the append and merge loads of the file."""
+    def __init__(self, compression: str = 'snappy'):
+        self._compression = compression
+
+    def write_parquet(self, df: pd.DataFrame, tmp_dir: str) -> str:
+        path = os.path.join(tmp_dir, f'{uuid.uuid4().hex}.parquet')
+        df.to_parquet(path, compression=self._compression, index=False)
+        logger.info(f'Wrote {len(df)} rows to {path} ({os.path.getsize(path)} bytes)')
+        return path
+
+    def load(self, df: pd.DataFrame, table: str, mode: str = 'append', merge_keys: tuple = ()):
+        """
+        Load a DataFrame into a table.
+
+        Args:
+            df (pd.DataFrame): rows to load, column names must match the table
+            table (str): destination table
+            mode (str): 'append' inserts every row, 'merge' updates the rows matching
+                ``merge_keys`` and inserts the others
+            merge_keys (tuple): key columns of the merge mode
+        """
+        if mode not in LOAD_MODES:
+            raise ValueError(f'Unknown load mode: {mode}')
+        if mode == 'merge' and not merge_keys:
+            raise ValueError('merge mode needs merge_keys')
+        if len(df) == 0:
+            logger.info(f'Nothing to load into {table}')
+            return
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = self.write_parquet(df, tmp_dir)
+            if mode == 'append':
+                self._append(path, table, list(df.columns))
+            else:
+                self._merge(path, table, list(df.columns), list(merge_keys))
+        logger.info(f'Loaded {len(df)} rows into {table} with {mode} mode')
+
+    @abc.abstractmethod
+    def _append(self, path: str, table: str, columns: list):
+        ...
+
+    @abc.abstractmethod
+    def _merge(self, path: str, table: str, columns: list, merge_keys: list):
+        ...
+
+
+class SnowflakeStageLoader(ParquetStageLoader):
+    """PUT the Parquet file to a user stage and COPY INTO the table."""
+    def __init__(self, session, stage: str = '@~/jdx_dsb_shopify', compression: str = 'snappy'):
+        super().__init__(compression=compression)
+        self._session = session
+        self._stage = stage
+
+    def _table_exists(self, table: str) -> bool:
+        return len(self._session.sql(f"SHOW TABLES LIKE '{table}'").collect()) > 0
+
+    def _put(self, path: str) -> str:
+        stage_dir = f'{self._stage}/{uuid.uuid4().hex}'
+        self._session.file.put(path, stage_dir, auto_compress=False, overwrite=True)
+        return stage_dir
+
+    def _copy_into(self, table: str, stage_dir: str):
+        self._session.sql(f'''
+            COPY INTO {table}
+            FROM {stage_dir}
+            FILE_FORMAT = (TYPE = PARQUET)
+            MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+            PURGE = TRUE
+        ''').collect()
+
+    def _create_from_parquet(self, path: str, table: str):
+        # first load of a new table, let Snowpark create it with the frame's schema
+        self._session.create_dataframe(pd.read_parquet(path)).write.save_as_table(table, mode='append')
+
+    def _append(self, path: str, table: str, columns: list):
+        if not self._table_exists(table):
+            self._create_from_parquet(path, table)
+            return
+        self._copy_into(table, self._put(path))
+
+    def _merge(self, path: str, table: str, columns: list, merge_keys: list):
+        if not self._table_exists(table):
+            self._create_from_parquet(path, table)
+            return
+        stage_dir = self._put(path)
+        tmp_table = f'{table}_STAGING_{uuid.uuid4().hex[:8].upper()}'
+        on = ' AND '.join(f't.{k} = s.{k}' for k in merge_keys)
+        update = ', '.join(f't.{c} = s.{c}' for c in columns if c not in merge_keys)
+        insert_cols = ', '.join(columns)
+        insert_values = ', '.join(f's.{c}' for c in columns)
+        self._session.sql(f'CREATE TEMPORARY TABLE {tmp_table} LIKE {table}').collect()
+        try:
+            self._copy_into(tmp_table, stage_dir)
+            self._session.sql(f'''
+                MERGE INTO {table} t
+                USING {tmp_table} s
+                ON {on}
+                WHEN MATCHED THEN UPDATE SET {update}
+                WHEN NOT MATCHED THEN INSERT ({insert_cols}) VALUES ({insert_values})
+            ''').collect()
+        finally:
+            self._session.sql(f'DROP TABLE IF EXISTS {tmp_table}').collect()
+
+
+class DuckDBStageLoader(ParquetStageLoader):
+    """Local stand-in for SnowflakeStageLoader, loading the Parquet file into DuckDB."""
+    def __init__(self, database: str = ':memory:', compression: str = 'snappy'):
+        import duckdb
+
+        super().__init__(compression=compression)
+        self._con = duckdb.connect(database)
+
+    @property
+    def connection(self):
+        return self._con
+
+    def _create_if_missing(self, path: str, table: str):
+        self._con.execute(f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM read_parquet('{path}') LIMIT 0")
+
+    def _append(self, path: str, table: str, columns: list):
+        self._create_if_missing(path, table)
+        cols = ', '.join(columns)
+        self._con.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM read_parquet('{path}')")
+
+    def _merge(self, path: str, table: str, columns: list, merge_keys: list):
+        self._create_if_missing(path, table)
+        on = ' AND '.join(f't.{k} = s.{k}' for k in merge_keys)
+        cols = ', '.join(columns)
+        self._con.execute('BEGIN TRANSACTION')
+        try:
+            self._con.execute(f"DELETE FROM {table} t USING read_parquet('{path}') s WHERE {on}")
+            self._con.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM read_parquet('{path}')")
+            self._con.execute('COMMIT')
+        except Exception:
+            self._con.execute('ROLLBACK')
+            raise
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for the local on-disk cache.
+
+The cache lives in ``data/cache`` of the project unless ``JDX_DSB_SHOPIFY_CACHE_DIR``
+points somewhere else.
+"""
+import json
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parents[2] / 'data' / 'cache'
+
+
+def get_cache_dir() -> Path:
+    cache_dir = Path(os.environ.get('JDX_DSB_SHOPIFY_CACHE_DIR', DEFAULT_CACHE_DIR))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+class ParquetCache:
+    """
+    A DataFrame cached as a Parquet file, tagged with the version of its source.
+    The cached frame is only returned while the source version is unchanged.
+    """
+    def __init__(self, name: str, cache_dir: Path = None):
+        cache_dir = Path(cache_dir) if cache_dir is not None else get_cache_dir()
+        self._data_path = cache_dir / f'{name}.parquet'
+        self._meta_path = cache_dir / f'{name}.json'
+
+    def get(self, version: str):
+        """
+        Returns:
+            pd.DataFrame: the cached frame, None if it is missing or stale
+        """
+        if version is None or not (self._data_path.exists() and self._meta_path.exists()):
+            return None
+        with open(self._meta_path, 'rt') as f:
+            meta = json.load(f)
+        if meta.get('version') != version:
+            logger.info(f'{self._data_path.name} is stale (cached {meta.get("version")}, source {version})')
+            return None
+        logger.info(f'Using cached {self._data_path.name} ({version})')
+        return pd.read_parquet(self._data_path)
+
+    def put(self, df: pd.DataFrame, version: str):
+        if version is None:
+            return
+        # write next to the target and rename so readers never see a partial file
+        tmp_data_path = self._data_path.with_suffix('.parquet.tmp')
+        df.to_parquet(tmp_data_path, index=False)
+        os.replace(tmp_data_path, self._data_path)
+        tmp_meta_path = self._meta_path.with_suffix('.json.tmp')
+        with open(tmp_meta_path, 'wt') as f:
+            json.dump({'version': version, 'rows': len(df)}, f)
+        os.replace(tmp_meta_path, self._meta_path)
+
+
+class JsonState:
+    """
+    A small JSON document kept in the cache dir, e.g. the watermarks of an incremental sync.
+    """
+    def __init__(self, name: str, cache_dir: Path = None):
+        cache_dir = Path(cache_dir) if cache_dir is not None else get_cache_dir()
+        self._path = cache_dir / f'{name}.json'
+
+    def get(self) -> dict:
+        if not self._path.exists():
+            return dict()
+        with open(self._path, 'rt') as f:
+            return json.load(f)
+
+    def put(self, state: dict):
+        tmp_path = self._path.with_suffix('.json.tmp')
+        with open(tmp_path, 'wt') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._path)
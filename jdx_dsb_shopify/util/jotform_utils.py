@@ -8,10 +8,71 @@
 # version : 1.0
 # package : JotFormAPI
 
-import urllib.request, urllib.parse, urllib.error
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from jdx_dsb_shopify.util.retry_utils import LatencyRecorder, RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+
+class SubmissionPager:
+    """
+    Paging plan of iter_form_submissions, shared by the sync and async clients.
+
+    The first page is fetched alone. When it is full, the remaining pages up to the
+    form's submission count can be fetched concurrently, then any pages past the count
+    (submissions received meanwhile) are fetched one by one. Filtered queries are always
+    paged sequentially since the count is unfiltered. Submissions seen on an earlier page
+    are dropped, offsets shift when submissions arrive mid-pull.
+
+    Args:
+        page_size (int): submissions per request
+        concurrent (bool): fetch the pages up to the submission count concurrently
+    """
+    def __init__(self, page_size: int, concurrent: bool = True):
+        self.page_size = page_size
+        self.next_offset = page_size
+        self.done = False
+        self._concurrent = concurrent
+        self._last_concurrent_offset = None
+        self._seen = set()
+
+    @property
+    def needs_count(self):
+        return self._concurrent and not self.done
+
+    def _new_submissions(self, submissions):
+        page = [s for s in submissions if s['id'] not in self._seen]
+        self._seen.update(s['id'] for s in page)
+        return page
+
+    def first_page(self, submissions):
+        self.done = len(submissions) < self.page_size
+        return self._new_submissions(submissions)
+
+    def concurrent_offsets(self, count):
+        """Offsets of the pages to fetch concurrently, sequential paging resumes after the last one."""
+        offsets = list(range(self.page_size, count, self.page_size))
+        if offsets:
+            self._last_concurrent_offset = offsets[-1]
+            self.next_offset = offsets[-1] + self.page_size
+        return offsets
+
+    def concurrent_page(self, offset, submissions):
+        if offset == self._last_concurrent_offset and len(submissions) < self.page_size:
+            self.done = True
+        return self._new_submissions(submissions)
+
+    def next_page(self, submissions):
+        self.done = len(submissions) < self.page_size
+        self.next_offset += self.page_size
+        return self._new_submissions(submissions)
 
 
 class JotformAPIClient:
@@ -23,11 +84,34 @@ class JotformAPIClient:
     _debugMode = False
     _outputType = "json"
 
-    def __init__(self, api_key=None, base_url=DEFAULT_BASE_URL, output_type='json', debug=False):
+    def __init__(
+            self,
+            api_key=None,
+            base_url=DEFAULT_BASE_URL,
+            output_type='json',
+            debug=False,
+            max_retries: int = 5,
+            backoff_factor: float = 1.0,
+            timeout: tuple = (5, 60),
+            pool_size: int = 10,
+            gzip: bool = True,
+    ):
         self._api_key = api_key
         self._base_url = base_url
         self._outputType = output_type.lower()
         self._debugMode = debug
+        self._timeout = timeout
+        self._retry = RetryPolicy('Jotform', max_retries, backoff_factor)
+        self._latencies = LatencyRecorder()
+
+        # one keep-alive session per client so calls reuse the TCP/TLS connection
+        self._session = requests.Session()
+        self._session.headers.update({
+            'User-Agent': 'JOTFORM_PYTHON_WRAPPER',
+            'Accept-Encoding': 'gzip, deflate' if gzip else 'identity',
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
 
     @property
     def api_key(self):
@@ -45,68 +129,68 @@ class JotformAPIClient:
     def base_url(self, base_url):
         self._base_url = base_url
 
+    def close(self):
+        self._session.close()
+
     def _log(self, message):
         if self._debugMode:
             print(message)
 
-    # def set_baseurl(self, baseurl):
-    #     self.__baseUrl = baseurl
-    #
-    # def get_debugMode(self):
-    #     return self.__debugMode
-    #
-    # def set_debugMode(self, value):
-    #     self.__debugMode = value
-    #
-    # def get_outputType(self):
-    #     return self.__outputType
-    # def set_outputType(self, value):
-    #     self.__outputType = value
+    def _request(self, method, path, **kwargs):
+        """
+        Send a request to the API through the pooled session, backing off on the
+        rate limit (429) and server errors (5xx). The latency of every call is
+        recorded per method and path, see latency_metrics.
+        """
+        url = self._base_url.rstrip('/') + '/API' + path
+        kwargs.setdefault('timeout', self._timeout)
+        headers = kwargs.pop('headers', dict())
+        headers['APIKEY'] = self._api_key
+        for attempt in self._retry.attempts:
+            start = time.perf_counter()
+            r = self._session.request(method, url, headers=headers, **kwargs)
+            elapsed = time.perf_counter() - start
+            self._latencies.record(f'{method} {path}', elapsed)
+            self._log(f'{method} {url} {r.status_code} in {elapsed:.3f}s')
+            delay = self._retry.retry_delay(method, path, r, attempt)
+            if delay is None:
+                return r
+            time.sleep(delay)
+
+    def latency_metrics(self):
+        """Latency of the calls made so far.
+        Returns:
+            dict: 'METHOD /path' -> calls, total_s, mean_s, max_s
+        """
+        return self._latencies.metrics()
 
     def fetch_url(self, url, params=None, method=None):
-        if(self.__outputType != 'json'):
+        if(self._outputType != 'json'):
             url = url + '.xml'
 
-        url = self.__baseUrl + self.__apiVersion + url
-
         self._log('fetching url ' + url)
         if (params):
             self._log(params)
 
-        headers = {
-            'api_key': self.__apiKey,
-            'User-Agent': 'JOTFORM_PYTHON_WRAPPER'
-        }
-
+        method = method or 'GET'
         if (method == 'GET'):
-            if (params):
-                url = url + '?' + urllib.parse.urlencode(params)
-
-            req = urllib.request.Request(url, headers=headers, data=None)
+            r = self._request(method, url, params=params)
         elif (method == 'POST'):
-            if (params):
-                data = urllib.parse.urlencode(params).encode('utf-8')
-            else:
-                data = None
-            req = urllib.request.Request(url, headers=headers, data=data)
+            r = self._request(method, url, data=params)
         elif (method == 'DELETE'):
-            req = urllib.request.Request(url, headers=headers, data=None)
-            req.get_method = lambda: 'DELETE'
+            r = self._request(method, url)
         elif (method == 'PUT'):
             if (params):
                 params = params.encode("utf-8")
-            req = urllib.request.Request(url, headers=headers, data=params)
-            req.get_method = lambda: 'PUT'
-
-        response = urllib.request.urlopen(req)
+            r = self._request(method, url, data=params)
+        else:
+            raise ValueError(f'Unsupported method {method}')
 
-        if (self.__outputType == 'json'):
-            responseObject = json.loads(response.read().decode('utf-8'))
-            return responseObject['content']
+        r.raise_for_status()
+        if (self._outputType == 'json'):
+            return r.json()['content']
         else:
-            data = response.read()
-            response.close()
-            return data
+            return r.content
 
     def create_conditions(
             self,
@@ -120,7 +204,6 @@ class JotformAPIClient:
             'limit': limit,
             'filter': filterArray,
             'orderby': order_by,
-            'apiKey': self.api_key,
         }
         params = {}
 
@@ -291,10 +374,56 @@ class JotformAPIClient:
 
         params = self.create_conditions(offset, limit, filterArray, order_by)
 
-        r = requests.get(f'{self.base_url}/API/form/{form_id}/submissions', params=params)
+        r = self._request('GET', f'/form/{form_id}/submissions', params=params)
 
         return r
 
+    def get_form_submission_count(self, form_id):
+        """Number of submissions of a form, as reported by /form/{id}.
+        Args:
+            form_id (string): Form ID is the numbers you see on a form URL.
+        Returns:
+            int: submission count of the form
+        """
+        return int(self.get_form(str(form_id)).get('count', 0))
+
+    def iter_form_submissions(self, form_id, page_size=1000, filterArray=None, order_by=None, max_workers=4):
+        """Iterate over all submissions of a form, one page at a time.
+
+        The first page is fetched alone. When it is full, the remaining pages up to the
+        form's submission count are fetched concurrently and yielded as they arrive, then
+        any pages past the count (submissions received meanwhile) are fetched one by one.
+        Filtered queries are always paged sequentially since the count is unfiltered.
+
+        Args:
+            form_id (string): Form ID is the numbers you see on a form URL.
+            page_size (int): submissions per request, at most 1000.
+            filterArray (array): Filters the query results to fetch a specific form range.(optional)
+            order_by (string): Order results by a form field name. (optional)
+            max_workers (int): number of pages fetched concurrently.
+        Yields:
+            list: submissions of a page, in no particular page order
+        """
+        pager = SubmissionPager(page_size, concurrent=not filterArray and max_workers > 1)
+
+        def fetch_page(offset):
+            r = self.get_form_submissions(
+                form_id, offset=offset, limit=page_size, filterArray=filterArray, order_by=order_by
+            )
+            r.raise_for_status()
+            return r.json()['content']
+
+        yield pager.first_page(fetch_page(None))
+        if pager.needs_count:
+            offsets = pager.concurrent_offsets(self.get_form_submission_count(form_id))
+            if offsets:
+                with ThreadPoolExecutor(max_workers=min(max_workers, len(offsets))) as executor:
+                    futures = {executor.submit(fetch_page, offset): offset for offset in offsets}
+                    for future in as_completed(futures):
+                        yield pager.concurrent_page(futures[future], future.result())
+        while not pager.done:
+            yield pager.next_page(fetch_page(pager.next_offset))
+
     def create_form_submission(self, formID, submission):
         """Submit data to this form using the API.
         Args:
@@ -712,4 +841,36 @@ def parse_form_names(name_dict):
 
 
 def parse_form_dates(date_dict):
-    return date_dict['datetime']
\ No newline at end of file
+    return date_dict['datetime']
+
+def extract_answers(submissions, names):
+    """Extract the answers of the given questions from raw submissions, column by column.
+
+    Question ids are resolved from the question names once per answers layout, keyed
+    by the number of answers, and reused for every submission with that layout. Names
+    a layout does not ask are remembered as missing too, so they are not searched for
+    again. A layout whose cached ids no longer match the names is resolved again.
+
+    Args:
+        submissions (list): submissions as returned by get_form_submissions
+        names (list): question names to extract
+    Returns:
+        dict: question name -> list of answers aligned with submissions, None where unanswered.
+        Only names asked by at least one submission are returned.
+    """
+    names = set(names)
+    columns = dict()
+    layouts = dict()
+    for i, submission in enumerate(submissions):
+        answers = submission['answers']
+        qids = layouts.get(len(answers))
+        if qids is None or any(answers.get(qid, {}).get('name') != name for name, qid in qids.items()):
+            qids = {answer['name']: qid for qid, answer in answers.items() if answer.get('name') in names}
+            layouts[len(answers)] = qids
+        for name, qid in qids.items():
+            if name not in columns:
+                columns[name] = [None] * len(submissions)
+            answer = answers.get(qid)
+            if answer is not None:
+                columns[name][i] = answer.get('answer')
+    return columns
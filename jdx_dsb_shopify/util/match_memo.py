@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for the persistent memo of fuzzy matches.
+
+Every scored key is remembered with the version of the candidate keys it was
+scored against, so repeated spellings skip the fuzzy scorer until the candidates
+change. Pinned matches are set by hand and take precedence over scored ones.
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from rapidfuzz import utils
+
+from jdx_dsb_shopify.util.cache import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+PINNED_SCORE = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    name TEXT NOT NULL,
+    block TEXT NOT NULL,
+    key TEXT NOT NULL,
+    version TEXT NOT NULL,
+    matched TEXT,
+    score INTEGER NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (name, block, key, version)
+);
+CREATE TABLE IF NOT EXISTS pins (
+    name TEXT NOT NULL,
+    block TEXT NOT NULL,
+    key TEXT NOT NULL,
+    matched TEXT NOT NULL,
+    pinned_at TEXT NOT NULL,
+    PRIMARY KEY (name, block, key)
+);
+"""
+
+
+def normalize_key(key) -> str:
+    """Lower-cased alphanumerics, the form the fuzzy scorer compares."""
+    return utils.default_process(str(key))
+
+
+def candidates_version(candidates) -> str:
+    """Hash of the distinct candidate keys, changes whenever a candidate is added or removed."""
+    digest = hashlib.sha1()
+    for candidate in sorted({str(c) for c in candidates}):
+        digest.update(candidate.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def format_block(block_id) -> str:
+    return '|'.join(str(b) for b in block_id)
+
+
+class MatchMemo:
+    """
+    SQLite backed memo of ``(matched, score)`` per normalized key, block and candidate version.
+    """
+    def __init__(self, name: str, path: Path = None):
+        self.name = name
+        self._path = Path(path) if path is not None else get_cache_dir() / 'match_memo.sqlite'
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def lookup(self, block: str, keys, version: str) -> dict:
+        """
+        Args:
+            block: block the keys belong to
+            keys: raw keys, normalized before the lookup
+            version: candidates_version of the block's candidates
+
+        Returns:
+            dict: raw key -> (matched, score) for every key with a pinned or memoized match
+        """
+        normalized = {key: normalize_key(key) for key in keys}
+        with self._lock, self._connect() as conn:
+            scored = dict(
+                (key, (matched, score)) for key, matched, score in conn.execute(
+                    'SELECT key, matched, score FROM matches WHERE name = ? AND block = ? AND version = ?',
+                    (self.name, block, version),
+                )
+            )
+            pinned = dict(
+                (key, (matched, PINNED_SCORE)) for key, matched in conn.execute(
+                    'SELECT key, matched FROM pins WHERE name = ? AND block = ?',
+                    (self.name, block),
+                )
+            )
+        scored.update(pinned)
+        return {key: scored[n] for key, n in normalized.items() if n in scored}
+
+    def store(self, block: str, version: str, results: dict):
+        """
+        Args:
+            block: block the keys belong to
+            version: candidates_version of the block's candidates
+            results: raw key -> (matched, score)
+        """
+        if not results:
+            return
+        updated_at = datetime.utcnow().isoformat()
+        rows = [
+            (self.name, block, normalize_key(key), version, None if matched is None else str(matched), int(score), updated_at)
+            for key, (matched, score) in results.items()
+        ]
+        with self._lock, self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def pin(self, block: str, key: str, matched: str, candidates) -> str:
+        """
+        Args:
+            block: block the key belongs to
+            key: raw key to pin
+            matched: candidate to always match the key to, compared on its normalized form
+            candidates: current candidate keys of the block
+
+        Returns:
+            str: the candidate the key was pinned to, as spelled in candidates
+        """
+        by_normalized = dict()
+        for candidate in candidates:
+            by_normalized.setdefault(normalize_key(candidate), str(candidate))
+        if normalize_key(matched) not in by_normalized:
+            raise ValueError(f'{matched!r} is not a candidate of {self.name}/{block}')
+        matched = by_normalized[normalize_key(matched)]
+
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO pins VALUES (?, ?, ?, ?, ?)',
+                (self.name, block, normalize_key(key), matched, datetime.utcnow().isoformat()),
+            )
+        logger.info(f'Pinned {key!r} to {matched!r} in {self.name}/{block}')
+        return matched
+
+    def unpin(self, block: str, key: str) -> bool:
+        with self._lock, self._connect() as conn:
+            deleted = conn.execute(
+                'DELETE FROM pins WHERE name = ? AND block = ? AND key = ?',
+                (self.name, block, normalize_key(key)),
+            ).rowcount
+        return deleted > 0
+
+    def to_frame(self, block: str = None, pinned_only: bool = False) -> pd.DataFrame:
+        """
+        Returns:
+            pd.DataFrame: memoized and pinned matches, pins first
+        """
+        block_filter = '' if block is None else ' AND block = ?'
+        params = (self.name,) if block is None else (self.name, block)
+        with self._lock, self._connect() as conn:
+            pins = pd.read_sql_query(
+                'SELECT block, key, matched, pinned_at AS updated_at FROM pins WHERE name = ?' + block_filter,
+                conn, params=params,
+            )
+            if pinned_only:
+                matches = pins.iloc[:0]
+            else:
+                matches = pd.read_sql_query(
+                    'SELECT block, key, matched, score, version, updated_at FROM matches WHERE name = ?' + block_filter,
+                    conn, params=params,
+                )
+        pins['score'] = PINNED_SCORE
+        pins['pinned'] = True
+        matches = matches.assign(pinned=False)
+        return pd.concat([pins, matches], ignore_index=True).sort_values(['pinned', 'block', 'key'], ascending=[False, True, True])
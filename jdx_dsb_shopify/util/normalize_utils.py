@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for vectorized normalization of order fields.
+
+Every function works on whole columns with the pandas string accessors, so
+cleaning stays in C instead of a Python call per row.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# low cardinality order fields kept as categoricals
+ORDER_CATEGORY_COLS = ('account_name', 'product_short_name')
+
+
+def split_names(names: pd.Series):
+    """
+    Args:
+        names: Jotform full name answers, dicts with ``first`` and ``last``
+
+    Returns:
+        tuple: first names, last names
+    """
+    return names.str.get('first'), names.str.get('last')
+
+
+def parse_dates(dates: pd.Series) -> pd.Series:
+    """Jotform date answers, dicts with ``datetime``, to their datetime strings."""
+    return dates.str.get('datetime')
+
+
+def parse_hazel_products(tests: pd.Series) -> pd.Series:
+    """hazelTest answers to hazel_plus or hazel_basic."""
+    is_plus = tests.str.lower().str.contains('plus', regex=False, na=False)
+    return pd.Series(np.where(is_plus, 'hazel_plus', 'hazel_basic'), index=tests.index)
+
+
+def clean_upper(values: pd.Series) -> pd.Series:
+    return values.astype(str).str.upper().str.strip()
+
+
+def clean_email(emails: pd.Series) -> pd.Series:
+    return emails.str.lower().str.strip()
+
+
+def standardize_names(names: pd.Series) -> pd.Series:
+    """Upper-case first letter, lower-case rest, e.g. JANE -> Jane."""
+    return names.str.capitalize()
+
+
+def normalize_orders(
+        df: pd.DataFrame,
+        upper_cols=(),
+        strip_cols=(),
+        email_cols=(),
+        category_cols=ORDER_CATEGORY_COLS,
+) -> pd.DataFrame:
+    """
+    Normalize order fields in one pass, columns missing from df are skipped.
+
+    Args:
+        df: orders
+        upper_cols: upper-cased and stripped
+        strip_cols: stripped only
+        email_cols: lower-cased and stripped
+        category_cols: converted to categoricals
+
+    Returns:
+        pd.DataFrame: normalized copy of df
+    """
+    df = df.copy()
+    for c in upper_cols:
+        if c in df.columns:
+            df[c] = clean_upper(df[c])
+    for c in strip_cols:
+        if c in df.columns:
+            df[c] = df[c].str.strip()
+    for c in email_cols:
+        if c in df.columns:
+            df[c] = clean_email(df[c])
+    for c in category_cols:
+        if c in df.columns:
+            df[c] = df[c].astype('category')
+    return df
+
+
+def decategorize(df: pd.DataFrame) -> pd.DataFrame:
+    """Categoricals back to object columns, e.g. before fillna('') or writing to a sheet."""
+    category_cols = df.select_dtypes('category').columns
+    if len(category_cols) == 0:
+        return df
+    return df.astype({c: object for c in category_cols})
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for the durable queue of Jotform submissions waiting for a Shopify order.
+
+Submissions are queued once per submission id, claimed by a worker in micro-batches
+and marked done or failed. Failed submissions are retried until they run out of
+attempts, after which the nightly reconciliation run picks them up again.
+"""
+import json
+import logging
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from jdx_dsb_shopify.util.cache import get_cache_dir
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+# submissions in these states are owned by the queue, reconciliation leaves them alone
+HANDLED_STATUSES = (QUEUED, PROCESSING, DONE)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    submission_id TEXT PRIMARY KEY,
+    form TEXT NOT NULL,
+    payload TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    order_name TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS submissions_status ON submissions (status, created_at);
+"""
+
+
+def _now():
+    return datetime.utcnow().isoformat()
+
+
+class OrderQueue:
+    """
+    SQLite backed queue of submissions, safe to share between the webhook receiver and the worker.
+    """
+    def __init__(self, path: Path = None, max_attempts: int = 3):
+        self._path = Path(path) if path is not None else get_cache_dir() / 'order_queue.sqlite'
+        self._max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, submission_id: str, form: str, payload: dict = None) -> bool:
+        """
+        Returns:
+            bool: False if the submission was queued before, e.g. a redelivered webhook
+        """
+        now = _now()
+        with self._connect() as conn:
+            inserted = conn.execute(
+                'INSERT OR IGNORE INTO submissions (submission_id, form, payload, status, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (str(submission_id), form, json.dumps(payload or dict()), QUEUED, now, now),
+            ).rowcount
+        return inserted > 0
+
+    def claim(self, batch_size: int = 20) -> list:
+        """
+        Move up to batch_size queued submissions to processing, oldest first.
+
+        Returns:
+            list: (submission_id, form) of the claimed submissions
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT submission_id, form FROM submissions WHERE status = ? ORDER BY created_at LIMIT ?',
+                (QUEUED, batch_size),
+            ).fetchall()
+            conn.executemany(
+                'UPDATE submissions SET status = ?, attempts = attempts + 1, updated_at = ? WHERE submission_id = ?',
+                [(PROCESSING, _now(), submission_id) for submission_id, _ in rows],
+            )
+            conn.execute('COMMIT')
+        return rows
+
+    def mark_done(self, submission_id: str, order_name: str = None, note: str = None):
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE submissions SET status = ?, order_name = ?, error = ?, updated_at = ? WHERE submission_id = ?',
+                (DONE, order_name, note, _now(), str(submission_id)),
+            )
+
+    def mark_failed(self, submission_id: str, error: str, retry: bool = True):
+        """
+        Requeue the submission while it has attempts left, otherwise leave it failed for the reconciliation run.
+        Only submissions still processing are affected.
+        """
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE submissions SET status = CASE WHEN ? AND attempts < ? THEN ? ELSE ? END, '
+                'error = ?, updated_at = ? WHERE submission_id = ? AND status = ?',
+                (retry, self._max_attempts, QUEUED, FAILED, error, _now(), str(submission_id), PROCESSING),
+            )
+
+    def requeue_stale(self, older_than: timedelta = timedelta(minutes=10)) -> int:
+        """Requeue submissions left processing by a worker that died mid-batch."""
+        cutoff = (datetime.utcnow() - older_than).isoformat()
+        with self._connect() as conn:
+            requeued = conn.execute(
+                'UPDATE submissions SET status = ?, updated_at = ? WHERE status = ? AND updated_at < ?',
+                (QUEUED, _now(), PROCESSING, cutoff),
+            ).rowcount
+        if requeued:
+            logger.warning(f'Requeued {requeued} submissions left processing')
+        return requeued
+
+    def submission_ids(self, statuses=HANDLED_STATUSES) -> set:
+        with self._connect() as conn:
+            rows = conn.execute(
+                f'SELECT submission_id FROM submissions WHERE status IN ({",".join("?" * len(statuses))})',
+                tuple(statuses),
+            ).fetchall()
+        return {submission_id for submission_id, in rows}
+
+    def counts(self) -> dict:
+        with self._connect() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM submissions GROUP BY status').fetchall())
@@ -1,10 +1,10 @@
 from urllib.parse import quote
 
-from jdx_utils.api.secrets import get_secret_from_sm
+from jdx_dsb_shopify.util.secret_utils import get_secret
 
 
 def get_platformdb_conn_str(secret_name):
-    platform_db_secret = get_secret_from_sm(secret_name)
+    platform_db_secret = get_secret(secret_name)
     endpoint = platform_db_secret['host']
     port = platform_db_secret['port']
     db_name = platform_db_secret['dbname']
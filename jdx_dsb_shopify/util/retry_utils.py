@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for the retry policy and latency bookkeeping shared by the HTTP clients.
+
+The sync (requests) and async (aiohttp) Shopify and Jotform clients only differ in how
+they send a request and wait, which responses to retry and for how long is decided here.
+"""
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying. POSTs are only retried when the API guarantees the call
+# was not processed, otherwise a retried create_order could duplicate an order.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+NON_IDEMPOTENT_RETRY_STATUSES = (429, 503)
+
+
+class RetryPolicy:
+    """
+    Backs off on throttling (429) and server errors (5xx), for the Retry-After of the
+    response if given, exponentially otherwise.
+
+    Args:
+        name (str): API name used in the logs
+        max_retries (int): retries after the first attempt
+        backoff_factor (float): seconds of the first backoff, doubled on every retry
+        limiter_waits (bool): a call limiter already holds every caller until Retry-After
+            expires, responses with a Retry-After are then retried right away
+    """
+    def __init__(self, name: str, max_retries: int = 5, backoff_factor: float = 1.0, limiter_waits: bool = False):
+        self.name = name
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.limiter_waits = limiter_waits
+
+    @property
+    def attempts(self):
+        return range(self.max_retries + 1)
+
+    def retry_delay(self, method: str, url: str, r, attempt: int):
+        """
+        Args:
+            method (str): HTTP method of the call
+            url (str): URL or path of the call, for the logs
+            r (requests.Response): response of the attempt
+            attempt (int): attempt number, starting at 0
+
+        Returns:
+            float: seconds to wait before the next attempt, None when r is the final response
+        """
+        retry_statuses = NON_IDEMPOTENT_RETRY_STATUSES if method == 'POST' else RETRY_STATUSES
+        if r.status_code not in retry_statuses or attempt == self.max_retries:
+            if not r.ok:
+                logger.error(f'{self.name} {method} {url} failed with {r.status_code}: {r.text}')
+            return None
+
+        retry_after = r.headers.get('Retry-After')
+        if retry_after is not None and self.limiter_waits:
+            delay = 0
+        elif retry_after and retry_after.isdigit():
+            delay = float(retry_after)
+        else:
+            delay = self.backoff_factor * 2 ** attempt
+        logger.warning(
+            f'{self.name} {method} {url} returned {r.status_code}, '
+            f'retry {attempt + 1}/{self.max_retries} in {delay}s'
+        )
+        return delay
+
+
+class LatencyRecorder:
+    """
+    Latencies of API calls keyed by 'METHOD endpoint', safe to share between threads.
+    """
+    def __init__(self):
+        self._latencies = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, key: str, elapsed: float):
+        with self._lock:
+            self._latencies[key].append(elapsed)
+
+    def metrics(self) -> dict:
+        """
+        Returns:
+            dict: 'METHOD endpoint' -> calls, total_s, mean_s, max_s
+        """
+        with self._lock:
+            latencies = {k: list(v) for k, v in self._latencies.items()}
+        return {
+            k: {'calls': len(v), 'total_s': sum(v), 'mean_s': sum(v) / len(v), 'max_s': max(v)}
+            for k, v in latencies.items()
+        }
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for cached access to AWS Secrets Manager.
+
+Secrets are memoized per process with a TTL, so the scripts and helpers can ask for
+the same secret as often as they like while Secrets Manager is hit once per secret.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jdx_utils.api.secrets import get_google_api_creds, get_secret_from_sm
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SECRET_TTL = 3600
+
+_cache = dict()
+_key_locks = dict()
+_lock = threading.Lock()
+
+
+def _get_cached(key, loader, ttl):
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    # one lock per key so concurrent callers wait for a single fetch of the same secret
+    with key_lock:
+        cached = _cache.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        value = loader()
+        _cache[key] = (time.monotonic() + ttl, value)
+        return value
+
+
+def get_secret(secret_name: str, ttl: float = DEFAULT_SECRET_TTL) -> dict:
+    """
+    Cached version of get_secret_from_sm.
+
+    Args:
+        secret_name (str): Secrets Manager secret name
+        ttl (float): seconds a fetched secret stays valid
+
+    Returns:
+        dict: secret key/values
+    """
+    def loader():
+        logger.debug(f'Fetching secret {secret_name} from Secrets Manager')
+        return get_secret_from_sm(secret_name)
+
+    return _get_cached(('secret', secret_name), loader, ttl)
+
+
+def get_google_creds_info(secret_name: str, ttl: float = DEFAULT_SECRET_TTL) -> dict:
+    """
+    Cached version of get_google_api_creds.
+
+    Args:
+        secret_name (str): Secrets Manager secret name of the service account
+        ttl (float): seconds the fetched credentials stay valid
+
+    Returns:
+        dict: service account info
+    """
+    return _get_cached(('google', secret_name), lambda: get_google_api_creds(secret_name), ttl)
+
+
+def get_google_credentials(secret_name: str, scopes: tuple, ttl: float = DEFAULT_SECRET_TTL):
+    """
+    Cached Google service account credentials.
+
+    Args:
+        secret_name (str): Secrets Manager secret name of the service account
+        scopes (tuple): OAuth scopes of the credentials
+        ttl (float): seconds the credentials stay cached
+
+    Returns:
+        google.oauth2.service_account.Credentials: service account credentials
+    """
+    def loader():
+        from google.oauth2.service_account import Credentials
+        return Credentials.from_service_account_info(get_google_creds_info(secret_name, ttl=ttl), scopes=list(scopes))
+
+    return _get_cached(('google_credentials', secret_name, tuple(scopes)), loader, ttl)
+
+
+def prefetch_secrets(secret_names: list, google_secret_names: list = (), max_workers: int = 8):
+    """
+    Fetch every secret a script needs concurrently and warm the cache.
+
+    Args:
+        secret_names (list): Secrets Manager secret names
+        google_secret_names (list): secret names of Google service accounts
+        max_workers (int): number of concurrent fetches
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(get_secret, name) for name in secret_names]
+        futures += [executor.submit(get_google_creds_info, name) for name in google_secret_names]
+        for future in futures:
+            future.result()
+
+
+def clear_secret_cache():
+    with _lock:
+        _cache.clear()
@@ -1,26 +1,245 @@
 import logging
+import math
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import pandas as pd
 import requests
 import json
-from jdx_utils.api.secrets import get_secret_from_sm
+from requests.adapters import HTTPAdapter
 from jdx_utils.util import log_start_stop, log_runtime
 
+from jdx_dsb_shopify.util.retry_utils import RetryPolicy
+from jdx_dsb_shopify.util.secret_utils import get_secret
 from jdx_dsb_shopify.globals import FST_BARCODE, FST_SKU, FST_LP, NIPS_BASIC_BARCODE, NIPS_BASIC_SKU, NIPS_BASIC_LP, \
     NIPS_PLUS_BARCODE, NIPS_PLUS_SKU, NIPS_PLUS_LP
 
 logger = logging.getLogger(__name__)
 
+B2B_PRODUCTS = {
+    'birch': {
+        'title': 'Birch Fetal Gender Test B2B Ultrasound Centers',
+        'barcode': FST_BARCODE,
+        'sku': FST_SKU,
+        'compare_at_price': FST_LP,
+    },
+    'hazel_basic': {
+        'title': 'Hazel NIPS-Basic Test B2B Ultrasound Centers',
+        'barcode': NIPS_BASIC_BARCODE,
+        'sku': NIPS_BASIC_SKU,
+        'compare_at_price': NIPS_BASIC_LP,
+    },
+    'hazel_plus': {
+        'title': 'Hazel NIPS-Plus Test B2B Ultrasound Centers',
+        'barcode': NIPS_PLUS_BARCODE,
+        'sku': NIPS_PLUS_SKU,
+        'compare_at_price': NIPS_PLUS_LP,
+    },
+}
+
+# REST products.json caps a product at 100 variants
+MAX_VARIANTS_PER_PRODUCT = 100
+
+BULK_VARIANT_QUERY = '''
+{
+  productVariants%(filter)s {
+    edges {
+      node {
+        legacyResourceId
+        title
+        sku
+        barcode
+        price
+        compareAtPrice
+        product {
+          legacyResourceId
+          productType
+          tags
+        }
+      }
+    }
+  }
+}
+'''
+
+BULK_OPERATION_RUN_MUTATION = '''
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+'''
+
+CURRENT_BULK_OPERATION_QUERY = '''
+{
+  currentBulkOperation {
+    id
+    status
+    errorCode
+    objectCount
+    url
+  }
+}
+'''
+
+def assign_variant_shards(
+        account_ids: list,
+        max_variants: int = MAX_VARIANTS_PER_PRODUCT,
+        current_shards: dict = None,
+) -> dict:
+    """
+    Deterministically spread accounts over as few products (shards) as possible.
+
+    Accounts already on a shard stay there while the shard is still used and has room,
+    moving a variant would delete it and give it a new variant id. The other accounts
+    go to their hashed shard (crc32 of the account id modulo the shard count), or to the
+    emptiest shard when that one is full. Without current shards the same account set
+    always maps to the same shards, and up to ``max_variants`` accounts stay on a single
+    product.
+
+    Args:
+        account_ids (list): accounts to place
+        max_variants (int): variants per product
+        current_shards (dict): account id -> shard of the live products
+
+    Returns:
+        dict: account id -> shard number
+    """
+    account_ids = sorted(set(str(a) for a in account_ids))
+    current_shards = {str(a): shard for a, shard in (current_shards or dict()).items()}
+    n_shards = max(1, math.ceil(len(account_ids) / max_variants))
+    shard_map = dict()
+    counts = Counter()
+    for a in account_ids:
+        shard = current_shards.get(a)
+        if shard is not None and shard < n_shards and counts[shard] < max_variants:
+            shard_map[a] = shard
+            counts[shard] += 1
+    for a in account_ids:
+        if a in shard_map:
+            continue
+        shard = zlib.crc32(a.encode('utf-8')) % n_shards
+        if counts[shard] >= max_variants:
+            shard = min(range(n_shards), key=lambda s: (counts[s], s))
+        shard_map[a] = shard
+        counts[shard] += 1
+    return shard_map
+
+
+def get_product_shard(product_info: dict) -> int:
+    """Shard number of a B2B product, read from its ``shard_<n>`` tag (untagged products are shard 0)."""
+    tags = product_info.get('tags', '')
+    if isinstance(tags, str):
+        tags = tags.split(',')
+    for tag in tags:
+        tag = tag.strip()
+        if tag.startswith('shard_') and tag[len('shard_'):].isdigit():
+            return int(tag[len('shard_'):])
+    return 0
+
+
+class ShopifyCallLimiter:
+    """
+    Client-side mirror of Shopify's leaky-bucket REST limit.
+
+    The bucket level is estimated locally (calls in flight leak at ``leak_rate`` per
+    second) and re-synced from the ``X-Shopify-Shop-Api-Call-Limit`` header of every
+    response. A ``Retry-After`` header blocks all callers until it expires.
+    """
+    def __init__(self, bucket_size: int = 40, leak_rate: float = 2.0, headroom: int = 2, clock=time.monotonic):
+        self._bucket_size = bucket_size
+        self._leak_rate = leak_rate
+        self._headroom = headroom
+        self._clock = clock
+        self._used = 0.0
+        self._blocked_until = 0.0
+        self._last_update = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def bucket_size(self):
+        return self._bucket_size
+
+    @property
+    def remaining(self):
+        with self._lock:
+            self._leak(self._clock())
+            return max(0.0, self._bucket_size - self._used)
+
+    def _leak(self, now):
+        self._used = max(0.0, self._used - (now - self._last_update) * self._leak_rate)
+        self._last_update = now
+
+    def reserve(self) -> float:
+        """
+        Reserve a slot for one call.
+
+        Returns:
+            float: seconds the caller has to wait before sending the call
+        """
+        with self._lock:
+            now = self._clock()
+            self._leak(now)
+            wait = max(0.0, self._blocked_until - now)
+            overflow = self._used + 1 - (self._bucket_size - self._headroom)
+            if overflow > 0:
+                wait = max(wait, overflow / self._leak_rate)
+            self._used += 1
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            logger.debug(f'Throttling Shopify call for {wait:.2f}s')
+            time.sleep(wait)
+
+    def update_from_response(self, response):
+        call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+        retry_after = response.headers.get('Retry-After')
+        with self._lock:
+            now = self._clock()
+            self._leak(now)
+            if call_limit:
+                used, bucket_size = (int(v) for v in call_limit.split('/'))
+                self._bucket_size = bucket_size
+                self._used = max(self._used, float(used))
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + float(retry_after))
+
+
 class ShopifyHelper:
-    def __init__(self, secret_name):
-        self._access_token = get_secret_from_sm(secret_name)['SHOPIFY_TOKEN']
-        self._shop_env = get_secret_from_sm(secret_name)['SHOP_ENV']
+    def __init__(
+            self,
+            secret_name,
+            max_retries: int = 5,
+            backoff_factor: float = 1.0,
+            timeout: tuple = (5, 60),
+            pool_size: int = 10,
+    ):
+        shopify_secrets = get_secret(secret_name)
+        self._access_token = shopify_secrets['SHOPIFY_TOKEN']
+        self._shop_env = shopify_secrets['SHOP_ENV']
         self._product_endpoint = f'https://{self._shop_env}/admin/api/2022-07/products.json'
         self._order_endpoint = f'https://{self._shop_env}/admin/api/2023-04/orders.json'
+        self._variant_endpoint = f'https://{self._shop_env}/admin/api/2022-07/variants'
+        self._graphql_endpoint = f'https://{self._shop_env}/admin/api/2023-04/graphql.json'
         self._headers = {
             'X-Shopify-Access-Token': self._access_token,
             'Content-Type': 'application/json'
         }
+        self._timeout = timeout
+        self._limiter = ShopifyCallLimiter()
+        self._retry = RetryPolicy('Shopify', max_retries, backoff_factor, limiter_waits=True)
+
+        # one keep-alive session per helper so calls reuse the TCP/TLS connection
+        self._session = requests.Session()
+        self._session.headers.update(self._headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
 
     @property
     def shop_env(self):
@@ -30,41 +249,293 @@ class ShopifyHelper:
     def headers(self):
         return self._headers
 
+    @property
+    def limiter(self):
+        return self._limiter
+
+    @property
+    def graphql_endpoint(self):
+        return self._graphql_endpoint
+
+    @graphql_endpoint.setter
+    def graphql_endpoint(self, graphql_endpoint):
+        self._graphql_endpoint = graphql_endpoint
+
+    def close(self):
+        self._session.close()
+
+    def _request(self, method: str, url: str, **kwargs):
+        """
+        Send a request through the pooled session, honouring the call limit and
+        backing off on throttling (429) and server errors (5xx).
+        """
+        kwargs.setdefault('timeout', self._timeout)
+        for attempt in self._retry.attempts:
+            self._limiter.acquire()
+            r = self._session.request(method, url, **kwargs)
+            self._limiter.update_from_response(r)
+            delay = self._retry.retry_delay(method, url, r, attempt)
+            if delay is None:
+                return r
+            time.sleep(delay)
+
     def get_products(self, product_ids: list = None):
         param_payloads = {
             'ids': product_ids
         }
 
-        r = requests.get(
+        r = self._request(
+            'GET',
             self._product_endpoint,
             params = param_payloads,
-            headers=self.headers
         )
         return r
 
+    def iter_products(self, product_type: str = None, fields: list = None, limit: int = 250, **filters):
+        """
+        Lazily iterate over every product of the shop, following the ``Link: rel=next``
+        page_info cursors.
+
+        Args:
+            product_type (str): only return products of this product type
+            fields (list): only return these product fields
+            limit (int): page size, 250 is the REST maximum
+            **filters: any other products.json filter, e.g. status or vendor
+
+        Yields:
+            dict: product
+        """
+        params = {
+            'limit': limit,
+            'product_type': product_type,
+            'fields': ','.join(fields) if fields else None,
+            **filters,
+        }
+        url = self._product_endpoint
+        while url:
+            r = self._request('GET', url, params=params)
+            r.raise_for_status()
+            yield from r.json()['products']
+            # the next link already carries page_info, limit and fields
+            url = r.links.get('next', {}).get('url')
+            params = None
 
     @log_start_stop
     @log_runtime
     def create_product(self, product_info):
-        r = requests.post(self._product_endpoint, data=json.dumps(product_info), headers=self.headers)
+        r = self._request('POST', self._product_endpoint, data=json.dumps(product_info))
         return r
 
     @log_start_stop
     @log_runtime
     def delete_product(self, product_id):
-        r = requests.delete(self._product_endpoint.replace('.json', f'/{product_id}.json'), headers=self.headers)
+        r = self._request('DELETE', self._product_endpoint.replace('.json', f'/{product_id}.json'))
+        return r
+
+    def get_product(self, product_id, fields: list = None):
+        r = self._request(
+            'GET',
+            self._product_endpoint.replace('.json', f'/{product_id}.json'),
+            params={'fields': ','.join(fields) if fields else None},
+        )
+        return r
+
+    def update_variant(self, variant_info):
+        r = self._request(
+            'PUT',
+            f"{self._variant_endpoint}/{variant_info['id']}.json",
+            data=json.dumps({'variant': variant_info}),
+        )
+        return r
+
+    def create_variant(self, product_id, variant_info):
+        r = self._request(
+            'POST',
+            self._product_endpoint.replace('.json', f'/{product_id}/variants.json'),
+            data=json.dumps({'variant': variant_info}),
+        )
+        return r
+
+    def delete_variant(self, product_id, variant_id):
+        r = self._request(
+            'DELETE',
+            self._product_endpoint.replace('.json', f'/{product_id}/variants/{variant_id}.json'),
+        )
         return r
 
     @log_start_stop
     @log_runtime
     def create_order(self, order_info):
-        r = requests.post(self._order_endpoint, data=json.dumps(order_info), headers=self.headers)
+        r = self._request('POST', self._order_endpoint, data=json.dumps(order_info))
         return r
 
+    def _target_concurrency(self, max_workers: int):
+        # scale the in-flight calls with the remaining call budget: a drained bucket
+        # falls back to one call at a time, a full bucket runs all workers
+        share = self._limiter.remaining / self._limiter.bucket_size
+        return max(1, min(max_workers, int(round(share * max_workers))))
+
+    def _run_batch(self, fn, items: list, max_workers: int = 8):
+        """
+        Run ``fn`` over ``items`` on a bounded worker pool whose concurrency follows
+        the remaining call-limit budget.
+
+        Returns:
+            list: results in input order, None where the call raised
+        """
+        results = [None] * len(items)
+        pending = dict()
+        next_index = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while next_index < len(items) or pending:
+                concurrency = self._target_concurrency(max_workers)
+                while next_index < len(items) and len(pending) < concurrency:
+                    pending[executor.submit(fn, items[next_index])] = next_index
+                    next_index += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    try:
+                        results[i] = future.result()
+                    except requests.RequestException as e:
+                        logger.error(f'Shopify call for batch item {i} failed: {e}')
+        return results
+
+    @log_start_stop
+    @log_runtime
+    def create_orders(self, order_infos: list, max_workers: int = 8):
+        logger.info(f'Creating {len(order_infos)} orders with up to {max_workers} workers.')
+        return self._run_batch(self.create_order, order_infos, max_workers=max_workers)
+
+    @log_start_stop
+    @log_runtime
+    def update_variants(self, variant_infos: list, max_workers: int = 8):
+        logger.info(f'Updating {len(variant_infos)} variants.')
+        return self._run_batch(self.update_variant, variant_infos, max_workers=max_workers)
+
+    @log_start_stop
+    @log_runtime
+    def create_variants(self, product_id, variant_infos: list, max_workers: int = 8):
+        logger.info(f'Adding {len(variant_infos)} variants to product {product_id}.')
+        return self._run_batch(
+            lambda variant_info: self.create_variant(product_id, variant_info),
+            variant_infos,
+            max_workers=max_workers,
+        )
+
+    @log_start_stop
+    @log_runtime
+    def delete_variants(self, product_id, variant_ids: list, max_workers: int = 8):
+        logger.info(f'Removing {len(variant_ids)} variants from product {product_id}.')
+        return self._run_batch(
+            lambda variant_id: self.delete_variant(product_id, variant_id),
+            variant_ids,
+            max_workers=max_workers,
+        )
+
+    def graphql(self, query: str, variables: dict = None):
+        r = self._request(
+            'POST',
+            self._graphql_endpoint,
+            data=json.dumps({'query': query, 'variables': variables or {}}),
+        )
+        r.raise_for_status()
+        result = r.json()
+        if result.get('errors'):
+            raise RuntimeError(f'Shopify GraphQL errors: {result["errors"]}')
+        return result['data']
+
+    def run_bulk_query(self, query: str, poll_interval: float = 5.0, timeout: float = 3600):
+        """
+        Run a GraphQL bulk operation and wait for it to finish.
+
+        Returns:
+            str: URL of the JSONL result file, None if the query matched nothing
+        """
+        data = self.graphql(BULK_OPERATION_RUN_MUTATION, variables={'query': query})
+        user_errors = data['bulkOperationRunQuery']['userErrors']
+        if user_errors:
+            raise RuntimeError(f'Could not start Shopify bulk operation: {user_errors}')
+        logger.info(f"Started Shopify bulk operation {data['bulkOperationRunQuery']['bulkOperation']['id']}")
+
+        deadline = time.monotonic() + timeout
+        while True:
+            operation = self.graphql(CURRENT_BULK_OPERATION_QUERY)['currentBulkOperation']
+            if operation['status'] == 'COMPLETED':
+                logger.info(f"Shopify bulk operation finished with {operation['objectCount']} objects.")
+                return operation['url']
+            if operation['status'] in ('FAILED', 'CANCELED', 'EXPIRED'):
+                raise RuntimeError(
+                    f"Shopify bulk operation {operation['id']} {operation['status']}: {operation['errorCode']}"
+                )
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Shopify bulk operation {operation['id']} did not finish in {timeout}s")
+            time.sleep(poll_interval)
+
+    @staticmethod
+    def iter_bulk_results(url: str, chunk_size: int = 1 << 16):
+        """Stream a bulk operation JSONL result file line by line."""
+        # the result file lives on a signed storage URL, do not send the shop token there
+        with requests.get(url, stream=True, timeout=(5, 300)) as r:
+            r.raise_for_status()
+            for line in r.iter_lines(chunk_size=chunk_size):
+                if line:
+                    yield json.loads(line)
+
+    @log_start_stop
+    @log_runtime
+    def bulk_export_variants(self, search_query: str = None, output: str = 'pandas', poll_interval: float = 5.0):
+        """
+        Snapshot every product variant with a single GraphQL bulk operation.
+
+        Args:
+            search_query (str): optional productVariants search filter, e.g. 'product_type:birch'
+            output (str): 'pandas' for a DataFrame, 'arrow' for a pyarrow Table
+            poll_interval (float): seconds between bulk operation status polls
+
+        Returns:
+            variants with the same columns as the REST variant payload
+            (id, product_id, title, sku, barcode, price, compare_at_price) plus the
+            product_type and product_tags of their product
+        """
+        if output not in ('pandas', 'arrow'):
+            raise ValueError(f'Unknown output: {output}')
+
+        query_filter = f'(query: {json.dumps(search_query)})' if search_query else ''
+        url = self.run_bulk_query(BULK_VARIANT_QUERY % {'filter': query_filter}, poll_interval=poll_interval)
+
+        columns = {
+            'id': list(),
+            'product_id': list(),
+            'title': list(),
+            'sku': list(),
+            'barcode': list(),
+            'price': list(),
+            'compare_at_price': list(),
+            'product_type': list(),
+            'product_tags': list(),
+        }
+        if url is not None:
+            for variant in self.iter_bulk_results(url):
+                columns['id'].append(int(variant['legacyResourceId']))
+                columns['product_id'].append(int(variant['product']['legacyResourceId']))
+                columns['title'].append(variant['title'])
+                columns['sku'].append(variant['sku'])
+                columns['barcode'].append(variant['barcode'])
+                columns['price'].append(variant['price'])
+                columns['compare_at_price'].append(variant['compareAtPrice'])
+                columns['product_type'].append(variant['product']['productType'])
+                columns['product_tags'].append(variant['product']['tags'])
+
+        if output == 'arrow':
+            import pyarrow as pa
+            return pa.table(columns)
+        return pd.DataFrame(columns)
+
     @log_start_stop
     @log_runtime
     def get_orders(self, order_ids:list):
-        r = requests.get(self._order_endpoint, params={'ids': json.dumps(order_ids), 'status': 'any'}, headers=self.headers)
+        r = self._request('GET', self._order_endpoint, params={'ids': json.dumps(order_ids), 'status': 'any'})
         return r
     # ['5299801030905', '5300357005561']
     # 'Overnight (1 business day - Monday to Friday)'
@@ -121,69 +592,45 @@ class ShopifyHelper:
         return variants
 
 
+    @classmethod
+    def create_b2b_product_variants(cls, variant_df: pd.DataFrame, product_short_name: str = 'birch'):
+        if product_short_name not in B2B_PRODUCTS:
+            raise ValueError(f'Unknown product type: {product_short_name}')
+        product_config = B2B_PRODUCTS[product_short_name]
+        return cls.create_product_variants_from_df(
+            df=variant_df,
+            barcode=product_config['barcode'],
+            sku=product_config['sku'],
+            compared_at_price=product_config['compare_at_price'],
+        )
+
     @log_start_stop
     def create_b2b_products(
             self,
             variant_df: pd.DataFrame,
             status: str = 'active',
-            product_short_name: str = 'birch'
+            product_short_name: str = 'birch',
+            shard: int = 0,
     ):
-        logger.info(f'Creating a Shopify product with product type: {product_short_name}')
+        logger.info(f'Creating a Shopify product with product type: {product_short_name} (shard {shard})')
         logger.info(f'Create with {len(variant_df)} variants.')
-        if product_short_name == 'birch':
-            product_info = self.create_product_info(
-                product_title='Birch Fetal Gender Test B2B Ultrasound Centers',
-                body_html='',
-                status=status,
-                product_type='birch',
-                vendor='junodx',
-                published=False,
-                tags=['b2b', 'birch', 'imaging_centers'],
-                variants=self.create_product_variants_from_df(
-                    df=variant_df,
-                    barcode=FST_BARCODE,
-                    sku=FST_SKU,
-                    compared_at_price=FST_LP,
-                )
-
-            )
-        elif product_short_name == 'hazel_basic':
-            product_info = self.create_product_info(
-                product_title='Hazel NIPS-Basic Test B2B Ultrasound Centers',
-                body_html='',
-                status=status,
-                product_type='hazel_basic',
-                vendor='junodx',
-                published=False,
-                tags=['b2b', 'hazel_basic', 'imaging_centers'],
-                variants=self.create_product_variants_from_df(
-                    df=variant_df,
-                    barcode=NIPS_BASIC_BARCODE,
-                    sku=NIPS_BASIC_SKU,
-                    compared_at_price=NIPS_BASIC_LP,
-                )
-
-            )
-        elif product_short_name == 'hazel_plus':
-            product_info = self.create_product_info(
-                product_title='Hazel NIPS-Plus Test B2B Ultrasound Centers',
-                body_html='',
-                status=status,
-                product_type='hazel_plus',
-                vendor='junodx',
-                published=False,
-                tags=['b2b', 'hazel_plus', 'imaging_centers'],
-                variants=self.create_product_variants_from_df(
-                    df=variant_df,
-                    barcode=NIPS_PLUS_BARCODE,
-                    sku=NIPS_PLUS_SKU,
-                    compared_at_price=NIPS_PLUS_LP,
-                )
-
+        if len(variant_df) > MAX_VARIANTS_PER_PRODUCT:
+            raise ValueError(
+                f'{len(variant_df)} variants exceed the {MAX_VARIANTS_PER_PRODUCT} variants per product limit.'
             )
-
-        else:
-            raise ValueError(f'Unknown product type: {product_short_name}')
+        variants = self.create_b2b_product_variants(variant_df, product_short_name=product_short_name)
+        product_title = B2B_PRODUCTS[product_short_name]['title']
+        if shard > 0:
+            product_title = f'{product_title} ({shard + 1})'
+        product_info = self.create_product_info(
+            product_title=product_title,
+            body_html='',
+            status=status,
+            product_type=product_short_name,
+            vendor='junodx',
+            published=False,
+            tags=['b2b', product_short_name, 'imaging_centers', f'shard_{shard}'],
+            variants=variants,
+        )
 
         return self.create_product(product_info)
-
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+This module is for Snowflake session utility functions.
+
+Every Snowflake helper goes through one shared Snowpark session per process, so a
+cron run logs in once and resumes a single warehouse.
+"""
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+from jdx_dsb_shopify.globals import SNOWFLAKE_SECRET_NAME, SNOWFLAKE_WH
+from jdx_dsb_shopify.util.secret_utils import get_secret
+
+logger = logging.getLogger(__name__)
+
+SNOWFLAKE_DATABASE = 'JDX_PLATFORM'
+SNOWFLAKE_SCHEMA = 'ANALYTICS'
+
+_session = None
+_query_tag = None
+# Snowpark sessions are not safe to share between threads, callers serialize on this lock
+_session_lock = threading.RLock()
+
+
+def get_connection_parameters(warehouse: str = SNOWFLAKE_WH) -> dict:
+    snowflake_secrets = get_secret(SNOWFLAKE_SECRET_NAME)
+    return {
+        "account": snowflake_secrets['SNOWFLAKE_ACCOUNT'],
+        "user": snowflake_secrets['SNOWFLAKE_USER'],
+        "password": snowflake_secrets['SNOWFLAKE_PASSWORD'],
+        "warehouse": warehouse,
+        "database": SNOWFLAKE_DATABASE,
+        "schema": SNOWFLAKE_SCHEMA,
+        # the shared session outlives the login token in long-running services like jotform_webhook serve
+        "client_session_keep_alive": True,
+    }
+
+
+def set_query_tag(query_tag: str):
+    """
+    Tag every query of the run, e.g. with the script name. The tag is applied when the
+    session is created, so setting it does not log in to Snowflake.
+    """
+    global _query_tag
+    with _session_lock:
+        _query_tag = query_tag
+        if _session is not None:
+            _session.query_tag = query_tag
+
+
+def get_session():
+    """
+    Shared Snowpark session of the process, created on first use.
+
+    Returns:
+        snowflake.snowpark.Session: session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            from snowflake.snowpark import Session
+
+            connection_parameters = get_connection_parameters()
+            logger.info(f"Connecting to Snowflake with warehouse {connection_parameters['warehouse']}")
+            _session = Session.builder.configs(connection_parameters).create()
+            if _query_tag is not None:
+                _session.query_tag = _query_tag
+            atexit.register(close_session)
+        return _session
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+@contextmanager
+def snowflake_session(query_tag: str = None):
+    """
+    Context manager around the shared session. The session is locked for the
+    duration of the block and, if given, ``query_tag`` replaces the run's query tag
+    until the block exits.
+
+    Args:
+        query_tag (str): optional query tag for the queries of the block
+
+    Yields:
+        snowflake.snowpark.Session: session
+    """
+    with _session_lock:
+        session = get_session()
+        if query_tag is None:
+            yield session
+            return
+
+        session.query_tag = query_tag
+        try:
+            yield session
+        finally:
+            session.query_tag = _query_tag
+
+
+def get_table_version(table: str) -> str:
+    """
+    Version token of a table, changing with every committed DML on it.
+    SYSTEM$LAST_CHANGE_COMMIT_TIME is answered from metadata, so the probe does not
+    resume the warehouse.
+
+    Args:
+        table (str): fully qualified table name
+
+    Returns:
+        str: version token
+    """
+    with snowflake_session() as session:
+        return str(session.sql(f"SELECT SYSTEM$LAST_CHANGE_COMMIT_TIME('{table}')").collect()[0][0])
+
+
+def fetch_pandas(query: str, dtypes: dict = None) -> pd.DataFrame:
+    """
+    Run a query on the shared session and stream its Arrow result batches straight
+    into pandas, without collecting Row objects first.
+
+    Args:
+        query (str): SQL query
+        dtypes (dict): lower case column name -> dtype, applied to every batch
+
+    Returns:
+        pd.DataFrame: query result with lower case column names
+    """
+    dtypes = dtypes or dict()
+    batches = list()
+    with snowflake_session() as session:
+        for batch in session.sql(query).to_pandas_batches():
+            batch.columns = [c.lower() for c in batch.columns]
+            batches.append(batch.astype({c: t for c, t in dtypes.items() if c in batch.columns}))
+
+    if len(batches) == 0:
+        return pd.DataFrame({c: pd.Series(dtype=t) for c, t in dtypes.items()})
+    return pd.concat(batches, ignore_index=True)
@@ -1,32 +1,155 @@
 import logging
+from collections import defaultdict
 
+import numpy as np
 import pandas as pd
-from thefuzz import fuzz
-from thefuzz import process
-import logging
+from rapidfuzz import fuzz, process, utils
+
+from jdx_dsb_shopify.util.match_memo import candidates_version, format_block, normalize_key
 
 logger=logging.getLogger(__name__)
 
-def fuzzy_merge(df_1, df_2, key1, key2, threshold=90, **kwargs):
+
+def _match_keys(left_keys: np.ndarray, right_keys: np.ndarray, chunk_size: int = 2048, workers: int = -1):
+    """
+    Best match in right_keys for every key in left_keys, scored like thefuzz's
+    process.extractOne (WRatio on lower-cased alphanumerics, rounded to an int).
+
+    WRatio only scores 100 when the processed keys are equal, so keys whose processed
+    form is in right_keys skip the scorer and take the first such right key, as
+    extractOne would. The others are scored against every right key at once with
+    rapidfuzz's cdist, ``chunk_size`` left keys at a time to bound the memory of the
+    score matrix.
+
+    Args:
+        left_keys: distinct left keys
+        right_keys: distinct right keys
+        chunk_size: number of left keys scored per cdist call
+        workers: threads used by cdist, -1 for all cores
+
+    Returns:
+        tuple: position of the best right key (-1 without candidates) and its score, aligned with left_keys
+    """
+    best = np.full(len(left_keys), -1, dtype=int)
+    scores = np.zeros(len(left_keys), dtype=int)
+    if len(right_keys) == 0:
+        return best, scores
+
+    first_right = dict()
+    for i, right_key in enumerate(right_keys):
+        processed = utils.default_process(right_key)
+        if processed:
+            first_right.setdefault(processed, i)
+    exact = np.asarray([first_right.get(utils.default_process(k), -1) for k in left_keys], dtype=int)
+    best[exact >= 0] = exact[exact >= 0]
+    scores[exact >= 0] = 100
+
+    to_score = np.flatnonzero(exact < 0)
+    for start in range(0, len(to_score), chunk_size):
+        rows = to_score[start:start + chunk_size]
+        score_matrix = process.cdist(
+            left_keys[rows], right_keys,
+            scorer=fuzz.WRatio,
+            processor=utils.default_process,
+            workers=workers,
+        )
+        best[rows] = score_matrix.argmax(axis=1)
+        scores[rows] = np.rint(score_matrix[np.arange(len(rows)), best[rows]]).astype(int)
+
+    return best, scores
+
+
+def _group_by_block(df, key, block_keys):
+    """Distinct keys of every block, as {block: list of keys}."""
+    distinct = df[block_keys + [key]].drop_duplicates()
+    if block_keys:
+        block_ids = pd.MultiIndex.from_frame(distinct[block_keys].astype(str))
+    else:
+        block_ids = [()] * len(distinct)
+    blocks = defaultdict(list)
+    for block_id, value in zip(block_ids, distinct[key]):
+        blocks[block_id].append(value)
+    return distinct, block_ids, blocks
+
+
+def fuzzy_merge(df_1, df_2, key1, key2, threshold=90, block_keys=None, memo=None, **kwargs):
     """
     :param df_1: the left table to join
     :param df_2: the right table to join
     :param key1: key column of the left table
     :param key2: key column of the right table
     :param threshold: how close the matches should be to return a match, based on Levenshtein distance
-    :param limit: the amount of matches that will get returned, these are sorted high to low
+    :param block_keys: column(s) present in both tables, keys are only matched within the same block
+    :param memo: MatchMemo holding earlier and pinned matches, only unseen keys are scored
+    :param kwargs: passed to the merge of the matched tables, e.g. how
     :return: dataframe with boths keys and matches
     """
     df_1 = df_1.copy()
     df_2 = df_2.copy()
+    if block_keys is None:
+        block_keys = []
+    elif isinstance(block_keys, str):
+        block_keys = [block_keys]
+    else:
+        block_keys = list(block_keys)
 
-    s = df_2[key2].tolist()
+    # score every distinct left key once, against the right keys of its block only
+    left_distinct, left_block_ids, left_blocks = _group_by_block(df_1, key1, block_keys)
+    _, _, right_blocks = _group_by_block(df_2, key2, block_keys)
 
-    df_1[['matched', 'score']] = df_1[key1].apply(
-        lambda x: process.extractOne(x, s)
-    ).apply(pd.Series)
+    matches = dict()
+    tasks = dict()
+    versions = dict()
+    for block_id, left_values in left_blocks.items():
+        right_values = right_blocks.get(block_id, [])
+        if memo is not None:
+            # reuse earlier results for keys whose memoized match is still a candidate,
+            # compared on the normalized key like the pins, the first candidate wins a tie
+            versions[block_id] = candidates_version(right_values)
+            right_by_key = dict()
+            for v in right_values:
+                right_by_key.setdefault(normalize_key(v), v)
+            memoized = memo.lookup(format_block(block_id), left_values, versions[block_id])
+            for left_value, (matched_value, score) in memoized.items():
+                if matched_value is None:
+                    matches[(block_id, left_value)] = (None, score)
+                elif normalize_key(matched_value) in right_by_key:
+                    matches[(block_id, left_value)] = (right_by_key[normalize_key(matched_value)], score)
+            left_values = [v for v in left_values if (block_id, v) not in matches]
+            if not left_values:
+                continue
+            logger.info(f'Scoring {len(left_values)} unseen keys of block {format_block(block_id) or "all"}')
+        tasks[block_id] = (
+            left_values,
+            np.asarray([str(v) for v in left_values], dtype=object),
+            np.asarray([str(v) for v in right_values], dtype=object),
+        )
 
-    df_1 = df_1.merge(df_2, left_on=['matched'], right_on=[key2], **kwargs).query(f'score>={threshold}')
+    # cdist already scores every block on all cores
+    results = {
+        block_id: _match_keys(left_keys, right_keys)
+        for block_id, (_, left_keys, right_keys) in tasks.items()
+    }
 
-    return df_1
+    for block_id, (best, scores) in results.items():
+        right_values = right_blocks.get(block_id, [])
+        block_matches = dict()
+        for left_value, i, score in zip(tasks[block_id][0], best, scores):
+            block_matches[left_value] = (right_values[i] if i >= 0 else None, score)
+            matches[(block_id, left_value)] = block_matches[left_value]
+        if memo is not None:
+            memo.store(format_block(block_id), versions[block_id], block_matches)
+
+    matched = [matches[(block_id, value)] for block_id, value in zip(left_block_ids, left_distinct[key1])]
+    left_distinct['matched'] = [m[0] for m in matched]
+    left_distinct['score'] = np.asarray([m[1] for m in matched], dtype=int)
+    df_1 = df_1.merge(left_distinct, on=block_keys + [key1], how='left')
 
+    df_1 = df_1.merge(
+        df_2,
+        left_on=['matched'] + block_keys,
+        right_on=[key2] + block_keys,
+        **kwargs
+    ).query(f'score>={threshold}')
+
+    return df_1
@@ -0,0 +1,20 @@
+import pytest
+
+from tests.helpers import FakeClock
+
+SHOPIFY_SECRETS = {'SHOP_ENV': 'test-shop.myshopify.com', 'SHOPIFY_TOKEN': 'token'}
+
+
+@pytest.fixture
+def fake_clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def shopify_helper(monkeypatch):
+    from jdx_dsb_shopify.util import shopify_utils
+
+    monkeypatch.setattr(shopify_utils, 'get_secret', lambda secret_name: SHOPIFY_SECRETS)
+    helper = shopify_utils.ShopifyHelper('shopify-secret')
+    yield helper
+    helper.close()
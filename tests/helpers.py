@@ -0,0 +1,22 @@
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class FakeClock:
+    """Stand-in for time.monotonic that only moves when advanced."""
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+def make_response(status: int = 200, body: bytes = b'{}', headers: dict = None) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r.headers = CaseInsensitiveDict(headers or dict())
+    r._content = body
+    return r
@@ -0,0 +1,115 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+VARIANTS_JSONL = b'\n'.join(json.dumps(line).encode() for line in [
+    {
+        'legacyResourceId': '101', 'title': 'a1|Center One', 'sku': 'FST', 'barcode': '111',
+        'price': '99.00', 'compareAtPrice': '199.00',
+        'product': {'legacyResourceId': '1', 'productType': 'birch', 'tags': ['b2b', 'birch', 'shard_0']},
+    },
+    {
+        'legacyResourceId': '201', 'title': 'Default Title', 'sku': 'FST-D2C', 'barcode': '111',
+        'price': '199.00', 'compareAtPrice': None,
+        'product': {'legacyResourceId': '2', 'productType': 'birch', 'tags': []},
+    },
+    {
+        'legacyResourceId': '301', 'title': 'a2|Center Two', 'sku': 'NIPS', 'barcode': '222',
+        'price': '149.00', 'compareAtPrice': '299.00',
+        'product': {'legacyResourceId': '3', 'productType': 'hazel_plus', 'tags': ['b2b', 'hazel_plus']},
+    },
+]) + b'\n'
+
+
+class BulkOperationStub(BaseHTTPRequestHandler):
+    """Shopify GraphQL endpoint running one bulk operation, and the storage serving its JSONL result."""
+    def _send(self, body: bytes, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+        if 'bulkOperationRunQuery' in query:
+            data = {'bulkOperationRunQuery': {'bulkOperation': {'id': 'gid://1', 'status': 'CREATED'}, 'userErrors': []}}
+        else:
+            status = self.server.statuses.pop(0)
+            url = self.server.result_url if status == 'COMPLETED' else None
+            data = {'currentBulkOperation': {
+                'id': 'gid://1', 'status': status, 'errorCode': None, 'objectCount': '3', 'url': url,
+            }}
+        self._send(json.dumps({'data': data}).encode())
+
+    def do_GET(self):
+        assert 'X-Shopify-Access-Token' not in self.headers
+        self._send(VARIANTS_JSONL, content_type='application/jsonl')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def bulk_stub(shopify_helper):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BulkOperationStub)
+    server.statuses = ['RUNNING', 'COMPLETED']
+    server.result_url = f'http://127.0.0.1:{server.server_port}/bulk/result.jsonl'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    shopify_helper.graphql_endpoint = f'http://127.0.0.1:{server.server_port}/admin/api/2023-04/graphql.json'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_bulk_export_variants_to_pandas(shopify_helper, bulk_stub):
+    df = shopify_helper.bulk_export_variants(poll_interval=0)
+
+    assert bulk_stub.statuses == []
+    assert df['id'].tolist() == [101, 201, 301]
+    assert df['product_id'].tolist() == [1, 2, 3]
+    assert df['title'].tolist() == ['a1|Center One', 'Default Title', 'a2|Center Two']
+    assert df['price'].tolist() == ['99.00', '199.00', '149.00']
+    assert df['compare_at_price'].fillna('').tolist() == ['199.00', '', '299.00']
+    assert df['product_type'].tolist() == ['birch', 'birch', 'hazel_plus']
+    assert df['product_tags'].tolist() == [['b2b', 'birch', 'shard_0'], [], ['b2b', 'hazel_plus']]
+
+
+def test_bulk_export_variants_to_arrow(shopify_helper, bulk_stub):
+    table = shopify_helper.bulk_export_variants(output='arrow', poll_interval=0)
+    assert table.num_rows == 3
+    assert table.column('id').to_pylist() == [101, 201, 301]
+
+
+def test_bulk_export_without_matches_is_empty(shopify_helper, bulk_stub):
+    bulk_stub.statuses = ['COMPLETED']
+    bulk_stub.result_url = None
+    df = shopify_helper.bulk_export_variants(poll_interval=0)
+    assert len(df) == 0
+
+
+def test_failed_bulk_operation_raises(shopify_helper, bulk_stub):
+    bulk_stub.statuses = ['RUNNING', 'FAILED']
+    with pytest.raises(RuntimeError, match='FAILED'):
+        shopify_helper.bulk_export_variants(poll_interval=0)
+
+
+def test_rebuild_loads_only_b2b_variants(shopify_helper, bulk_stub, monkeypatch):
+    from jdx_dsb_shopify.scripts import manage_b2b_products
+
+    loads = dict()
+
+    def fake_update(df, product_short_name, mode='append'):
+        loads[product_short_name] = (df['id'].tolist(), list(df.columns), mode)
+
+    monkeypatch.setattr(manage_b2b_products, 'update_snowflake_shopify_b2b_products', fake_update)
+    bulk_stub.statuses = ['COMPLETED']
+    manage_b2b_products.rebuild_shopify_b2b_products(shopify_helper)
+
+    assert loads['birch'][0] == [101]
+    assert loads['hazel_basic'][0] == []
+    assert loads['hazel_plus'][0] == [301]
+    assert all(mode == 'merge' for _, _, mode in loads.values())
+    assert 'product_tags' not in loads['birch'][1]
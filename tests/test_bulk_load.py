@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+
+from jdx_dsb_shopify.util.bulk_load import DuckDBStageLoader
+
+# the loader imports duckdb lazily, skip rather than fail where it is not installed
+pytest.importorskip('duckdb')
+
+MERGE_KEYS = ('ENV', 'PRODUCT_SHORT_NAME', 'ID')
+
+
+def variants(ids, price):
+    return pd.DataFrame({
+        'ENV': 'dev',
+        'PRODUCT_SHORT_NAME': 'birch',
+        'ID': ids,
+        'PRICE': price,
+    })
+
+
+def table_rows(loader, table):
+    return loader.connection.execute(f'SELECT * FROM {table} ORDER BY ID, PRICE').df()
+
+
+def test_append_keeps_every_row():
+    loader = DuckDBStageLoader()
+    loader.load(variants([1, 2], 10.0), 'VARIANTS')
+    loader.load(variants([2, 3], 20.0), 'VARIANTS')
+
+    rows = table_rows(loader, 'VARIANTS')
+    assert rows['ID'].tolist() == [1, 2, 2, 3]
+    assert rows['PRICE'].tolist() == [10.0, 10.0, 20.0, 20.0]
+
+
+def test_merge_upserts_on_keys():
+    loader = DuckDBStageLoader()
+    loader.load(variants([1, 2], 10.0), 'VARIANTS', mode='merge', merge_keys=MERGE_KEYS)
+    other_product = variants([2], 15.0).assign(PRODUCT_SHORT_NAME='hazel_plus')
+    loader.load(other_product, 'VARIANTS', mode='merge', merge_keys=MERGE_KEYS)
+    loader.load(variants([2, 3], 20.0), 'VARIANTS', mode='merge', merge_keys=MERGE_KEYS)
+
+    rows = table_rows(loader, 'VARIANTS')
+    assert list(zip(rows['PRODUCT_SHORT_NAME'], rows['ID'], rows['PRICE'])) == [
+        ('birch', 1, 10.0),
+        ('hazel_plus', 2, 15.0),
+        ('birch', 2, 20.0),
+        ('birch', 3, 20.0),
+    ]
+
+
+def test_merge_needs_keys():
+    with pytest.raises(ValueError):
+        DuckDBStageLoader().load(variants([1], 10.0), 'VARIANTS', mode='merge')
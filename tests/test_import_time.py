@@ -0,0 +1,56 @@
+import subprocess
+import sys
+
+import pytest
+
+# cron entry points
+ENTRY_POINTS = (
+    'jdx_dsb_shopify.scripts.jotform_integration',
+    'jdx_dsb_shopify.scripts.amazon_fba_shopify',
+    'jdx_dsb_shopify.scripts.manage_b2b_products',
+    'jdx_dsb_shopify.scripts.jotform_webhook',
+)
+
+# client libraries that must only be imported by the code paths that use them
+DEFERRED_MODULES = (
+    'snowflake.snowpark',
+    'slack_sdk',
+    'gspread',
+    'google.oauth2',
+    'jdx_slack_bot',
+    'aiohttp',
+)
+
+IMPORT_BUDGET_MS = 2000
+
+
+def measure_import_time(module: str):
+    """
+    Import a module in a fresh interpreter with ``python -X importtime``.
+
+    Returns:
+        tuple: cumulative import time of the module in milliseconds, set of all imported modules
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    cumulative_us = dict()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        cumulative_us[name.strip()] = int(cumulative)
+    return cumulative_us[module] / 1000, set(cumulative_us)
+
+
+@pytest.mark.parametrize('module', ENTRY_POINTS)
+def test_entry_point_import_time(module):
+    import_ms, imported = measure_import_time(module)
+
+    assert import_ms < IMPORT_BUDGET_MS, f'{module} took {import_ms:.0f}ms to import'
+    eager = [m for m in DEFERRED_MODULES if m in imported]
+    assert not eager, f'{module} eagerly imports {", ".join(eager)}'
@@ -0,0 +1,177 @@
+import json
+import threading
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from jdx_dsb_shopify.scripts.jotform_integration import JOTFORM_DATETIME_FORMAT, ORDER_LOOKBACK, \
+    SUBMISSION_WATERMARKS, advance_submission_watermarks, get_submission_watermarks
+from jdx_dsb_shopify.util.cache import JsonState
+from jdx_dsb_shopify.util.jotform_utils import JotformAPIClient
+from tests.helpers import make_response
+
+
+class FakeForm:
+    """
+    Canned submissions of a form served page by page, newest first like Jotform.
+    ``arrivals`` are added in front of the submissions once the first page was served.
+    """
+    def __init__(self, n_submissions, count=None, arrivals=0):
+        self.submissions = [{'id': str(i)} for i in range(n_submissions, 0, -1)]
+        self.count = n_submissions if count is None else count
+        self.arrivals = arrivals
+        self.offsets = list()
+        self._lock = threading.Lock()
+
+    def get_form_submissions(self, form_id, offset=None, limit=None, filterArray=None, order_by=None):
+        with self._lock:
+            self.offsets.append(offset)
+            page = self.submissions[offset or 0:(offset or 0) + limit]
+            if self.arrivals and len(self.offsets) == 1:
+                newest = int(self.submissions[0]['id'])
+                self.submissions = [{'id': str(newest + i)} for i in range(self.arrivals, 0, -1)] + self.submissions
+        return make_response(body=json.dumps({'content': page}).encode())
+
+    def get_form_submission_count(self, form_id):
+        return self.count
+
+
+@pytest.fixture
+def jotform_client():
+    client = JotformAPIClient(api_key='key')
+    yield client
+    client.close()
+
+
+def pull(client, form, **kwargs):
+    client.get_form_submissions = form.get_form_submissions
+    client.get_form_submission_count = form.get_form_submission_count
+    pages = list(client.iter_form_submissions('1', **kwargs))
+    return [s['id'] for page in pages for s in page]
+
+
+def test_concurrent_paging_fetches_every_page_once(jotform_client):
+    form = FakeForm(2500)
+
+    ids = pull(jotform_client, form, page_size=1000)
+
+    assert sorted(ids, key=int) == [str(i) for i in range(1, 2501)]
+    assert sorted(form.offsets, key=lambda o: o or 0) == [None, 1000, 2000]
+
+
+def test_concurrent_paging_continues_past_the_count(jotform_client):
+    # 300 submissions arrived after the count was read
+    form = FakeForm(2300, count=2000)
+
+    ids = pull(jotform_client, form, page_size=1000)
+
+    assert sorted(ids, key=int) == [str(i) for i in range(1, 2301)]
+    assert form.offsets == [None, 1000, 2000]
+
+
+def test_paging_drops_submissions_shifted_onto_the_next_page(jotform_client):
+    # two submissions arrive after the first page, the next page repeats two of its submissions
+    form = FakeForm(25, arrivals=2)
+
+    ids = pull(jotform_client, form, page_size=10)
+
+    assert len(ids) == len(set(ids))
+    assert set(str(i) for i in range(1, 26)) <= set(ids)
+
+
+@pytest.mark.parametrize('kwargs', [
+    pytest.param({'filterArray': {'created_at:gt': '2026-10-01 00:00:00'}}, id='filtered'),
+    pytest.param({'max_workers': 1}, id='single worker'),
+])
+def test_sequential_paging(jotform_client, kwargs):
+    form = FakeForm(2000)
+    form.get_form_submission_count = None  # the count is never read
+
+    ids = pull(jotform_client, form, page_size=1000, **kwargs)
+
+    assert ids == [str(i) for i in range(2000, 0, -1)]
+    # a full last page is only known to be the last one after an empty page
+    assert form.offsets == [None, 1000, 2000]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('JDX_DSB_SHOPIFY_CACHE_DIR', str(tmp_path))
+    return tmp_path
+
+
+def lookback_floor():
+    return (datetime.now() - ORDER_LOOKBACK).strftime(JOTFORM_DATETIME_FORMAT)
+
+
+def test_submission_watermarks_are_floored_at_the_lookback(cache_dir):
+    recent = {'created_at': '2999-01-01 00:00:00', 'id': '42'}
+    JsonState(SUBMISSION_WATERMARKS).put({'birch': recent, 'hazel': {'created_at': '2000-01-01 00:00:00', 'id': '7'}})
+
+    before = lookback_floor()
+    watermarks = get_submission_watermarks()
+    after = lookback_floor()
+
+    assert watermarks['birch'] == recent
+    assert watermarks['hazel']['id'] == '0'
+    assert before <= watermarks['hazel']['created_at'] <= after
+
+
+def test_submission_watermarks_without_state_or_on_full_sync(cache_dir):
+    assert {w['id'] for w in get_submission_watermarks().values()} == {'0'}
+
+    JsonState(SUBMISSION_WATERMARKS).put({'birch': {'created_at': '2999-01-01 00:00:00', 'id': '42'}})
+    watermarks = get_submission_watermarks(full_sync=True)
+    assert set(watermarks) == {'birch', 'hazel'}
+    assert {w['id'] for w in watermarks.values()} == {'0'}
+
+
+WATERMARKS = {
+    'birch': {'created_at': '2026-10-01 00:00:00', 'id': '100'},
+    'hazel': {'created_at': '2026-10-01 00:00:00', 'id': '200'},
+}
+
+
+def submissions(rows):
+    return pd.DataFrame(rows, columns=['form', 'submission_id', 'order_submitted_at'])
+
+
+def test_advance_watermarks_to_the_last_done_submission():
+    df = submissions([
+        ('birch', '102', '2026-10-02 09:00:00'),
+        ('birch', '101', '2026-10-02 08:00:00'),
+        ('hazel', '201', '2026-10-03 08:00:00'),
+    ])
+
+    assert advance_submission_watermarks(WATERMARKS, df, pending_ids=[]) == {
+        'birch': {'created_at': '2026-10-02 09:00:00', 'id': '102'},
+        'hazel': {'created_at': '2026-10-03 08:00:00', 'id': '201'},
+    }
+
+
+def test_advance_watermarks_holds_back_for_pending_submissions():
+    df = submissions([
+        ('birch', '101', '2026-10-02 08:00:00'),
+        ('birch', '102', '2026-10-02 09:00:00'),  # failed or still queued
+        ('birch', '103', '2026-10-02 10:00:00'),
+        ('hazel', '201', '2026-10-03 08:00:00'),  # failed or still queued
+    ])
+
+    assert advance_submission_watermarks(WATERMARKS, df, pending_ids=['102', '201']) == {
+        'birch': {'created_at': '2026-10-02 08:00:00', 'id': '101'},
+        'hazel': WATERMARKS['hazel'],
+    }
+
+
+def test_advance_watermarks_breaks_ties_on_the_submission_id():
+    # same second, the numeric submission id orders them, not the string or row order
+    df = submissions([
+        ('birch', '1000', '2026-10-02 08:00:00'),
+        ('birch', '999', '2026-10-02 08:00:00'),
+        ('birch', '1001', '2026-10-02 08:00:00'),
+    ])
+
+    advanced = advance_submission_watermarks(WATERMARKS, df, pending_ids=['1001'])
+
+    assert advanced['birch'] == {'created_at': '2026-10-02 08:00:00', 'id': '1000'}
@@ -0,0 +1,88 @@
+import json
+
+import pandas as pd
+import pytest
+
+from jdx_dsb_shopify.scripts import jotform_webhook
+from jdx_dsb_shopify.scripts.jotform_integration import JOTFORM_FORM_IDS, created_orders_frame
+from jdx_dsb_shopify.util.order_queue import DONE, FAILED, QUEUED, OrderQueue
+from tests.helpers import make_response
+
+
+class FakeJotformClient:
+    def get_submission(self, submission_id):
+        return {'id': submission_id, 'form_id': JOTFORM_FORM_IDS['birch'], 'status': 'ACTIVE'}
+
+
+@pytest.fixture
+def order_queue(tmp_path):
+    return OrderQueue(path=tmp_path / 'order_queue.sqlite')
+
+
+@pytest.fixture
+def created_orders(monkeypatch):
+    """submission_id -> (order_name, response_status) returned by the Shopify order create."""
+    created_orders = dict()
+
+    def create_shopify_orders(shopify_helper, fuzzy_matched_df):
+        rows = [(s, *created_orders[s]) for s in fuzzy_matched_df['submission_id']]
+        return pd.DataFrame(rows, columns=['submission_id', 'order_name', 'response_status'])
+
+    # every submission is a new order matched to a variant
+    monkeypatch.setattr(jotform_webhook, 'submissions_to_form_info',
+                        lambda submissions, cols: pd.DataFrame({'submission_id': [s['id'] for s in submissions]}))
+    monkeypatch.setattr(jotform_webhook, 'parse_form_info', lambda df, form: df)
+    monkeypatch.setattr(jotform_webhook, 'clean_form_orders', lambda df: df)
+    monkeypatch.setattr(jotform_webhook, 'find_new_orders', lambda df: df)
+    monkeypatch.setattr(jotform_webhook, 'match_order_variants', lambda df: df)
+    monkeypatch.setattr(jotform_webhook, 'create_shopify_orders', create_shopify_orders)
+    monkeypatch.setattr(jotform_webhook, 'report_created_orders', lambda df: None)
+    return created_orders
+
+
+def process(order_queue, submission_ids):
+    for submission_id in submission_ids:
+        order_queue.enqueue(submission_id, 'birch')
+    jotform_webhook.process_batch(order_queue, FakeJotformClient(), None, order_queue.claim())
+
+
+def test_only_orders_shopify_did_not_process_are_requeued(order_queue, created_orders):
+    created_orders.update({
+        '1': ('#1001', 201),
+        '2': ('', 429),   # throttled
+        '3': ('', 503),   # unavailable
+        '4': ('', 500),   # may have been created
+        '5': ('', None),  # no response, e.g. a read timeout
+    })
+
+    process(order_queue, ['1', '2', '3', '4', '5'])
+
+    assert order_queue.submission_ids([DONE]) == {'1'}
+    assert order_queue.submission_ids([QUEUED]) == {'2', '3'}
+    assert order_queue.submission_ids([FAILED]) == {'4', '5'}
+
+
+def test_failed_order_creation_is_not_requeued(order_queue, created_orders, monkeypatch):
+    def create_shopify_orders(shopify_helper, fuzzy_matched_df):
+        raise RuntimeError('Shopify is down')
+
+    monkeypatch.setattr(jotform_webhook, 'create_shopify_orders', create_shopify_orders)
+
+    with pytest.raises(RuntimeError):
+        process(order_queue, ['1', '2'])
+
+    assert order_queue.submission_ids([FAILED]) == {'1', '2'}
+
+
+def test_created_orders_frame_keeps_the_response_status():
+    fuzzy_matched_df = pd.DataFrame([{c: 'x' for c in [
+        'account_name', 'first_name', 'last_name', 'email', 'dob', 'lmp', 'product_short_name',
+        'product_id', 'variant_id', 'kit_code', 'order_submitted_at',
+    ]}] * 3).assign(submission_id=['1', '2', '3'])
+    payloads = [{'order': {'email': 'x'}}] * 3
+    created = make_response(201, json.dumps({'order': {'name': '#1001', 'id': 11}}).encode())
+
+    df = created_orders_frame(fuzzy_matched_df, payloads, [created, make_response(429), None])
+
+    assert df['order_name'].tolist() == ['#1001', '', '']
+    assert df['response_status'].tolist() == [201, 429, None]
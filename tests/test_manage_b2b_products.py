@@ -0,0 +1,171 @@
+import json
+from contextlib import contextmanager
+
+import pandas as pd
+import pytest
+
+from jdx_dsb_shopify.scripts.manage_b2b_products import apply_product_variant_diff, diff_product_variants, \
+    get_last_variant_update
+from jdx_dsb_shopify.util import snowflake_utils
+from jdx_dsb_shopify.util.shopify_utils import ShopifyHelper
+from tests.helpers import make_response
+
+
+def live(variant_id, account_id, price, account_name=None):
+    return {'id': variant_id, 'option1': f'{account_id}|{account_name or f"Center {account_id}"}', 'price': str(price)}
+
+
+def desired(account_id, price, account_name=None):
+    return {'option1': f'{account_id}|{account_name or f"Center {account_id}"}', 'price': price}
+
+
+@pytest.mark.parametrize('live_variants, desired_variants, to_update, to_create, to_delete', [
+    pytest.param(
+        [live(11, 'a1', 100), live(12, 'a2', 120)],
+        [desired('a1', 100), desired('a2', 120)],
+        [], [], [],
+        id='unchanged',
+    ),
+    pytest.param(
+        [live(11, 'a1', '100.00'), live(12, 'a2', 120)],
+        [desired('a1', 100.001), desired('a2', 120)],
+        [], [], [],
+        id='price within a cent',
+    ),
+    pytest.param(
+        [live(11, 'a1', 100), live(12, 'a2', 120)],
+        [desired('a1', 90), desired('a2', 120)],
+        [{'id': 11, 'option1': 'a1|Center a1', 'price': 90}], [], [],
+        id='price change',
+    ),
+    pytest.param(
+        [live(11, 'a1', 100)],
+        [desired('a1', 100, 'Renamed Center')],
+        [{'id': 11, 'option1': 'a1|Renamed Center', 'price': 100}], [], [],
+        id='account rename',
+    ),
+    pytest.param(
+        [live(11, 'a1', 100)],
+        [desired('a1', 100), desired('a3', 130)],
+        [], [desired('a3', 130)], [],
+        id='new account',
+    ),
+    pytest.param(
+        [live(11, 'a1', 100), live(12, 'a2', 120)],
+        [desired('a1', 100)],
+        [], [], [12],
+        id='removed account',
+    ),
+    pytest.param(
+        [live(11, 'a1', 100), live(12, 'a2', 120)],
+        [desired('a1', 110), desired('a3', 130)],
+        [{'id': 11, 'option1': 'a1|Center a1', 'price': 110}], [desired('a3', 130)], [12],
+        id='update, add and remove',
+    ),
+])
+def test_diff_product_variants(live_variants, desired_variants, to_update, to_create, to_delete):
+    assert diff_product_variants(live_variants, desired_variants) == (to_update, to_create, to_delete)
+
+
+class FakeShopifyHelper:
+    """Records the variant writes, builds the desired variants like ShopifyHelper."""
+    create_b2b_product_variants = ShopifyHelper.create_b2b_product_variants
+
+    def __init__(self):
+        self.calls = list()
+
+    def update_variants(self, variant_infos):
+        self.calls.append(('update', variant_infos))
+        return [make_response() for _ in variant_infos]
+
+    def delete_variants(self, product_id, variant_ids):
+        self.calls.append(('delete', product_id, variant_ids))
+        return [make_response() for _ in variant_ids]
+
+    def create_variants(self, product_id, variant_infos):
+        self.calls.append(('create', product_id, [v['option1'] for v in variant_infos]))
+        return [make_response(201) for _ in variant_infos]
+
+    def get_product(self, product_id):
+        self.calls.append(('get', product_id))
+        return make_response(body=json.dumps({'product': {'id': product_id, 'variants': []}}).encode())
+
+
+def price_df(rows):
+    return pd.DataFrame(rows, columns=['account_id', 'account_name', 'price'])
+
+
+def test_apply_diff_makes_no_calls_when_nothing_changed():
+    helper = FakeShopifyHelper()
+    b2b_product = {'id': 1, 'variants': [live(11, 'a1', 100), live(12, 'a2', 120)]}
+    variant_df = price_df([('a1', 'Center a1', 100.0), ('a2', 'Center a2', 120.0)])
+
+    assert apply_product_variant_diff(b2b_product, variant_df, 'birch', helper) is None
+    assert helper.calls == []
+
+
+def test_apply_diff_writes_only_the_changes():
+    helper = FakeShopifyHelper()
+    b2b_product = {'id': 1, 'variants': [live(11, 'a1', 100), live(12, 'a2', 120)]}
+    variant_df = price_df([('a1', 'Center a1', 110.0), ('a3', 'Center a3', 130.0)])
+
+    response = apply_product_variant_diff(b2b_product, variant_df, 'birch', helper)
+
+    assert response.json()['product']['id'] == 1
+    assert helper.calls == [
+        ('update', [{'id': 11, 'option1': 'a1|Center a1', 'price': 110.0}]),
+        ('delete', 1, [12]),
+        ('create', 1, ['a3|Center a3']),
+        ('get', 1),
+    ]
+
+
+def test_apply_diff_raises_when_a_write_fails():
+    helper = FakeShopifyHelper()
+    helper.update_variants = lambda variant_infos: [None]
+    b2b_product = {'id': 1, 'variants': [live(11, 'a1', 100)]}
+
+    with pytest.raises(RuntimeError):
+        apply_product_variant_diff(b2b_product, price_df([('a1', 'Center a1', 90.0)]), 'birch', helper)
+
+
+class FakeSnowparkSession:
+    """Returns the given pandas batches for every query."""
+    def __init__(self, batches):
+        self.batches = batches
+
+    def sql(self, query):
+        return self
+
+    def to_pandas_batches(self):
+        return iter(self.batches)
+
+
+@pytest.fixture
+def snowflake_batches(monkeypatch):
+    # get_last_variant_update catches SnowparkSQLException
+    pytest.importorskip('snowflake.snowpark')
+    batches = list()
+
+    @contextmanager
+    def fake_session(query_tag=None):
+        yield FakeSnowparkSession(batches)
+
+    monkeypatch.setattr(snowflake_utils, 'snowflake_session', fake_session)
+    return batches
+
+
+def test_last_variant_update_of_empty_table(snowflake_batches):
+    assert get_last_variant_update('test-shop.myshopify.com') == dict()
+
+
+def test_last_variant_update(snowflake_batches):
+    snowflake_batches.append(pd.DataFrame({
+        'PRODUCT_SHORT_NAME': ['birch', 'hazel_plus'],
+        'LAST_MODIFIED': ['2026-10-01 08:00:00.123456', '2026-10-02 09:30:00'],
+    }))
+
+    assert get_last_variant_update('test-shop.myshopify.com') == {
+        'birch': pd.Timestamp('2026-10-01 08:00:00.123456'),
+        'hazel_plus': pd.Timestamp('2026-10-02 09:30:00'),
+    }
@@ -0,0 +1,50 @@
+import pandas as pd
+import pytest
+
+from jdx_dsb_shopify.util.match_memo import MatchMemo
+from jdx_dsb_shopify.util.util import fuzzy_merge
+
+VARIANT_NAMES = ["ST. MARY'S IMAGING CENTER", 'HAZEL IMAGING']
+
+
+@pytest.fixture
+def memo(tmp_path):
+    return MatchMemo('test', path=tmp_path / 'match_memo.sqlite')
+
+
+def test_pin_resolves_the_variant_spelling(memo):
+    assert memo.pin('hazel_plus', 'St Marys Imaging', "St. Mary's Imaging Center", VARIANT_NAMES) \
+        == "ST. MARY'S IMAGING CENTER"
+
+    pins = memo.to_frame(pinned_only=True)
+    assert pins[['block', 'key', 'matched']].values.tolist() == \
+        [['hazel_plus', 'st marys imaging', "ST. MARY'S IMAGING CENTER"]]
+
+
+def test_pin_refuses_unknown_variant(memo):
+    with pytest.raises(ValueError):
+        memo.pin('hazel_plus', 'St Marys Imaging', 'St Marys Imaging Annex', VARIANT_NAMES)
+
+    assert len(memo.to_frame()) == 0
+
+
+def test_fuzzy_merge_uses_pins(memo):
+    memo.pin('hazel_plus', 'SMI', "ST. MARY'S IMAGING CENTER", VARIANT_NAMES)
+    orders = pd.DataFrame({
+        'account_name': ['smi', 'Hazel Imaging'],
+        'product_short_name': 'hazel_plus',
+    })
+    # the pinned account was renamed in case only since it was pinned
+    variants = pd.DataFrame({
+        'variant_account_name': ["St. Mary's Imaging Center", 'HAZEL IMAGING'],
+        'product_short_name': 'hazel_plus',
+        'id': [1, 2],
+    })
+
+    df = fuzzy_merge(
+        orders, variants, 'account_name', 'variant_account_name',
+        block_keys='product_short_name', memo=memo, how='inner',
+    ).set_index('account_name')
+
+    assert df['id'].to_dict() == {'smi': 1, 'Hazel Imaging': 2}
+    assert df['score'].to_dict() == {'smi': 100, 'Hazel Imaging': 100}
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+from collections import Counter
+
+import pytest
+import requests
+
+from jdx_dsb_shopify.util.shopify_utils import ShopifyCallLimiter, assign_variant_shards
+from tests.helpers import make_response
+
+
+def test_limiter_lets_calls_through_until_the_headroom(fake_clock):
+    limiter = ShopifyCallLimiter(bucket_size=10, leak_rate=2.0, headroom=2, clock=fake_clock)
+    assert [limiter.reserve() for _ in range(8)] == [0.0] * 8
+    # the ninth call overflows the usable bucket by one call, i.e. half a second of leak
+    assert limiter.reserve() == pytest.approx(0.5)
+
+
+def test_limiter_refills_at_the_leak_rate(fake_clock):
+    limiter = ShopifyCallLimiter(bucket_size=10, leak_rate=2.0, headroom=2, clock=fake_clock)
+    for _ in range(8):
+        limiter.reserve()
+    assert limiter.remaining == pytest.approx(2.0)
+    fake_clock.advance(1.5)
+    assert limiter.remaining == pytest.approx(5.0)
+    fake_clock.advance(60)
+    assert limiter.remaining == pytest.approx(10.0)
+    assert limiter.reserve() == 0.0
+
+
+def test_limiter_resyncs_from_the_call_limit_header(fake_clock):
+    limiter = ShopifyCallLimiter(bucket_size=40, leak_rate=2.0, headroom=2, clock=fake_clock)
+    limiter.update_from_response(make_response(headers={'X-Shopify-Shop-Api-Call-Limit': '79/80'}))
+    assert limiter.bucket_size == 80
+    assert limiter.remaining == pytest.approx(1.0)
+    # a lower header never lowers the local estimate, calls may still be in flight
+    limiter.update_from_response(make_response(headers={'X-Shopify-Shop-Api-Call-Limit': '10/80'}))
+    assert limiter.remaining == pytest.approx(1.0)
+
+
+def test_limiter_blocks_every_caller_until_retry_after(fake_clock):
+    limiter = ShopifyCallLimiter(clock=fake_clock)
+    limiter.update_from_response(make_response(429, headers={'Retry-After': '2.0'}))
+    assert limiter.reserve() == pytest.approx(2.0)
+    fake_clock.advance(1.5)
+    assert limiter.reserve() == pytest.approx(0.5)
+    fake_clock.advance(0.5)
+    assert limiter.reserve() == 0.0
+
+
+def test_create_orders_keeps_input_order_and_returns_none_on_failure(shopify_helper, monkeypatch):
+    calls = list()
+    lock = threading.Lock()
+
+    def fake_request(method, url, **kwargs):
+        n = json.loads(kwargs['data'])['order']['n']
+        with lock:
+            calls.append(n)
+        # later orders finish first, results must still come back in input order
+        time.sleep(0.005 * (10 - n))
+        if n == 3:
+            raise requests.ConnectionError('connection reset')
+        return make_response(201, json.dumps({'order': {'name': f'#{n}'}}).encode())
+
+    monkeypatch.setattr(shopify_helper, '_request', fake_request)
+    responses = shopify_helper.create_orders([{'order': {'n': n}} for n in range(10)], max_workers=4)
+
+    assert sorted(calls) == list(range(10))
+    assert responses[3] is None
+    assert [r.json()['order']['name'] for i, r in enumerate(responses) if i != 3] == [
+        f'#{n}' for n in range(10) if n != 3
+    ]
+
+
+def test_batch_concurrency_follows_the_call_budget(shopify_helper, fake_clock):
+    shopify_helper._limiter = ShopifyCallLimiter(bucket_size=40, clock=fake_clock)
+    assert shopify_helper._target_concurrency(8) == 8
+    shopify_helper.limiter.update_from_response(make_response(headers={'X-Shopify-Shop-Api-Call-Limit': '30/40'}))
+    assert shopify_helper._target_concurrency(8) == 2
+    shopify_helper.limiter.update_from_response(make_response(headers={'X-Shopify-Shop-Api-Call-Limit': '40/40'}))
+    assert shopify_helper._target_concurrency(8) == 1
+
+
+def accounts(n, start=0):
+    return [f'acc-{i}' for i in range(start, start + n)]
+
+
+def test_shards_are_deterministic_and_within_the_variant_limit():
+    shard_map = assign_variant_shards(accounts(250), max_variants=100)
+    assert shard_map == assign_variant_shards(list(reversed(accounts(250))), max_variants=100)
+    assert set(shard_map.values()) == {0, 1, 2}
+    assert max(Counter(shard_map.values()).values()) <= 100
+
+
+def test_up_to_the_limit_accounts_share_one_product():
+    assert set(assign_variant_shards(accounts(100), max_variants=100).values()) == {0}
+
+
+@pytest.mark.parametrize('n_before, n_after', [(100, 101), (150, 201), (250, 260)])
+def test_growing_the_account_set_only_places_new_accounts(n_before, n_after):
+    current = assign_variant_shards(accounts(n_before), max_variants=100)
+    shard_map = assign_variant_shards(accounts(n_after), max_variants=100, current_shards=current)
+
+    moved = [a for a, shard in current.items() if shard_map[a] != shard]
+    assert moved == []
+    assert max(Counter(shard_map.values()).values()) <= 100
+
+
+def test_shrinking_only_moves_the_accounts_of_removed_shards():
+    current = assign_variant_shards(accounts(250), max_variants=100)
+    remaining = accounts(150)
+    shard_map = assign_variant_shards(remaining, max_variants=100, current_shards=current)
+
+    moved = {a for a in remaining if shard_map[a] != current[a]}
+    assert moved == {a for a in remaining if current[a] >= 2}
+    assert set(shard_map.values()) == {0, 1}
+    assert max(Counter(shard_map.values()).values()) <= 100
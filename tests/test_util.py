@@ -0,0 +1,66 @@
+import pandas as pd
+import pytest
+
+from jdx_dsb_shopify.util.util import fuzzy_merge
+
+# reference implementation, fuzzy_merge must keep returning its matches and scores
+process = pytest.importorskip('thefuzz.process')
+
+ORDERS = pd.DataFrame({
+    'account_name': [
+        'Hazel Imaging',             # scores 100 against two variants, the first one wins
+        'hazel imaging',
+        'ST. MARYS IMAGING CENTER',  # equal once punctuation and case are dropped
+        'St Marys Imaging',          # below the threshold
+        'Birch Clinic',
+        'Birch Clinic',
+        'Oak Radiology',
+        'Pine MRI',
+        'Unknown Place',             # below the threshold
+    ],
+    'order': range(9),
+})
+
+VARIANTS = pd.DataFrame({
+    'variant_account_name': [
+        'HAZEL IMAGING',
+        'St. Marys Imaging Center',
+        'Birch Clinic',
+        'Birch Clinic West',
+        'Oak Radiology Group',
+        'Oak Radiology Grp',
+        'Pine M.R.I.',
+        'Hazel Imaging',
+    ],
+    'id': range(8),
+})
+
+
+def thefuzz_merge(df_1, df_2, key1, key2, threshold=90, **kwargs):
+    """fuzzy_merge before it was vectorized."""
+    df_1 = df_1.copy()
+    s = df_2[key2].tolist()
+    df_1[['matched', 'score']] = df_1[key1].apply(lambda x: process.extractOne(x, s)).apply(pd.Series)
+    return df_1.merge(df_2, left_on=['matched'], right_on=[key2], **kwargs).query(f'score>={threshold}')
+
+
+def comparable(df):
+    df = df[['order', 'account_name', 'matched', 'score', 'id']].astype({'score': int})
+    return df.sort_values('order').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('threshold', [0, 90, 95])
+@pytest.mark.parametrize('how', ['inner', 'left'])
+def test_fuzzy_merge_matches_thefuzz(threshold, how):
+    expected = thefuzz_merge(ORDERS, VARIANTS, 'account_name', 'variant_account_name', threshold=threshold, how=how)
+    actual = fuzzy_merge(ORDERS, VARIANTS, 'account_name', 'variant_account_name', threshold=threshold, how=how)
+
+    pd.testing.assert_frame_equal(comparable(actual), comparable(expected))
+
+
+def test_fuzzy_merge_ties_go_to_the_first_variant():
+    actual = fuzzy_merge(ORDERS, VARIANTS, 'account_name', 'variant_account_name', how='inner')
+
+    assert actual.loc[actual['account_name'] == 'Hazel Imaging', 'id'].tolist() == [0]
+    assert 'St Marys Imaging' not in actual['account_name'].tolist()
+    assert 'Unknown Place' not in actual['account_name'].tolist()